@@ -29,7 +29,8 @@ from hyperkitty.models import ArchivePolicy, Email, MailingList
 from .attachment import AttachmentSerializer
 from .sender import SenderSerializer
 from .utils import (
-    IsMailingListPublicOrIsMember, MLChildHyperlinkedRelatedField)
+    IsMailingListPublicOrIsMember, KeysetPaginationMixin,
+    MLChildHyperlinkedRelatedField)
 
 
 class EmailShortSerializer(serializers.HyperlinkedModelSerializer):
@@ -71,12 +72,18 @@ class EmailSerializer(EmailShortSerializer):
         return obj.get_votes()
 
 
-class EmailList(generics.ListAPIView):
+class EmailList(KeysetPaginationMixin, generics.ListAPIView):
     """List emails"""
 
     serializer_class = EmailShortSerializer
     ordering_fields = ("archived_date", "thread_order", "date")
 
+    def get_keyset_ordering(self):
+        if "thread_id" in self.kwargs:
+            # The thread order may be unset.
+            return None
+        return ("-archived_date", "-id")
+
     def get_queryset(self):
         mlist = MailingList.objects.get(name=self.kwargs["mlist_fqdn"])
         if not is_mlist_authorized(self.request, mlist):
@@ -92,10 +99,11 @@ class EmailList(generics.ListAPIView):
         return query
 
 
-class EmailListBySender(generics.ListAPIView):
+class EmailListBySender(KeysetPaginationMixin, generics.ListAPIView):
     """List emails by sender"""
 
     serializer_class = EmailShortSerializer
+    keyset_ordering = ("-archived_date", "-id")
 
     def get_queryset(self):
         key = self.kwargs["mailman_id"]
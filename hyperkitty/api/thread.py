@@ -27,7 +27,8 @@ from rest_framework import generics, serializers
 from hyperkitty.lib.view_helpers import is_mlist_authorized
 from hyperkitty.models import MailingList, Thread
 from .utils import (
-    IsMailingListPublicOrIsMember, MLChildHyperlinkedRelatedField)
+    IsMailingListPublicOrIsMember, KeysetPaginationMixin,
+    MLChildHyperlinkedRelatedField)
 
 
 class ThreadShortSerializer(serializers.HyperlinkedModelSerializer):
@@ -84,11 +85,12 @@ class ThreadSerializer(ThreadShortSerializer):
             ]
 
 
-class ThreadList(generics.ListAPIView):
+class ThreadList(KeysetPaginationMixin, generics.ListAPIView):
     """List threads"""
 
     serializer_class = ThreadShortSerializer
     ordering = ("-date_active", )
+    keyset_ordering = ("-date_active", "-id")
 
     def get_queryset(self):
         mlist = MailingList.objects.get(name=self.kwargs["mlist_fqdn"])
@@ -19,8 +19,16 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+from collections import OrderedDict
+
 from rest_framework import permissions, serializers
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
+from hyperkitty.lib.paginator import InvalidCursor, cursor_paginate
 from hyperkitty.lib.view_helpers import is_mlist_authorized
 from hyperkitty.models import MailingList
 
@@ -82,3 +90,71 @@ class IsMailingListPublicOrIsMember(permissions.BasePermission):
             # This is not a object linked to a mailing-list.
             return True
         return is_mlist_authorized(request, mlist)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginate with opaque cursors over a unique ordering (see
+    hyperkitty.lib.paginator). The number of results is set with the
+    ``limit`` query parameter.
+    """
+
+    cursor_query_param = "cursor"
+    limit_query_param = "limit"
+
+    def __init__(self, ordering):
+        self.ordering = ordering
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            self.page = cursor_paginate(
+                queryset, request.query_params.get(self.cursor_query_param),
+                request.query_params.get(
+                    self.limit_query_param, api_settings.PAGE_SIZE),
+                ordering=self.ordering)
+        except InvalidCursor:
+            raise NotFound("Invalid cursor")
+        return list(self.page)
+
+    def _get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        return self._get_link(self.page.next_cursor)
+
+    def get_previous_link(self):
+        return self._get_link(self.page.previous_cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]))
+
+
+class KeysetPaginationMixin(object):
+    """
+    Use the keyset pagination in a list view when a ``cursor`` query
+    parameter is given, the default pagination is used otherwise.
+    """
+
+    #: The unique ordering of the keyset pagination, None to disable it.
+    keyset_ordering = None
+
+    def get_keyset_ordering(self):
+        return self.keyset_ordering
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            ordering = self.get_keyset_ordering()
+            if (ordering is not None and
+                    KeysetPagination.cursor_query_param in
+                    self.request.query_params):
+                self._paginator = KeysetPagination(ordering)
+        return super().paginator
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+"""
+Build the missing mbox archives of the past months.
+"""
+
+from django_extensions.management.jobs import BaseJob
+
+from hyperkitty.lib.archives import build_missing_month_archives
+from hyperkitty.models import MailingList
+
+
+class Job(BaseJob):
+    help = "Build the missing monthly mbox archives"
+    when = "daily"
+
+    def execute(self):
+        for mlist in MailingList.objects.all():
+            build_missing_month_archives(mlist)
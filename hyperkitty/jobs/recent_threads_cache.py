@@ -34,5 +34,4 @@ class Job(BaseJob):
 
     def execute(self):
         for mlist in MailingList.objects.all():
-            for cached_value in mlist.recent_cached_values:
-                cached_value.rebuild()
+            mlist.rebuild_recent_cache()
@@ -25,7 +25,7 @@ Compute thread order and depth for all threads
 
 from django_extensions.management.jobs import BaseJob
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.analysis import compute_threads_order_and_depth
 from hyperkitty.models import Thread
 
 
@@ -34,5 +34,5 @@ class Job(BaseJob):
     when = "yearly"
 
     def execute(self):
-        for thread in Thread.objects.all():
-            compute_thread_order_and_depth(thread)
+        compute_threads_order_and_depth(
+            Thread.objects.values_list("id", flat=True).iterator())
@@ -23,33 +23,183 @@ Analysis of messages or threads of messages
 Author: Aurelien Bompard <abompard@fedoraproject.org>
 """
 
+from collections import defaultdict
+from itertools import islice
+
 from django.db import transaction
+from django.db.models import F, Max, Q
+
+
+# Number of threads loaded at once by compute_threads_order_and_depth().
+THREADS_BATCH_SIZE = 500
 
-import networkx as nx
+# Number of emails updated by each bulk UPDATE query.
+BULK_UPDATE_SIZE = 1000
 
 
 def compute_thread_order_and_depth(thread):
-    # Emails must be saved, there will be DB queries in this function.
-    graph = nx.DiGraph()
-    thread_pos = {"d": 0, "o": 0}  # depth, order
-
-    def walk_successors(msgid):
-        obj = graph.nodes[msgid]["obj"]
-        obj.thread_depth = thread_pos["d"]
-        obj.thread_order = thread_pos["o"]
-        obj.save(update_fields=["thread_depth", "thread_order"])
-        thread_pos["d"] += 1
-        thread_pos["o"] += 1
-        for succ in sorted(graph.successors(msgid),
-                           key=lambda m: graph.nodes[m]["num"]):
-            walk_successors(succ)
-        thread_pos["d"] -= 1
-    for index, email in enumerate(thread.emails.order_by("date")):
-        graph.add_node(email.id, num=index, obj=email)
-        if email.parent_id is not None:
-            graph.add_edge(email.parent_id, email.id)
-            if not nx.is_directed_acyclic_graph(graph):
-                # I don't want reply loops in my graph, thank you very much
-                graph.remove_edge(email.parent_id, email.id)
+    """
+    Compute the thread_order and thread_depth values for a thread.
+
+    :arg thread: the thread, its emails must be saved.
+    """
+    _update_thread_positions(
+        {thread.id: thread.starting_email_id}, thread.emails.all())
+
+
+def compute_email_order_and_depth(email):
+    """
+    Insert a new email in the order and depth of its thread.
+
+    A reply without replies of its own does not change the position of the
+    other emails relative to each other, so it is inserted at its slot and
+    the order of the emails after it is shifted with a single query. When
+    that is not possible, for example if the rest of the thread has not
+    been positioned yet, the whole thread is computed again.
+
+    :arg email: the new email, it must be saved.
+    """
+    from hyperkitty.models.email import Email  # circular import
+    thread = email.thread
+    siblings = thread.emails.exclude(id=email.id)
+    if (email.parent_id is None or email.parent_id == email.id
+            or email.children.exists()
+            or siblings.filter(thread_order__isnull=True).exists()):
+        compute_thread_order_and_depth(thread)
+        return
+    try:
+        parent_order, parent_depth = siblings.filter(
+            id=email.parent_id).values_list(
+            "thread_order", "thread_depth").get()
+    except Email.DoesNotExist:
+        compute_thread_order_and_depth(thread)
+        return
+    # Replies are sorted by date under their parent: the new email takes
+    # the place of the first later reply, or goes after the parent's
+    # replies.
+    next_order = siblings.filter(parent_id=email.parent_id).filter(
+        Q(date__gt=email.date) | Q(date=email.date, id__gt=email.id)
+        ).order_by("date", "id").values_list(
+        "thread_order", flat=True).first()
+    if next_order is None:
+        next_order = siblings.filter(
+            thread_order__gt=parent_order, thread_depth__lte=parent_depth
+            ).order_by("thread_order").values_list(
+            "thread_order", flat=True).first()
+    if next_order is None:
+        next_order = siblings.aggregate(
+            max_order=Max("thread_order"))["max_order"] + 1
+    with transaction.atomic():
+        siblings.filter(thread_order__gte=next_order).update(
+            thread_order=F("thread_order") + 1)
+        thread.emails.filter(id=email.id).update(
+            thread_order=next_order, thread_depth=parent_depth + 1)
+    email.thread_order = next_order
+    email.thread_depth = parent_depth + 1
+
+
+def compute_threads_order_and_depth(thread_ids):
+    """
+    Compute the thread_order and thread_depth values for many threads.
+
+    The emails of the threads are loaded by batches with a single query for
+    each batch, and only the emails whose values changed are written back,
+    with bulk updates. This gives the same result as calling
+    :func:`compute_thread_order_and_depth` for each thread.
+
+    :arg thread_ids: an iterable of thread ids.
+    """
+    from hyperkitty.models.email import Email  # circular import
+    from hyperkitty.models.thread import Thread  # circular import
+    thread_ids = iter(thread_ids)
+    while True:
+        batch = list(islice(thread_ids, THREADS_BATCH_SIZE))
+        if not batch:
+            break
+        starting_emails = Thread.objects.filter(
+            id__in=batch, starting_email__isnull=False
+            ).values_list("id", "starting_email_id")
+        _update_thread_positions(
+            dict(starting_emails), Email.objects.filter(thread_id__in=batch))
+
+
+def _update_thread_positions(starting_emails, emails):
+    """
+    Compute and store the order and depth of the emails in some threads.
+
+    :arg starting_emails: a dict mapping the thread ids to the ids of their
+        starting email.
+    :arg emails: a queryset of the emails in those threads.
+    """
+    from hyperkitty.models.email import Email  # circular import
+    thread_emails = defaultdict(list)
+    current = {}
+    emails = emails.order_by("date", "id").values_list(
+        "id", "thread_id", "parent_id", "thread_order", "thread_depth")
+    for email_id, thread_id, parent_id, order, depth in emails:
+        thread_emails[thread_id].append((email_id, parent_id))
+        current[email_id] = (order, depth)
+    changed = []
+    for thread_id, starting_email_id in starting_emails.items():
+        positions = _get_thread_positions(
+            starting_email_id, thread_emails[thread_id])
+        for email_id, (order, depth) in positions.items():
+            if current[email_id] != (order, depth):
+                changed.append(Email(
+                    id=email_id, thread_order=order, thread_depth=depth))
     with transaction.atomic():
-        walk_successors(thread.starting_email.id)
+        Email.objects.bulk_update(
+            changed, ["thread_order", "thread_depth"],
+            batch_size=BULK_UPDATE_SIZE)
+
+
+def _get_thread_positions(starting_email_id, emails):
+    """
+    Compute the order and depth of the emails in a thread.
+
+    Replies are sorted by date under their parent. A reply that would
+    create a loop is ignored, as are the emails that can't be reached from
+    the starting email.
+
+    :arg starting_email_id: the id of the thread's starting email.
+    :arg emails: a list of ``(id, parent_id)`` tuples, sorted by date.
+    :returns: a dict mapping the email ids to ``(order, depth)`` tuples.
+    """
+    email_ids = set(email_id for email_id, _parent_id in emails)
+    if starting_email_id not in email_ids:
+        return {}
+    # Each email has at most one parent, so the replies form a forest. The
+    # trees are tracked with a union-find structure: a reply creates a loop
+    # if its parent is in its own tree, since the reply is that tree's root
+    # until it is attached to its parent.
+    tree = {email_id: email_id for email_id in email_ids}
+
+    def find_tree(email_id):
+        root = email_id
+        while tree[root] != root:
+            root = tree[root]
+        while tree[email_id] != root:
+            tree[email_id], email_id = root, tree[email_id]
+        return root
+
+    children = defaultdict(list)
+    for email_id, parent_id in emails:
+        if parent_id not in email_ids:
+            continue
+        parent_tree = find_tree(parent_id)
+        email_tree = find_tree(email_id)
+        if parent_tree == email_tree:
+            continue  # Reply loop
+        tree[email_tree] = parent_tree
+        children[parent_id].append(email_id)
+    # Walk the tree depth-first, with an explicit stack to support very
+    # long reply chains.
+    positions = {}
+    stack = [(starting_email_id, 0)]
+    while stack:
+        email_id, depth = stack.pop()
+        positions[email_id] = (len(positions), depth)
+        stack.extend(
+            (child_id, depth + 1)
+            for child_id in reversed(children[email_id]))
+    return positions
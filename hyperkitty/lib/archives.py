@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Precomputed monthly mbox archives.
+
+The emails of a past month rarely change, so the compressed mbox of a month
+is written once to a storage and served as a static file. It is removed when
+an email of that month is added, deleted or reattached, and written again in
+the background.
+"""
+
+import datetime
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.module_loading import import_string
+from django.utils.timezone import now, utc
+
+from hyperkitty.lib.mbox import gzip_stream, iter_mbox
+from hyperkitty.lib.view_helpers import file_response, get_display_dates
+
+
+def get_storage():
+    """
+    Return the storage of the monthly archives, or None if they are disabled.
+
+    The ``HYPERKITTY_MBOX_ARCHIVES_STORAGE`` setting is the dotted path of a
+    Django storage class. Otherwise, the archives are stored in the
+    ``HYPERKITTY_MBOX_ARCHIVES_FOLDER`` directory, if it is set.
+    """
+    storage_class = getattr(
+        settings, "HYPERKITTY_MBOX_ARCHIVES_STORAGE", None)
+    if storage_class:
+        return import_string(storage_class)()
+    folder = getattr(settings, "HYPERKITTY_MBOX_ARCHIVES_FOLDER", None)
+    if folder:
+        return FileSystemStorage(location=folder)
+    return None
+
+
+def is_past_month(year, month):
+    """Whether the month (in UTC) is over, and its archive can be built."""
+    return get_display_dates(year, month, None)[1] <= now()
+
+
+def get_archive_name(mlist, year, month):
+    try:
+        listname, domain = mlist.name.rsplit("@", 1)
+    except ValueError:
+        listname = "none"
+        domain = mlist.name
+    return "%s/%s/%04d-%02d.mbox.gz" % (domain, listname, year, month)
+
+
+def build_month_archive(mlist, year, month):
+    """
+    Write the archive of a past month to the storage, replacing the existing
+    one. Return its name, or None if it can't be built.
+    """
+    storage = get_storage()
+    if storage is None or not is_past_month(year, month):
+        return None
+    begin_date, end_date = get_display_dates(year, month, None)
+    query = mlist.emails.filter(date__gte=begin_date, date__lt=end_date)
+    name = get_archive_name(mlist, year, month)
+    with tempfile.TemporaryFile() as archive:
+        for chunk in gzip_stream(iter_mbox(query)):
+            archive.write(chunk)
+        archive.seek(0)
+        _replace(storage, name, File(archive))
+    return name
+
+
+def _replace(storage, name, content):
+    """
+    Replace a file of the storage without ever serving a partial file: it is
+    written to a temporary name first. On a local filesystem, it is then
+    atomically renamed.
+    """
+    tmp_name = storage.save("%s.%s.tmp" % (name, uuid.uuid4().hex), content)
+    try:
+        if isinstance(storage, FileSystemStorage):
+            os.replace(storage.path(tmp_name), storage.path(name))
+            return
+        # Other storages can't rename, the file is missing for a moment and
+        # the view exports the month as usual in the meantime.
+        storage.delete(name)
+        with storage.open(tmp_name) as tmp_file:
+            saved_name = storage.save(name, tmp_file)
+        if saved_name != name:
+            # Another build saved it concurrently.
+            storage.delete(saved_name)
+    finally:
+        if storage.exists(tmp_name):
+            storage.delete(tmp_name)
+
+
+def build_missing_month_archives(mlist):
+    """Build the archives of the past months which have emails."""
+    storage = get_storage()
+    if storage is None:
+        return
+    months = mlist.emails.datetimes("date", "month", tzinfo=utc)
+    for month_date in months.iterator():
+        year, month = month_date.year, month_date.month
+        if not is_past_month(year, month):
+            continue
+        if not storage.exists(get_archive_name(mlist, year, month)):
+            build_month_archive(mlist, year, month)
+
+
+def invalidate_month_archive(mlist, year, month):
+    """
+    Remove the archive of a month whose emails have changed, and rebuild it
+    in the background.
+    """
+    storage = get_storage()
+    if storage is None or not is_past_month(year, month):
+        return
+    storage.delete(get_archive_name(mlist, year, month))
+    from hyperkitty.tasks import rebuild_mbox_archive  # circular import
+    rebuild_mbox_archive(mlist.name, year, month)
+
+
+def serve_month_archive(request, mlist, year, month, filename):
+    """
+    Return a response serving the archive of a month, or None if it has not
+    been built yet (its build is then scheduled).
+    """
+    storage = get_storage()
+    if storage is None or not is_past_month(year, month):
+        return None
+    name = get_archive_name(mlist, year, month)
+    try:
+        archive = storage.open(name) if storage.exists(name) else None
+    except FileNotFoundError:
+        # It was being replaced.
+        archive = None
+    if archive is None:
+        from hyperkitty.tasks import rebuild_mbox_archive  # circular import
+        rebuild_mbox_archive(mlist.name, year, month)
+        return None
+    if isinstance(storage, FileSystemStorage):
+        # The file may be replaced in the meantime, describe the open one.
+        stat = os.fstat(archive.fileno())
+        size = stat.st_size
+        last_modified = datetime.datetime.fromtimestamp(stat.st_mtime, utc)
+    else:
+        size = storage.size(name)
+        try:
+            last_modified = storage.get_modified_time(name)
+        except NotImplementedError:
+            last_modified = None
+    etag = '"%x-%x"' % (
+        int(last_modified.timestamp() * 1000000) if last_modified else 0,
+        size)
+    return file_response(
+        request, archive, size, "application/gzip",
+        filename=filename, etag=etag, last_modified=last_modified)
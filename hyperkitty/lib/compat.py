@@ -51,5 +51,5 @@ def get_list_by_name(list_name, domain):
 def month_name_to_num(month_name):
     """map month names to months numbers"""
     months = dict((datetime.date(2000, num, 1).strftime('%B'), num)
-                  for num in range(1, 12))
+                  for num in range(1, 13))
     return months[month_name]
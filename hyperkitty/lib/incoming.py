@@ -22,10 +22,12 @@
 
 import logging
 import re
+from collections import namedtuple
 from email.message import EmailMessage
 
 from django.conf import settings
-from django.db import DataError
+from django.db import DatabaseError, DataError, transaction
+from django.db.models.base import ModelState
 from django.utils import timezone
 
 from django_mailman3.lib.scrub import Scrubber
@@ -33,7 +35,9 @@ from django_mailman3.lib.scrub import Scrubber
 from hyperkitty.lib.utils import (
     get_message_id, get_ref, header_to_unicode, parseaddr, parsedate)
 from hyperkitty.models import (
-    ArchivePolicy, Attachment, Email, MailingList, Sender)
+    ArchivePolicy, Attachment, AttachmentBlob, Email, MailingList,
+    Sender, Thread)
+from hyperkitty.models.thread import update_thread_counts
 from hyperkitty.tasks import sender_mailman_id, update_from_mailman
 
 
@@ -49,6 +53,10 @@ class DuplicateMessage(Exception):
     """
 
 
+ParsedMessage = namedtuple(
+    "ParsedMessage", ["email", "sender_address", "attachments"])
+
+
 def add_to_list(list_name, message):
     assert isinstance(message, EmailMessage)
     # timeit("1 start")
@@ -65,7 +73,23 @@ def add_to_list(list_name, message):
     msg_id = get_message_id(message)
     if Email.objects.filter(mailinglist=mlist, message_id=msg_id).exists():
         raise DuplicateMessage(msg_id)
-    email = Email(mailinglist=mlist, message_id=msg_id)
+    email = _store_email(mlist, parse_message(message))
+    return email.message_id_hash
+
+
+def parse_message(message):
+    """
+    Extract everything HyperKitty stores about a message, without touching
+    the database.
+
+    :returns: a ``ParsedMessage`` holding an unsaved ``Email`` instance (with
+        neither its mailing-list, its sender nor its thread set), the sender's
+        address and the list of attachments found by the scrubber.
+    """
+    assert isinstance(message, EmailMessage)
+    if "Message-Id" not in message:
+        raise ValueError("No 'Message-Id' header in email", message)
+    email = Email(message_id=get_message_id(message))
     email.in_reply_to = get_ref(message)  # Find thread id
     if message.get_unixfrom() is not None:
         mo = UNIXFROM_DATE_RE.match(message.get_unixfrom())
@@ -91,11 +115,6 @@ def add_to_list(list_name, message):
         else:
             sender_address = "unknown@example.com"
     email.sender_name = from_name
-    sender = Sender.objects.get_or_create(address=sender_address)[0]
-    email.sender = sender
-    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        sender_mailman_id(sender.pk)
-    # timeit("3 after sender, before email content")
 
     # Headers
     email.subject = header_to_unicode(message.get('Subject'))
@@ -125,6 +144,18 @@ def add_to_list(list_name, message):
 
     # TODO: detect category?
 
+    return ParsedMessage(email, sender_address, attachments)
+
+
+def _store_email(mlist, parsed):
+    email = parsed.email
+    email.mailinglist = mlist
+    sender = Sender.objects.get_or_create(address=parsed.sender_address)[0]
+    email.sender = sender
+    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+        sender_mailman_id(sender.pk)
+    # timeit("3 after sender, before email content")
+
     # Find the parent email.
     # This can't be moved to Email.on_pre_save() because Email.set_parent()
     # needs to be free to change the parent independently from the in_reply_to
@@ -155,14 +186,227 @@ def add_to_list(list_name, message):
         raise ValueError(str(e))
 
     # Attachments (email must have been saved before)
-    for attachment in attachments:
+    for attachment in parsed.attachments:
         counter, name, content_type, encoding, content = attachment
         if Attachment.objects.filter(email=email, counter=counter).exists():
             continue
-        att = Attachment.objects.create(
+        att = Attachment(
             email=email, counter=counter, name=name, content_type=content_type,
             encoding=encoding)
-        att.set_content(content)
-        att.save()
+        # The blob must not be deleted before the attachment uses it.
+        with transaction.atomic():
+            att.set_content(content)
+            att.save()
 
-    return email.message_id_hash
+    return email
+
+
+def add_batch_to_list(list_name, batch):
+    """
+    Store many parsed messages at once, using a fixed number of queries.
+
+    Senders, parents and threads are resolved with set-based queries and the
+    rows are inserted with ``bulk_create()``. The model signals are not sent,
+    so this is only meant for imports in batch mode, where the thread order
+    and the caches are computed at the end of the import process. If the bulk
+    insert fails, the batch is stored again one email at a time, to isolate
+    the faulty messages.
+
+    :arg list_name: the mailing-list address.
+    :arg batch: a list of ``ParsedMessage`` instances, in archival order.
+    :returns: a tuple with the list of stored ``Email`` instances and a list
+        of ``(parsed_message, exception)`` tuples for the messages that could
+        not be stored, including the duplicates.
+    """
+    mlist = MailingList.objects.get_or_create(name=list_name)[0]
+    if mlist.archive_policy == ArchivePolicy.never.value:
+        logger.info("Archiving disabled by list policy for %s", list_name)
+        return [], []
+    try:
+        with transaction.atomic():
+            return _store_batch(mlist, batch)
+    except DatabaseError as e:
+        logger.warning(
+            "Could not bulk-insert %d emails in %s, storing them one by "
+            "one: %s", len(batch), list_name, e)
+    emails = []
+    failures = []
+    for parsed in batch:
+        # Forget what the bulk insert has set before being rolled back.
+        parsed.email.id = parsed.email.parent_id = None
+        parsed.email.thread_id = None
+        parsed.email._state = ModelState()
+        try:
+            with transaction.atomic():
+                if Email.objects.filter(
+                        mailinglist=mlist,
+                        message_id=parsed.email.message_id).exists():
+                    raise DuplicateMessage(parsed.email.message_id)
+                emails.append(_store_email(mlist, parsed))
+        except Exception as e:
+            failures.append((parsed, e))
+    return emails, failures
+
+
+def _store_batch(mlist, batch):
+    failures = []
+    # Duplicates, in the database and inside the batch.
+    existing = set(Email.objects.filter(
+        mailinglist=mlist,
+        message_id__in=[p.email.message_id for p in batch],
+        ).values_list("message_id", flat=True))
+    pending = []
+    for parsed in batch:
+        msg_id = parsed.email.message_id
+        if msg_id in existing:
+            failures.append((parsed, DuplicateMessage(msg_id)))
+            continue
+        existing.add(msg_id)
+        pending.append(parsed)
+    if not pending:
+        return [], failures
+
+    # Senders
+    addresses = set(p.sender_address for p in pending)
+    addresses.difference_update(Sender.objects.filter(
+        address__in=addresses).values_list("address", flat=True))
+    Sender.objects.bulk_create(
+        [Sender(address=address) for address in addresses])
+
+    # Parents. Like in add_to_list(), a reply can only be attached to an email
+    # that has been archived before it.
+    parents = {
+        msg_id: (email_id, thread_id)
+        for msg_id, email_id, thread_id in Email.objects.filter(
+            mailinglist=mlist,
+            message_id__in=set(
+                p.email.in_reply_to for p in pending
+                if p.email.in_reply_to is not None),
+            ).values_list("message_id", "id", "thread_id")
+        }
+    in_batch = {}
+    batch_parents = {}
+    # Emails starting a new thread, or in a thread started in this batch, are
+    # mapped to the new thread's thread_id.
+    new_thread_ids = {}
+    starters = {}
+    for parsed in pending:
+        email = parsed.email
+        email.mailinglist = mlist
+        email.sender_id = parsed.sender_address
+        ref = email.in_reply_to
+        if ref in parents:
+            email.parent_id, email.thread_id = parents[ref]
+        elif ref in in_batch:
+            parent = in_batch[ref]
+            batch_parents[email.message_id] = parent
+            if parent.thread_id is not None:
+                email.thread_id = parent.thread_id
+            else:
+                new_thread_ids[email.message_id] = \
+                    new_thread_ids[parent.message_id]
+        else:
+            new_thread_ids[email.message_id] = email.message_id_hash
+            starters[email.message_id_hash] = email
+        in_batch[email.message_id] = email
+
+    # Threads. An existing thread may already use the thread_id, leave those
+    # emails and their replies to add_to_list's logic.
+    conflicting = set(Thread.objects.filter(
+        mailinglist=mlist, thread_id__in=set(new_thread_ids.values()),
+        ).values_list("thread_id", flat=True))
+    fallback = [p for p in pending
+                if new_thread_ids.get(p.email.message_id) in conflicting]
+    pending = [p for p in pending
+               if new_thread_ids.get(p.email.message_id) not in conflicting]
+    new_threads = {}
+    for parsed in pending:
+        thread_id = new_thread_ids.get(parsed.email.message_id)
+        if thread_id is None:
+            continue
+        date = parsed.email.date
+        if thread_id not in new_threads:
+            new_threads[thread_id] = Thread(
+                mailinglist=mlist, thread_id=thread_id, date_active=date)
+        elif date > new_threads[thread_id].date_active:
+            new_threads[thread_id].date_active = date
+    Thread.objects.bulk_create(new_threads.values())
+    thread_pks = dict(Thread.objects.filter(
+        mailinglist=mlist, thread_id__in=list(new_threads),
+        ).values_list("thread_id", "id"))
+    for parsed in pending:
+        thread_id = new_thread_ids.get(parsed.email.message_id)
+        if thread_id is not None:
+            parsed.email.thread_id = thread_pks[thread_id]
+
+    # Emails
+    emails = [p.email for p in pending]
+    Email.objects.bulk_create(emails)
+    email_pks = dict(Email.objects.filter(
+        mailinglist=mlist, message_id__in=[e.message_id for e in emails],
+        ).values_list("message_id", "id"))
+    for email in emails:
+        email.id = email_pks[email.message_id]
+    children = []
+    for email in emails:
+        parent = batch_parents.get(email.message_id)
+        if parent is not None:
+            email.parent_id = parent.id
+            children.append(email)
+    Email.objects.bulk_update(children, ["parent"])
+
+    # Thread starters and activity dates.
+    for thread in new_threads.values():
+        thread.id = thread_pks[thread.thread_id]
+        thread.starting_email_id = starters[thread.thread_id].id
+    Thread.objects.bulk_update(new_threads.values(), ["starting_email"])
+    # Replies to existing threads make them active again.
+    new_thread_pks = set(thread_pks.values())
+    active_dates = {}
+    for email in emails:
+        if email.thread_id in new_thread_pks:
+            continue
+        active_dates[email.thread_id] = max(
+            email.date, active_dates.get(email.thread_id, email.date))
+    updated_threads = []
+    for thread in Thread.objects.filter(
+            id__in=list(active_dates)).only("id", "date_active"):
+        if active_dates[thread.id] > thread.date_active:
+            thread.date_active = active_dates[thread.id]
+            updated_threads.append(thread)
+    Thread.objects.bulk_update(updated_threads, ["date_active"])
+    update_thread_counts(list(set(email.thread_id for email in emails)))
+
+    # Attachments, and their blobs stored at once.
+    attachments = []
+    for parsed in pending:
+        counters = set()
+        for counter, name, content_type, encoding, content in \
+                parsed.attachments:
+            if counter in counters:
+                continue
+            counters.add(counter)
+            att = Attachment(
+                email=parsed.email, counter=counter, name=name,
+                content_type=content_type, encoding=encoding)
+            content = att.encode_content(content)
+            att.size = len(content)
+            attachments.append((att, content))
+    blobs = AttachmentBlob.store_many(
+        [content for _att, content in attachments])
+    for (att, _content), blob in zip(attachments, blobs):
+        att.blob = blob
+    Attachment.objects.bulk_create(
+        [att for att, _content in attachments])
+
+    for parsed in fallback:
+        try:
+            with transaction.atomic():
+                emails.append(_store_email(mlist, parsed))
+        except Exception as e:
+            failures.append((parsed, e))
+
+    if new_threads:
+        # The recent threads are usually updated by the Thread signals.
+        mlist.cached_values["recent_threads"].rebuild()
+    return emails, failures
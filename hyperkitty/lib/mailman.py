@@ -26,6 +26,7 @@ from urllib.error import HTTPError
 from django.core.cache import cache
 
 from django_mailman3.lib.mailman import get_mailman_client
+from django_mailman3.models import MailDomain
 from mailmanclient import MailmanConnectionError
 
 
@@ -36,6 +37,24 @@ class ModeratedListException(Exception):
     pass
 
 
+MAIL_DOMAINS_CACHE_KEY = "hyperkitty:mail_domains"
+
+
+def get_mail_domains():
+    """
+    Return a dict mapping the mail domains to the domain of their web site,
+    loaded with a single query and cached until a domain is changed.
+    """
+    def _get_mail_domains():
+        return dict(MailDomain.objects.values_list(
+            "mail_domain", "site__domain"))
+    return cache.get_or_set(MAIL_DOMAINS_CACHE_KEY, _get_mail_domains, None)
+
+
+def invalidate_mail_domains():
+    cache.delete(MAIL_DOMAINS_CACHE_KEY)
+
+
 def subscribe(list_id, user, email=None, display_name=None):
     if email is None:
         email = user.email
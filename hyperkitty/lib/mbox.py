@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Streaming reader and writer for mbox files.
+
+The standard library's ``mailbox.mbox`` scans the whole file to build its
+table of contents before the first message can be read, and keeps it in
+memory. This reader splits the file while reading it, using the same rules.
+
+The writer builds an mbox from a queryset of emails, one chunk of emails at a
+time, without keeping the emails in memory.
+"""
+
+import gzip
+import mmap
+import os
+import queue
+import threading
+import zlib
+from collections import namedtuple
+
+from django.db.models import Prefetch
+
+from hyperkitty.models.email import Attachment, Email
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+EXPORT_CHUNK_SIZE = 200
+
+
+# unixfrom: the envelope sender line, without the leading "From ".
+# content: the raw message (headers and body).
+# end: the offset of the end of the message in the (uncompressed) mbox.
+# position: the number of bytes read from the file on disk so far.
+RawMessage = namedtuple(
+    "RawMessage", ["unixfrom", "content", "end", "position"])
+
+
+class MboxReader(object):
+    """
+    Iterate over the messages of an mbox file, optionally gzip-compressed.
+
+    Uncompressed files are memory-mapped, compressed files are decompressed
+    on the fly: in both cases the memory usage does not depend on the size of
+    the file.
+
+    :arg path: the path to the mbox file.
+    :arg start: the offset in the uncompressed mbox to start reading from. It
+        is usually the ``end`` value of a message that was previously read.
+    """
+
+    def __init__(self, path, start=0):
+        self.path = path
+        self.start = start
+        self.size = os.path.getsize(path)
+        self._file = open(path, "rb")
+        self.compressed = self._file.read(2) == GZIP_MAGIC
+        self._file.seek(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        if self.compressed:
+            with gzip.GzipFile(fileobj=self._file) as gzfile:
+                gzfile.seek(self.start)
+                yield from self._split_lines(gzfile)
+        elif self.size > 0:
+            with mmap.mmap(self._file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                yield from self._split_mmap(data)
+
+    def _make_message(self, from_line, content, end, position):
+        unixfrom = from_line[5:].rstrip(b"\r\n").decode("ascii", "replace")
+        return RawMessage(unixfrom, content, end, position)
+
+    def _split_mmap(self, data):
+        size = len(data)
+        # Skip to the first "From " line.
+        start = self.start
+        if data[start:start + 5] != b"From " or (
+                start > 0 and data[start - 1] != 10):
+            start = data.find(b"\nFrom ", max(start - 1, 0))
+            if start == -1:
+                return  # No message
+            start += 1
+        while start < size:
+            next_line = data.find(b"\nFrom ", start)
+            if next_line == -1:
+                next_start = size
+                # A blank line before the end of the file is a separator.
+                stop = size - 1 if data[-2:] == b"\n\n" else size
+            else:
+                next_start = next_line + 1
+                # A blank line before the next "From " line is a separator.
+                stop = next_line if data[next_line - 1] == 10 else next_start
+            eol = data.find(b"\n", start, stop)
+            if eol == -1:
+                from_line, content = data[start:stop], b""
+            else:
+                from_line, content = data[start:eol], data[eol + 1:stop]
+            yield self._make_message(from_line, content, stop, stop)
+            start = next_start
+
+    def _split_lines(self, fileobj):
+        offset = self.start
+        from_line = None
+        lines = []
+        last_was_empty = False
+
+        def make_message():
+            # A blank line before the next "From " line is a separator.
+            content = b"".join(lines)
+            end = offset
+            if last_was_empty:
+                content = content[:-1]
+                end -= 1
+            return self._make_message(
+                from_line, content, end, self._file.tell())
+
+        for line in fileobj:
+            if line.startswith(b"From "):
+                if from_line is not None:
+                    yield make_message()
+                from_line = line
+                lines = []
+                last_was_empty = False
+            elif from_line is not None:
+                lines.append(line)
+                last_was_empty = (line == b"\n")
+            offset += len(line)
+        if from_line is not None:
+            yield make_message()
+
+
+def _get_emails_chunk(email_ids):
+    return Email.objects.filter(id__in=email_ids).select_related(
+        "sender", "mailinglist").prefetch_related(Prefetch(
+            # The content is needed, don't defer it.
+            "attachments", queryset=Attachment.objects.select_related(
+                "blob").defer(None).order_by("counter"),
+        )).order_by("archived_date", "id")
+
+
+def iter_emails(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Iterate over the emails of the query, in the archiving order.
+
+    Only the ids are read with a (server-side if possible) cursor. The emails
+    are then loaded by chunks, with their sender, mailing-list and
+    attachments.
+    """
+    email_ids = query.order_by("archived_date", "id").values_list(
+        "id", flat=True)
+    chunk = []
+    for email_id in email_ids.iterator(chunk_size=chunk_size):
+        chunk.append(email_id)
+        if len(chunk) >= chunk_size:
+            yield from _get_emails_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield from _get_emails_chunk(chunk)
+
+
+def iter_mbox(query, chunk_size=EXPORT_CHUNK_SIZE):
+    """Iterate over the emails of the query in the mbox format (bytes)."""
+    for email in iter_emails(query, chunk_size):
+        msg = email.as_message()
+        yield msg.as_bytes(unixfrom=True) + b"\n\n"
+
+
+def gzip_stream(chunks, threaded=False, level=6):
+    """
+    Compress an iterator of bytes in the gzip format.
+
+    If ``threaded`` is True, the compression is done in a separate thread,
+    while the next chunks are produced (zlib releases the GIL).
+    """
+    if threaded:
+        yield from _threaded_gzip_stream(chunks, level)
+        return
+    # Use the gzip format: http://www.zlib.net/manual.html#Advanced
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+_END = object()
+
+
+def _threaded_gzip_stream(chunks, level):
+    # The input queue is bounded, so that the memory usage does not depend
+    # on the speed of the compression.
+    todo = queue.Queue(maxsize=16)
+    done = queue.Queue()
+
+    def compress():
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        try:
+            while True:
+                chunk = todo.get()
+                if chunk is _END:
+                    done.put(compressor.flush())
+                    break
+                data = compressor.compress(chunk)
+                if data:
+                    done.put(data)
+        except Exception as e:
+            done.put(e)
+        done.put(_END)
+
+    def get_done(block):
+        while True:
+            try:
+                data = done.get(block=block)
+            except queue.Empty:
+                return
+            if data is _END:
+                return
+            if isinstance(data, Exception):
+                raise data
+            yield data
+
+    thread = threading.Thread(target=compress, daemon=True)
+    thread.start()
+    try:
+        for chunk in chunks:
+            todo.put(chunk)
+            yield from get_done(block=False)
+    finally:
+        # Also stop the thread if the response is interrupted.
+        while thread.is_alive():
+            try:
+                todo.put(_END, timeout=0.1)
+            except queue.Full:
+                continue
+            break
+    yield from get_done(block=True)
+    thread.join()
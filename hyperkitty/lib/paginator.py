@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Keyset (cursor) pagination.
+
+Instead of skipping a number of rows, a page starts right after (or before)
+the ordering values of the last (or first) object of another page. These
+values are carried in an opaque cursor. With an index on the ordering fields,
+the database reads the same number of rows for any page.
+
+The ordering must be unique, so it usually ends with the primary key, for
+example ``("-date_active", "-id")``.
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+DEFAULT_COUNT = 10
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def use_cursor_pagination(request):
+    """
+    Whether the keyset pagination should be used for this request: it is the
+    default when the ``HYPERKITTY_CURSOR_PAGINATION`` setting is True, and
+    it is always used when a cursor is given.
+    """
+    return ("cursor" in request.GET or
+            getattr(settings, "HYPERKITTY_CURSOR_PAGINATION", False))
+
+
+def _get_field_name(order):
+    return order.lstrip("-")
+
+
+def encode_cursor(obj, ordering, reverse=False):
+    """
+    Return the cursor pointing after the given object, or before it when
+    ``reverse`` is True.
+    """
+    values = []
+    for order in ordering:
+        field = obj._meta.get_field(_get_field_name(order))
+        values.append(field.value_to_string(obj))
+    data = json.dumps({"v": values, "r": reverse}, separators=(",", ":"))
+    return urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, model, ordering):
+    """
+    Return the ordering values and the direction of a cursor, or raise
+    InvalidCursor.
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        data = json.loads(urlsafe_b64decode(cursor + padding).decode("utf-8"))
+        values = data["v"]
+        reverse = bool(data["r"])
+        if len(values) != len(ordering):
+            raise ValueError
+        values = [
+            model._meta.get_field(_get_field_name(order)).to_python(value)
+            for order, value in zip(ordering, values)
+            ]
+    except (ValueError, TypeError, KeyError, ValidationError):
+        raise InvalidCursor("Invalid cursor: %r" % cursor)
+    if None in values:
+        raise InvalidCursor("Invalid cursor: %r" % cursor)
+    return values, reverse
+
+
+def _get_keyset_filter(ordering, values, reverse):
+    # (a, b) > (x, y) is written (a > x) OR (a = x AND b > y)
+    keyset_filter = Q()
+    equal = {}
+    for order, value in zip(ordering, values):
+        name = _get_field_name(order)
+        descending = order.startswith("-")
+        if descending != reverse:
+            lookup = "%s__lt" % name
+        else:
+            lookup = "%s__gt" % name
+        keyset_filter |= Q(**equal, **{lookup: value})
+        equal[name] = value
+    return keyset_filter
+
+
+def _reverse_ordering(ordering):
+    return [
+        _get_field_name(order) if order.startswith("-") else "-%s" % order
+        for order in ordering
+        ]
+
+
+class CursorPage(object):
+    """
+    A page of results of the keyset pagination. It can be used like Django's
+    Page in the views, but it has no paginator and no page number.
+    """
+
+    cursor_pagination = True
+
+    def __init__(self, object_list, ordering, has_next, has_previous):
+        self.object_list = object_list
+        self.ordering = ordering
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __repr__(self):
+        return "<CursorPage of %d objects>" % len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if not self._has_next or not self.object_list:
+            return None
+        return encode_cursor(self.object_list[-1], self.ordering)
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous or not self.object_list:
+            return None
+        return encode_cursor(self.object_list[0], self.ordering, reverse=True)
+
+
+def cursor_paginate(queryset, cursor=None, results_per_page=None,
+                    ordering=("-date_active", "-id")):
+    """
+    Return the CursorPage of the queryset starting at the cursor. The
+    queryset is ordered by the ``ordering`` fields.
+
+    :raises InvalidCursor: if the cursor can't be decoded.
+    """
+    try:
+        results_per_page = int(results_per_page)
+    except (ValueError, TypeError):
+        results_per_page = DEFAULT_COUNT
+    if results_per_page < 1:
+        results_per_page = DEFAULT_COUNT
+    reverse = False
+    if cursor:
+        values, reverse = decode_cursor(cursor, queryset.model, ordering)
+        queryset = queryset.filter(
+            _get_keyset_filter(ordering, values, reverse))
+    if reverse:
+        queryset = queryset.order_by(*_reverse_ordering(ordering))
+    else:
+        queryset = queryset.order_by(*ordering)
+    # Fetch one more object to know if there is another page.
+    objects = list(queryset[:results_per_page + 1])
+    has_more = len(objects) > results_per_page
+    objects = objects[:results_per_page]
+    if reverse:
+        objects.reverse()
+        return CursorPage(objects, ordering,
+                          has_next=True, has_previous=has_more)
+    return CursorPage(objects, ordering,
+                      has_next=has_more, has_previous=bool(cursor))
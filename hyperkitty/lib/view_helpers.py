@@ -21,17 +21,22 @@
 #
 
 import datetime
+import re
+from calendar import timegm
 from functools import wraps
 
-from django.http import Http404
+from django.http import (
+    FileResponse, Http404, HttpResponse, StreamingHttpResponse)
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.timezone import utc
 
 from django_mailman3.lib.mailman import get_subscriptions
 
 from hyperkitty.forms import CategoryForm
 from hyperkitty.lib.posting import get_sender
-from hyperkitty.models import MailingList, ThreadCategory
+from hyperkitty.models import MailingList, ThreadCategory, Vote
 
 
 def get_months(mlist):
@@ -80,37 +85,58 @@ def daterange(start_date, end_date):
         yield start_date + datetime.timedelta(n)
 
 
-def get_category_widget(request, current_category=None):
+def set_user_votes(emails, user):
+    """
+    Set the ``myvote`` attribute of the emails to the vote of the user (or
+    None), with a single query.
+
+    The emails can also be search results, their primary key is then a
+    string.
+    """
+    emails = list(emails)
+    votes = {}
+    if user.is_authenticated and emails:
+        for vote in Vote.objects.filter(
+                user=user, email_id__in=[email.pk for email in emails]):
+            votes[str(vote.email_id)] = vote
+    for email in emails:
+        email.myvote = votes.get(str(email.pk))
+
+
+def get_category_widget(request, current_category=None, categories=None):
     """
     Returns the category form and the applicable category object (or None if no
     category is set for this thread).
 
     If current_category is not provided or None, try to deduce it from the POST
     request.
-    """
 
-    categories = [
-        (c.name, c.name.upper())
-        for c in ThreadCategory.objects.all()
+    The categories can be given when they have already been loaded, for
+    example when building the widgets of a list of threads.
+    """
+    if categories is None:
+        categories = list(ThreadCategory.objects.all())
+    if isinstance(current_category, ThreadCategory):
+        current_category = current_category.name
+    choices = [
+        (c.name, c.name.upper()) for c in categories
         ] + [("", "no category")]
     if request.method == "POST":
         category_form = CategoryForm(request.POST)
     else:
         category_form = CategoryForm(
             initial={"category": current_category or ""})
-    category_form["category"].field.choices = categories
+    category_form["category"].field.choices = choices
 
     if request.method == "POST" and category_form.is_valid():
         # is_valid() must be called after the choices have been set
         current_category = category_form.cleaned_data["category"]
 
-    if not current_category:
-        category = None
-    else:
-        try:
-            category = ThreadCategory.objects.get(name=current_category)
-        except ThreadCategory.DoesNotExist:
-            category = None
+    category = None
+    if current_category:
+        for c in categories:
+            if c.name == current_category:
+                category = c
     return category, category_form
 
 
@@ -156,3 +182,108 @@ def get_posting_form(formclass, request, mlist, data=None):
         form.fields['sender'].choices = [
             (a, a) for a in request.user.hyperkitty_profile.addresses]
     return form
+
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+FILE_BLOCK_SIZE = 64 * 1024
+
+
+def _parse_range(range_header, size):
+    """
+    Return the first and last positions (included) of a single byte range,
+    or None if the header is not supported and the whole file must be sent.
+
+    :raises ValueError: if the range is not satisfiable.
+    """
+    match = RANGE_RE.match(range_header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # The suffix of the file.
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    first = int(first)
+    if last:
+        last = min(int(last), size - 1)
+        if last < first:
+            return None
+    else:
+        last = size - 1
+    if first >= size:
+        raise ValueError("Range starts after the end of the file")
+    return first, last
+
+
+def _if_range_passes(request, etag, last_modified):
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Only strong validators can be used.
+        return etag is not None and if_range == etag
+    return (last_modified is not None and
+            parse_http_date_safe(if_range) == last_modified)
+
+
+def _iter_file_range(fileobj, length):
+    try:
+        while length > 0:
+            data = fileobj.read(min(FILE_BLOCK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+
+def file_response(request, fileobj, size, content_type, filename=None,
+                  etag=None, last_modified=None):
+    """
+    Return a response streaming the content of an open file, with support
+    for conditional requests and for a single byte range.
+
+    :param etag: the quoted strong entity tag of the file.
+    :param last_modified: the modification date of the file, as an aware
+        datetime.
+    """
+    if last_modified is not None:
+        last_modified = timegm(last_modified.utctimetuple())
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    byte_range = None
+    if (response is None and "HTTP_RANGE" in request.META
+            and _if_range_passes(request, etag, last_modified)):
+        try:
+            byte_range = _parse_range(request.META["HTTP_RANGE"], size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%d" % size
+    if response is not None:
+        # Not modified, or an error.
+        fileobj.close()
+    elif byte_range is None:
+        response = FileResponse(fileobj, content_type=content_type)
+        response["Content-Length"] = size
+    else:
+        first, last = byte_range
+        fileobj.seek(first)
+        response = StreamingHttpResponse(
+            _iter_file_range(fileobj, last - first + 1),
+            content_type=content_type, status=206)
+        response["Content-Range"] = "bytes %d-%d/%d" % (first, last, size)
+        response["Content-Length"] = last - first + 1
+    response["Accept-Ranges"] = "bytes"
+    if etag is not None:
+        response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    if filename is not None and response.status_code in (200, 206):
+        response["Content-Disposition"] = (
+            'attachment; filename="%s"' % filename)
+    return response
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+"""
+Move the content of the attachments from the database to the attachments
+folder.
+"""
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from hyperkitty.management.utils import setup_logging
+from hyperkitty.models.email import AttachmentBlob
+
+
+class Command(BaseCommand):
+    help = ("Move the content of the attachments stored in the database to "
+            "the HYPERKITTY_ATTACHMENT_FOLDER directory")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int, default=100,
+            help="number of attachments moved in each transaction. The "
+                 "command can be interrupted and run again, the committed "
+                 "batches are not moved again.")
+
+    def handle(self, *args, **options):
+        setup_logging(self, options["verbosity"])
+        if not getattr(settings, "HYPERKITTY_ATTACHMENT_FOLDER", None):
+            raise CommandError(
+                "The HYPERKITTY_ATTACHMENT_FOLDER setting is not set.")
+        # The attachments stored before the deduplicated storage are moved
+        # to the blobs, which are written to the folder.
+        call_command(
+            "hyperkitty_dedupe_attachments",
+            batch_size=options["batch_size"],
+            verbosity=options["verbosity"],
+            stdout=self.stdout, stderr=self.stderr)
+        moved = 0
+        last_id = 0
+        while True:
+            # Only load one content at a time.
+            blob_ids = list(AttachmentBlob.objects.filter(
+                content__isnull=False, id__gt=last_id,
+                ).order_by("id").values_list("id", flat=True)[
+                :options["batch_size"]])
+            if not blob_ids:
+                break
+            with transaction.atomic():
+                for blob_id in blob_ids:
+                    blob = AttachmentBlob.objects.get(id=blob_id)
+                    if blob.move_to_folder():
+                        moved += 1
+            last_id = blob_ids[-1]
+            if options["verbosity"] >= 2:
+                self.stdout.write("%d contents moved" % moved)
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                "%d contents moved to the attachments folder" % moved)
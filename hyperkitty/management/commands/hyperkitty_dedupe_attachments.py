@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+"""
+Move the content of the existing attachments to the deduplicated store.
+"""
+
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from hyperkitty.management.utils import setup_logging
+from hyperkitty.models.email import Attachment, AttachmentBlob
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    try:
+        # Remove the email's folder if it is now empty.
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+class Command(BaseCommand):
+    help = ("Store the content of the existing attachments once for all the "
+            "attachments that share it, and delete the unused contents")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int, default=100,
+            help="number of attachments moved in each transaction. The "
+                 "command can be interrupted and run again, the committed "
+                 "batches are not moved again.")
+
+    def handle(self, *args, **options):
+        setup_logging(self, options["verbosity"])
+        moved = missing = 0
+        last_id = 0
+        while True:
+            attachments = list(Attachment.objects.filter(
+                blob__isnull=True, id__gt=last_id,
+                ).select_related("email__mailinglist").order_by("id")[
+                :options["batch_size"]])
+            if not attachments:
+                break
+            with transaction.atomic():
+                for attachment in attachments:
+                    if self._move(attachment):
+                        moved += 1
+                    else:
+                        missing += 1
+            last_id = attachments[-1].id
+            if options["verbosity"] >= 2:
+                self.stdout.write("%d attachments moved" % moved)
+        deleted = AttachmentBlob.delete_unused()
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                "%d attachments moved, %d distinct contents stored, "
+                "%d unused contents deleted" % (
+                    moved, AttachmentBlob.objects.count(), deleted))
+        if missing:
+            self.stderr.write(
+                "The content of %d attachments could not be found" % missing)
+
+    def _move(self, attachment):
+        old_path = attachment.get_path()
+        try:
+            content = attachment.open_content()
+        except FileNotFoundError:
+            self.stderr.write(
+                "Could not find the content of attachment %s of email %s"
+                % (attachment.counter, attachment.email_id))
+            return False
+        with content:
+            attachment.set_content(content.read())
+        attachment.save(update_fields=["blob", "content", "size"])
+        if old_path is not None:
+            # Keep the file if the batch is rolled back.
+            transaction.on_commit(lambda: _remove_file(old_path))
+        return True
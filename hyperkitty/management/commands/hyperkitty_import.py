@@ -24,57 +24,79 @@
 Import the content of a mbox file into the database.
 """
 
-import mailbox
+import json
+import multiprocessing
 import os
 import re
 from contextlib import suppress
 from datetime import datetime
 from email import message_from_bytes, policy
 from email.utils import make_msgid, unquote
+from io import StringIO
 from math import floor
+from time import monotonic
 from traceback import print_exc
 
 from django.conf import settings
 from django.core.management import call_command
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import (
+    BaseCommand, CommandError, OutputWrapper)
 from django.db import Error as DatabaseError
-from django.db import transaction
+from django.db import connections, transaction
+from django.db.models import Max, Min
 from django.utils.timezone import utc
 
 from dateutil import tz
 from dateutil.parser import parse as parse_date
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from hyperkitty.lib.incoming import DuplicateMessage, add_to_list
+from hyperkitty.lib.analysis import compute_threads_order_and_depth
+from hyperkitty.lib.archives import invalidate_month_archive
+from hyperkitty.lib.incoming import (
+    DuplicateMessage, add_batch_to_list, add_to_list, parse_message)
 from hyperkitty.lib.mailman import sync_with_mailman
+from hyperkitty.lib.mbox import MboxReader
 from hyperkitty.lib.utils import get_message_id
 from hyperkitty.management.utils import setup_logging
-from hyperkitty.models import Email, Thread
+from hyperkitty.models import Email, MailingList
+from hyperkitty.models.stats import get_day, update_daily_stats
 
 
 # Allow all wierd line endings.
 TEXTWRAP_RE = re.compile(r"(\n|\r|\r\n|\n\r)\s*")
 
+# Number of messages sent to a worker process at a time.
+WORKER_CHUNKSIZE = 20
+
+# Batch size used with --workers when --batch-size is not set.
+DEFAULT_BATCH_SIZE = 100
+
+# Without batches, the checkpoint is written every CHECKPOINT_INTERVAL
+# messages or CHECKPOINT_DELAY seconds.
+CHECKPOINT_INTERVAL = 100
+CHECKPOINT_DELAY = 10
+
 
 class ProgressMarker(object):
 
     def __init__(self, verbose, stdout):
         self.verbose = verbose
-        self.total = None
+        self.total = None  # The size of the mbox file, in bytes.
+        self.position = 0
         self.count = 0
         self.count_imported = 0
         self.spinner_seq = ('|', '/', '-', '\\')
         self.stdout = stdout
 
-    def tick(self, msgid=None):
+    def tick(self, msgid=None, position=None):
+        if position is not None:
+            self.position = position
         if self.total:
-            msg = "%d%%" % floor(100.0 * self.count / self.total)
+            msg = "%d%%" % floor(100.0 * self.position / self.total)
         else:
             msg = self.spinner_seq[self.count % len(self.spinner_seq)]
         if self.verbose:
             if self.total:
-                self.stdout.write(
-                    "%s (%d/%d, %s)" % (msgid, self.count, self.total, msg))
+                self.stdout.write("%s (%d, %s)" % (msgid, self.count, msg))
             else:
                 self.stdout.write("%s (%d)" % (msgid, self.count))
         else:
@@ -92,17 +114,77 @@ class ProgressMarker(object):
             self.stdout.flush()
 
 
+class Checkpoint(object):
+    """
+    Record how far each mbox file has been imported, in a JSON file.
+
+    For each mbox file, the checkpoint stores the offset of the end of the
+    last message that was committed to the database, and the number of
+    messages read up to there.
+    """
+
+    def __init__(self, path, list_address):
+        self.path = path
+        self.list_address = list_address
+        self.mboxes = {}
+
+    def load(self):
+        try:
+            with open(self.path) as checkpoint_file:
+                data = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            raise CommandError(
+                "Can't read the checkpoint file %s: %s" % (self.path, e))
+        if data.get("list") != self.list_address:
+            raise CommandError(
+                "The checkpoint file %s is for the list %s."
+                % (self.path, data.get("list")))
+        self.mboxes = data.get("mbox", {})
+
+    def get(self, mbfile):
+        """
+        :returns: a tuple with the offset to resume reading the mbox file
+            from and the number of messages read so far.
+        """
+        mbox = self.mboxes.get(os.path.abspath(mbfile), {})
+        return mbox.get("end", 0), mbox.get("count", 0)
+
+    def save(self, mbfile, end, count):
+        self.mboxes[os.path.abspath(mbfile)] = {"end": end, "count": count}
+        # Write to a temporary file first, an interruption must not leave a
+        # truncated checkpoint behind.
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump({"list": self.list_address, "mbox": self.mboxes},
+                      checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+
 class DbImporter(object):
     """
     Import email messages into the HyperKitty database using its API.
     """
 
-    def __init__(self, list_address, options, stdout, stderr):
+    def __init__(self, list_address, options, stdout, stderr,
+                 checkpoint=None):
         self.list_address = list_address
         self.verbose = options["verbosity"] >= 2
         self.since = options.get("since")
         self.until = options.get("until")
+        self.workers = options.get("workers") or 1
+        self.batch_size = options.get("batch_size")
+        if self.workers > 1 and not self.batch_size:
+            self.batch_size = DEFAULT_BATCH_SIZE
+        self.batch = []
+        self.checkpoint = checkpoint
+        self._mbfile = None
+        self._end = 0  # End offset of the last message read.
+        self._checkpoint_count = 0
+        self._checkpoint_time = 0
         self.impacted_thread_ids = set()
+        self.impacted_days = set()
         self.stdout = stdout
         self.stderr = stderr
 
@@ -164,106 +246,264 @@ class DbImporter(object):
 
         return date
 
+    def _prepare_message(self, msg_raw, unixfrom):
+        """
+        Convert a raw message from the mbox file to an
+        ``email.message.EmailMessage`` and fix its headers.
+
+        :returns: the message, or None if it must not be imported.
+        """
+        try:
+            message = message_from_bytes(msg_raw, policy=policy.default)
+        except UnicodeError as e:
+            self.stderr.write('Failed to convert {} to '
+                              'email.message.Message\n    {}'.format(
+                               unquote(message_from_bytes(msg_raw)[
+                                   "Message-Id"]), e))
+            return None
+        # Fix missing and wierd Date: headers.
+        date = (self._get_date(message, "date") or
+                self._get_date(message, "resent-date"))
+        if unixfrom and not date:
+            date = " ".join(unixfrom.split()[1:])
+
+        if date:
+            # Make sure this date can be parsed before setting it as as the
+            # header. If not, a TypeError is raised and we just keep the
+            # old Header.
+            with suppress(TypeError):
+                del message['Date']
+                message['Date'] = date
+
+        if self._is_too_old(message):
+            return None
+        if self._is_too_young(message):
+            return None
+        # Un-wrap the subject line if necessary
+        if message["subject"]:
+            message.replace_header(
+                "subject", TEXTWRAP_RE.sub(" ", message["subject"]))
+        if unixfrom:
+            message.set_unixfrom(unixfrom)
+        if message['message-id'] is None:
+            message['Message-ID'] = make_msgid('generated')
+        return message
+
     def from_mbox(self, mbfile):
         """
         Insert all the emails contained in an mbox file into the database.
 
-        :arg mbfile: a mailbox file
+        :arg mbfile: a mailbox file, optionally gzip-compressed
         """
-        mbox = mailbox.mbox(mbfile)
         progress_marker = ProgressMarker(self.verbose, self.stdout)
-        if not self.since:
-            progress_marker.total = len(mbox)
-        for msg in mbox:
-            # FIXME: this converts mailbox.mboxMessage to
-            # email.message.EmailMessage
-            msg_raw = msg.as_bytes(unixfrom=False)
-            unixfrom = msg.get_from()
-            try:
-                message = message_from_bytes(msg_raw, policy=policy.default)
-            except UnicodeError as e:
-                self.stderr.write('Failed to convert {} to '
-                                  'email.message.Message\n    {}'.format(
-                                   unquote(msg["Message-Id"]), e))
-                continue
-            # Fix missing and wierd Date: headers.
-            date = (self._get_date(message, "date") or
-                    self._get_date(message, "resent-date"))
-            if unixfrom and not date:
-                date = " ".join(unixfrom.split()[1:])
-
-            if date:
-                # Make sure this date can be parsed before setting it as as the
-                # header. If not, a TypeError is raised and we just keep the
-                # old Header.
-                with suppress(TypeError):
-                    del message['Date']
-                    message['Date'] = date
-
-            if self._is_too_old(message):
+        start = 0
+        if self.checkpoint is not None:
+            start, progress_marker.count = self.checkpoint.get(mbfile)
+            if start and self.verbose:
+                self.stdout.write(
+                    "Resuming after %d messages" % progress_marker.count)
+        self._mbfile = mbfile
+        self._end = start
+        self._checkpoint_count = progress_marker.count
+        self._checkpoint_time = monotonic()
+        with MboxReader(mbfile, start) as mbox:
+            progress_marker.total = mbox.size
+            if self.workers > 1:
+                self._from_raw_messages_parallel(mbox, progress_marker)
+            else:
+                self._from_raw_messages(mbox, progress_marker)
+        # self.store.search_index.flush() # Now commit to the search index
+        progress_marker.finish()
+
+    def _from_raw_messages_parallel(self, raw_messages, progress_marker):
+        # The messages are converted and scrubbed by the worker processes,
+        # and stored in order by this process, to keep the threading logic
+        # intact.
+        # The forked workers would inherit the socket of this process's
+        # database connections, close them first. They are opened again
+        # when the emails are stored. A transaction can't be interrupted
+        # though, and its connection is kept.
+        for connection in connections.all():
+            if not connection.in_atomic_block:
+                connection.close()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(self.workers, initializer=_init_worker,
+                          initargs=(self.since, self.until,
+                                    self.verbose)) as pool:
+            results = pool.imap(
+                _parse_in_worker, raw_messages, chunksize=WORKER_CHUNKSIZE)
+            for raw, msgid, parsed, log in results:
+                self._end = raw.end
+                if log:
+                    self.stderr.write(log, ending="")
+                if msgid is None:
+                    continue
+                progress_marker.tick(msgid, raw.position)
+                if parsed is None:
+                    continue
+                self.batch.append(parsed)
+                if len(self.batch) >= self.batch_size:
+                    self._flush_batch(progress_marker)
+        self._flush_batch(progress_marker)
+
+    def _from_raw_messages(self, raw_messages, progress_marker):
+        for raw in raw_messages:
+            self._end = raw.end
+            message = self._prepare_message(raw.content, raw.unixfrom)
+            if message is None:
                 continue
-            if self._is_too_young(message):
+            progress_marker.tick(message["Message-Id"], raw.position)
+            if self.batch_size:
+                parsed = self._parse_message(message)
+                if parsed is not None:
+                    self.batch.append(parsed)
+                if len(self.batch) >= self.batch_size:
+                    self._flush_batch(progress_marker)
                 continue
-            progress_marker.tick(message["Message-Id"])
-            # Un-wrap the subject line if necessary
-            if message["subject"]:
-                message.replace_header(
-                    "subject", TEXTWRAP_RE.sub(" ", message["subject"]))
-            if unixfrom:
-                message.set_unixfrom(unixfrom)
-            if message['message-id'] is None:
-                message['Message-ID'] = make_msgid('generated')
-            # Now insert the message
+            self._add_message(message, progress_marker)
+            # The messages after the checkpoint are read again when
+            # resuming, and skipped as duplicates.
+            self._save_checkpoint(progress_marker, throttle=True)
+        self._flush_batch(progress_marker)
+
+    def _add_message(self, message, progress_marker):
+        # Now insert the message
+        try:
+            with transaction.atomic():
+                add_to_list(self.list_address, message)
+        except DuplicateMessage as e:
+            if self.verbose:
+                self.stderr.write(
+                    "Duplicate email with message-id '%s'" % e.args[0])
+            return
+        except (LookupError, UnicodeError, ValueError) as e:
+            self.stderr.write("Failed adding message %s: %s"
+                              % (message.get("Message-ID"), e))
+            if len(e.args) == 2:
+                try:
+                    self.stderr.write(
+                        "%s from %s about %s"
+                        % (e.args[0], e.args[1].get("From"),
+                           e.args[1].get("Subject")))
+                except UnicodeDecodeError:
+                    pass
+            # Don't reraise the exception
+            return
+        except DatabaseError:
             try:
-                with transaction.atomic():
-                    add_to_list(self.list_address, message)
-            except DuplicateMessage as e:
+                print_exc(file=self.stderr)
+            except UnicodeError:
+                pass
+            self.stderr.write(
+                "Message %s failed to import, skipping"
+                % unquote(message["Message-Id"]))
+            return
+        except Exception as e:
+            # In case of *any* exception, log and continue to import the
+            # rest of the archive.
+            self.stderr.write(
+                "Message {} failed to import, skipping\n    {}".format(
+                    unquote(message["Message-ID"]), e))
+            return
+        email = Email.objects.get(
+            mailinglist__name=self.list_address,
+            message_id=get_message_id(message))
+        # # Commit every time to be able to rollback on error
+        # if not transaction.get_autocommit():
+        #     transaction.commit()
+        # Store the list of impacted threads to be able to compute the
+        # thread_order and thread_depth values
+        self.impacted_thread_ids.add(email.thread_id)
+        self.impacted_days.add(get_day(email.date))
+        progress_marker.count_imported += 1
+
+    def _parse_message(self, message):
+        try:
+            return parse_message(message)
+        except (LookupError, UnicodeError, ValueError) as e:
+            self.stderr.write("Failed adding message %s: %s"
+                              % (message.get("Message-ID"), e))
+        except Exception as e:
+            self.stderr.write(
+                "Message {} failed to import, skipping\n    {}".format(
+                    unquote(message["Message-ID"]), e))
+
+    def _flush_batch(self, progress_marker):
+        """
+        Insert the pending batch of messages into the database.
+        """
+        if not self.batch:
+            self._save_checkpoint(progress_marker)
+            return
+        emails, failures = add_batch_to_list(self.list_address, self.batch)
+        self.batch = []
+        for parsed, e in failures:
+            if isinstance(e, DuplicateMessage):
                 if self.verbose:
                     self.stderr.write(
                         "Duplicate email with message-id '%s'" % e.args[0])
                 continue
-            except (LookupError, UnicodeError, ValueError) as e:
-                self.stderr.write("Failed adding message %s: %s"
-                                  % (message.get("Message-ID"), e))
-                if len(e.args) == 2:
-                    try:
-                        self.stderr.write(
-                            "%s from %s about %s"
-                            % (e.args[0], e.args[1].get("From"),
-                               e.args[1].get("Subject")))
-                    except UnicodeDecodeError:
-                        pass
-                # Don't reraise the exception
-                continue
-            except DatabaseError:
-                try:
-                    print_exc(file=self.stderr)
-                except UnicodeError:
-                    pass
-                self.stderr.write(
-                    "Message %s failed to import, skipping"
-                    % unquote(message["Message-Id"]))
-                continue
-            except Exception as e:
-                # In case of *any* exception, log and continue to import the
-                # rest of the archive.
-                self.stderr.write(
-                    "Message {} failed to import, skipping\n    {}".format(
-                        unquote(message["Message-ID"]), e))
-                continue
-            email = Email.objects.get(
-                mailinglist__name=self.list_address,
-                message_id=get_message_id(message))
-            # # Commit every time to be able to rollback on error
-            # if not transaction.get_autocommit():
-            #     transaction.commit()
-            # Store the list of impacted threads to be able to compute the
-            # thread_order and thread_depth values
+            self.stderr.write(
+                "Message {} failed to import, skipping\n    {}".format(
+                    parsed.email.message_id, e))
+        for email in emails:
             self.impacted_thread_ids.add(email.thread_id)
-            progress_marker.count_imported += 1
-        # self.store.search_index.flush() # Now commit to the search index
-        progress_marker.finish()
-        mbox.close()
+            self.impacted_days.add(get_day(email.date))
+        progress_marker.count_imported += len(emails)
+        self._save_checkpoint(progress_marker)
+
+    def _save_checkpoint(self, progress_marker, throttle=False):
+        """
+        Record that the messages read so far are in the database.
+
+        With ``throttle``, the checkpoint is only written every
+        ``CHECKPOINT_INTERVAL`` messages or ``CHECKPOINT_DELAY`` seconds.
+        """
+        if self.checkpoint is None:
+            return
+        if (throttle and
+                progress_marker.count - self._checkpoint_count
+                < CHECKPOINT_INTERVAL and
+                monotonic() - self._checkpoint_time < CHECKPOINT_DELAY):
+            return
+        self.checkpoint.save(self._mbfile, self._end, progress_marker.count)
+        self._checkpoint_count = progress_marker.count
+        self._checkpoint_time = monotonic()
+
+
+# Worker processes for the --workers switch.
+
+_worker_importer = None
+_worker_log = StringIO()
+
+
+def _init_worker(since, until, verbose):
+    global _worker_importer
+    options = {
+        "verbosity": 2 if verbose else 1, "since": since, "until": until}
+    _worker_importer = DbImporter(
+        None, options, None, OutputWrapper(_worker_log))
+
+
+def _parse_in_worker(raw):
+    """
+    Convert and scrub a message in a worker process.
+
+    :returns: a tuple with the ``RawMessage`` stripped of its content, the
+        Message-ID header (None if the message must not be imported), the
+        ``ParsedMessage`` instance (None on failure) and the errors that were
+        logged.
+    """
+    _worker_log.seek(0)
+    _worker_log.truncate()
+    message = _worker_importer._prepare_message(raw.content, raw.unixfrom)
+    if message is None:
+        msgid = parsed = None
+    else:
+        msgid = message["Message-Id"]
+        parsed = _worker_importer._parse_message(message)
+    return (raw._replace(content=None), msgid, parsed,
+            _worker_log.getvalue())
 
 
 class Command(BaseCommand):
@@ -296,6 +536,26 @@ class Command(BaseCommand):
             '--ignore-mtime',
             action='store_true', default=False,
             help="do not check mbox mtimes (slower)")
+        parser.add_argument(
+            '--batch-size',
+            type=int, default=None,
+            help="insert the emails by batches of this size, using bulk "
+                 "queries (much faster, recommended for large archives)")
+        parser.add_argument(
+            '--workers',
+            type=int, default=1,
+            help="number of processes used to parse the emails. The emails "
+                 "are inserted by batches (see --batch-size) in the main "
+                 "process.")
+        parser.add_argument(
+            '--checkpoint',
+            help="record the progress of the import in this file, to be "
+                 "able to resume it with --resume if it is interrupted")
+        parser.add_argument(
+            '--resume',
+            action='store_true', default=False,
+            help="resume the import where the checkpoint file says it "
+                 "stopped (requires --checkpoint)")
 
     def _check_options(self, options):
         if not options.get("list_address"):
@@ -327,6 +587,14 @@ class Command(BaseCommand):
                         tzinfo=tz.tzlocal())
             except ValueError as e:
                 raise CommandError("invalid value for '--until': %s" % e)
+        if options.get("batch_size") is not None \
+                and options["batch_size"] < 1:
+            raise CommandError("The batch size must be a positive integer.")
+        if options.get("workers") is not None and options["workers"] < 1:
+            raise CommandError(
+                "The number of workers must be a positive integer.")
+        if options.get("resume") and not options.get("checkpoint"):
+            raise CommandError("The --resume switch requires --checkpoint.")
 
     def handle(self, *args, **options):
         self._check_options(options)
@@ -339,11 +607,18 @@ class Command(BaseCommand):
         #     != "django.db.backends.sqlite3":
         #     transaction.set_autocommit(False)
         settings.HYPERKITTY_BATCH_MODE = True
-        # Only import emails newer than the latest email in the DB
+        checkpoint = None
+        if options.get("checkpoint"):
+            checkpoint = Checkpoint(options["checkpoint"], list_address)
+            if options.get("resume"):
+                checkpoint.load()
+        # Only import emails newer than the latest email in the DB, unless
+        # the checkpoint says where to start.
         latest_email_date = Email.objects.filter(
                 mailinglist__name=list_address
             ).values("date").order_by("-date").first()
-        if latest_email_date and not options["since"]:
+        if latest_email_date and not options["since"] \
+                and not options.get("resume"):
             options["since"] = latest_email_date["date"]
         if options["since"] and options["verbosity"] >= 2:
             self.stdout.write(
@@ -351,7 +626,23 @@ class Command(BaseCommand):
         if options["until"] and options["verbosity"] >= 2:
             self.stdout.write(
                 "Only emails before %s will be imported" % options["until"])
-        importer = DbImporter(list_address, options, self.stdout, self.stderr)
+        # The batch modes only create the list when storing the first batch,
+        # make sure it exists for the cache warm up.
+        MailingList.objects.get_or_create(name=list_address)
+        importer = DbImporter(list_address, options, self.stdout, self.stderr,
+                              checkpoint)
+        if options.get("resume"):
+            # The interrupted import did not get to compute the thread
+            # structure.
+            importer.impacted_thread_ids.update(Email.objects.filter(
+                mailinglist__name=list_address, thread_order__isnull=True,
+                ).values_list("thread_id", flat=True).distinct())
+            # Nor the daily statistics: cover all the list's emails.
+            importer.impacted_days.update(
+                get_day(date) for date in Email.objects.filter(
+                    mailinglist__name=list_address).aggregate(
+                    first=Min("date"), last=Max("date")).values()
+                if date is not None)
         # disable mailman client for now
         for mbfile in options["mbox"]:
             if options["verbosity"] >= 1:
@@ -373,16 +664,24 @@ class Command(BaseCommand):
                                   % total_in_list)
         if options["verbosity"] >= 1:
             self.stdout.write("Computing thread structure")
-        # Work on batches of thread ids to avoid creating a huge SQL request
-        # (it's an IN statement)
-        thread_ids = list(importer.impacted_thread_ids)
-        while thread_ids:
-            thread_ids_batch = thread_ids[:100]
-            thread_ids = thread_ids[100:]
-            for thread in Thread.objects.filter(id__in=thread_ids_batch):
-                compute_thread_order_and_depth(thread)
+        compute_threads_order_and_depth(importer.impacted_thread_ids)
+        mlist = MailingList.objects.get(name=list_address)
+        if importer.impacted_days:
+            if options["verbosity"] >= 1:
+                self.stdout.write("Computing daily statistics")
+            first_day = min(importer.impacted_days)
+            last_day = max(importer.impacted_days)
+            update_daily_stats(mlist, first_day, last_day)
+            # The monthly mbox archives of this period are outdated.
+            year, month = first_day.year, first_day.month
+            while (year, month) <= (last_day.year, last_day.month):
+                invalidate_month_archive(mlist, year, month)
+                year, month = divmod(year * 12 + month, 12)
+                month += 1
         if options["verbosity"] >= 1:
             self.stdout.write("Warming up cache")
+        # The recent values were not updated while importing.
+        mlist.rebuild_recent_cache()
         call_command("hyperkitty_warm_up_cache", list_address)
         if options["verbosity"] >= 1:
             self.stdout.write(
@@ -30,6 +30,7 @@ from django.utils.timezone import now
 
 from hyperkitty.management.utils import setup_logging
 from hyperkitty.models import MailingList
+from hyperkitty.models.common import CachedValue
 
 
 class Command(BaseCommand):
@@ -74,8 +75,4 @@ class Command(BaseCommand):
                 self.warm_up_thread(thread)
 
     def warm_up_thread(self, thread):
-        for cached_value in thread.cached_values.values():
-            cached_value.warm_up()
-        for email in thread.emails.all():
-            for cached_value in email.cached_values.values():
-                cached_value.warm_up()
+        CachedValue.get_many(thread.emails.all(), ["votes"])
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.0.14 on 2020-07-20 10:12
+
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def compute_thread_stats(apps, schema_editor):
+    # Use the historical models, and a fixed number of queries to load the
+    # counts for all threads.
+    Thread = apps.get_model("hyperkitty", "Thread")
+    Email = apps.get_model("hyperkitty", "Email")
+    Vote = apps.get_model("hyperkitty", "Vote")
+    emails_counts = dict(Email.objects.order_by().values_list(
+        "thread_id").annotate(models.Count("id")))
+    participants_counts = Counter(
+        thread_id for thread_id, _sender, _name in
+        Email.objects.order_by().values_list(
+            "thread_id", "sender_id", "sender_name").distinct().iterator())
+    votes = {
+        thread_id: (likes, dislikes)
+        for thread_id, likes, dislikes in Vote.objects.order_by().values_list(
+            "email__thread_id").annotate(
+            likes=models.Count("id", filter=models.Q(value=1)),
+            dislikes=models.Count("id", filter=models.Q(value=-1)))
+        }
+    threads = []
+    for thread_id in Thread.objects.values_list("id", flat=True).iterator():
+        likes, dislikes = votes.get(thread_id, (0, 0))
+        threads.append(Thread(
+            id=thread_id,
+            emails_count=emails_counts.get(thread_id, 0),
+            participants_count=participants_counts[thread_id],
+            votes_likes=likes, votes_dislikes=dislikes))
+    Thread.objects.bulk_update(
+        threads, ["emails_count", "participants_count", "votes_likes",
+                  "votes_dislikes"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0022_add_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='emails_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='participants_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='votes_dislikes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='votes_likes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(compute_thread_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.0.14 on 2020-07-22 09:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.timezone import utc
+
+
+def compute_daily_stats(apps, schema_editor):
+    # Use the historical models, and read the emails of each list only once.
+    MailingList = apps.get_model("hyperkitty", "MailingList")
+    Email = apps.get_model("hyperkitty", "Email")
+    DailyStats = apps.get_model("hyperkitty", "MailingListDailyStats")
+    DailyPoster = apps.get_model("hyperkitty", "MailingListDailyPoster")
+    for mlist_id in MailingList.objects.values_list("id", flat=True):
+        stats = {}
+        posters = {}
+        emails = Email.objects.filter(mailinglist_id=mlist_id).order_by(
+            "date").values_list("date", "sender_id", "sender_name", "parent_id")
+        for date, sender_id, sender_name, parent_id in emails.iterator():
+            day = date.astimezone(utc).date()
+            day_stats = stats.setdefault(day, DailyStats(
+                mailinglist_id=mlist_id, date=day))
+            day_stats.emails_count += 1
+            if parent_id is None:
+                day_stats.threads_count += 1
+            poster = posters.get((day, sender_id))
+            if poster is None:
+                day_stats.participants_count += 1
+                poster = posters[(day, sender_id)] = DailyPoster(
+                    mailinglist_id=mlist_id, date=day, sender_id=sender_id)
+            poster.emails_count += 1
+            poster.sender_name = sender_name
+        DailyStats.objects.bulk_create(stats.values(), batch_size=1000)
+        DailyPoster.objects.bulk_create(posters.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0023_thread_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingListDailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('emails_count', models.IntegerField(default=0)),
+                ('threads_count', models.IntegerField(default=0)),
+                ('participants_count', models.IntegerField(default=0)),
+                ('mailinglist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='hyperkitty.MailingList')),
+            ],
+            options={
+                'unique_together': {('mailinglist', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='MailingListDailyPoster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('sender_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('emails_count', models.IntegerField(default=0)),
+                ('mailinglist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_posters', to='hyperkitty.MailingList')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_posts', to='hyperkitty.Sender')),
+            ],
+            options={
+                'unique_together': {('mailinglist', 'date', 'sender')},
+            },
+        ),
+        migrations.RunPython(compute_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.0.14 on 2020-07-24 10:12
+
+import datetime
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.utils.timezone import now, utc
+
+
+def compute_activity(apps, schema_editor):
+    # Use the historical models, with the same period as
+    # MailingList.get_recent_dates().
+    MailingList = apps.get_model("hyperkitty", "MailingList")
+    Thread = apps.get_model("hyperkitty", "Thread")
+    DailyPoster = apps.get_model("hyperkitty", "MailingListDailyPoster")
+    Activity = apps.get_model("hyperkitty", "MailingListActivity")
+    end_date = now() + datetime.timedelta(days=1)
+    begin_date = end_date - datetime.timedelta(days=32)
+    first_day = begin_date.astimezone(utc).date()
+    last_day = (end_date - datetime.timedelta(microseconds=1)).astimezone(
+        utc).date()
+    activities = []
+    for mlist_id in MailingList.objects.values_list("id", flat=True):
+        threads_count = Thread.objects.filter(
+            mailinglist_id=mlist_id,
+            starting_email__date__lt=end_date,
+            date_active__gte=begin_date,
+            ).count()
+        participants_count = DailyPoster.objects.filter(
+            mailinglist_id=mlist_id,
+            date__gte=first_day, date__lte=last_day,
+            ).values("sender_id").distinct().count()
+        activities.append(Activity(
+            mailinglist_id=mlist_id,
+            recent_threads_count=threads_count,
+            recent_participants_count=participants_count,
+            ))
+    Activity.objects.bulk_create(activities, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0024_daily_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingListActivity',
+            fields=[
+                ('mailinglist', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='activity', serialize=False, to='hyperkitty.MailingList')),
+                ('recent_threads_count', models.IntegerField(default=0)),
+                ('recent_participants_count', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(compute_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 3.0.14 on 2020-07-27 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0025_mailinglist_activity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['mailinglist', 'archived_date', 'id'], name='hyperkitty__mailing_b84061_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['mailinglist', 'date_active', 'id'], name='hyperkitty__mailing_f03036_idx'),
+        ),
+    ]
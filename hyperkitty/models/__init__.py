@@ -23,11 +23,13 @@
 # flake8:noqa
 
 from .category import ThreadCategory
-from .email import Attachment, Email
+from .email import Attachment, AttachmentBlob, Email
 from .favorite import Favorite
 from .mailinglist import ArchivePolicy, MailingList
 from .profile import Profile
 from .sender import Sender
+from .stats import (
+    MailingListActivity, MailingListDailyPoster, MailingListDailyStats)
 from .tag import Tag, Tagging
 from .thread import LastView, Thread
 from .vote import Vote
@@ -19,6 +19,9 @@
 #
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
+import time
+from collections import defaultdict
+
 from django.core.cache import cache
 from django.db import models
 
@@ -27,12 +30,33 @@ class CachedValue(object):
 
     cache_key = None
     timeout = None
+    # When set, the value is stale after this number of seconds: it is still
+    # returned, but a single worker rebuilds it in the background.
+    soft_timeout = None
+    # How long a worker may hold the rebuild or refresh lock, in seconds.
+    lock_timeout = 60
+    # How long to wait for the value when another worker is building it.
+    lock_wait = 5
+    # Value loaded by get_many(), returned by get_or_set() without querying
+    # the cache again.
+    _prefetched = None
 
     def _get_cache_key(self, *args, **kwargs):
         if self.cache_key is not None:
             return self.cache_key
         raise NotImplementedError
 
+    def _get_fresh_key(self, *args, **kwargs):
+        return "%s:fresh" % self._get_cache_key(*args, **kwargs)
+
+    def _get_lock_key(self, *args, **kwargs):
+        return "%s:lock" % self._get_cache_key(*args, **kwargs)
+
+    def _get_refresh_key(self, *args, **kwargs):
+        # Not the rebuild lock: a background refresh may wait in the queue
+        # for a while, a missing value must not wait for it.
+        return "%s:refresh" % self._get_cache_key(*args, **kwargs)
+
     def get_value(self, *args, **kwargs):
         """Get the value that must be cached."""
         raise NotImplementedError
@@ -44,20 +68,111 @@ class CachedValue(object):
 
     def rebuild(self, *args, **kwargs):
         """Overwrite the value in the cache."""
+        self._prefetched = None
         value = self.get_value(*args, **kwargs)
         cache.set(self._get_cache_key(*args, **kwargs), value, self.timeout)
+        if self.soft_timeout is not None:
+            cache.set(self._get_fresh_key(*args, **kwargs), True,
+                      self.soft_timeout)
         return value
 
+    def schedule_rebuild(self, *args, **kwargs):
+        """
+        Rebuild a stale value. The caller holds the refresh lock, which must
+        be released when done.
+        """
+        try:
+            self.rebuild(*args, **kwargs)
+        finally:
+            cache.delete(self._get_refresh_key(*args, **kwargs))
+
+    def _refresh_if_stale(self, fresh, *args, **kwargs):
+        if self.soft_timeout is None or fresh is not None:
+            return
+        # Only one worker schedules the rebuild.
+        if cache.add(self._get_refresh_key(*args, **kwargs), True,
+                     self.lock_timeout):
+            self.schedule_rebuild(*args, **kwargs)
+
+    def _rebuild_with_lock(self, *args, **kwargs):
+        # Only one worker rebuilds a missing value, the others wait for it.
+        cache_key = self._get_cache_key(*args, **kwargs)
+        lock_key = self._get_lock_key(*args, **kwargs)
+        deadline = time.monotonic() + self.lock_wait
+        while not cache.add(lock_key, True, self.lock_timeout):
+            if time.monotonic() >= deadline:
+                # Don't wait forever on a worker that may have died.
+                return self.rebuild(*args, **kwargs)
+            time.sleep(0.1)
+            value = cache.get(cache_key)
+            if value is not None:
+                return value
+        try:
+            return self.rebuild(*args, **kwargs)
+        finally:
+            cache.delete(lock_key)
+
     def get_or_set(self, *args, **kwargs):
         """Return the cached value, rebuilding the cache if necessary."""
-        value = cache.get(self._get_cache_key(*args, **kwargs))
+        if self._prefetched is not None and not args and not kwargs:
+            return self._prefetched
+        cache_key = self._get_cache_key(*args, **kwargs)
+        if self.soft_timeout is None:
+            value, fresh = cache.get(cache_key), None
+        else:
+            fresh_key = self._get_fresh_key(*args, **kwargs)
+            found = cache.get_many([cache_key, fresh_key])
+            value, fresh = found.get(cache_key), found.get(fresh_key)
         if value is None:
-            value = self.rebuild(*args, **kwargs)
+            return self._rebuild_with_lock(*args, **kwargs)
+        self._refresh_if_stale(fresh, *args, **kwargs)
         return value
 
     def __call__(self, *args, **kwargs):
         return self.get_or_set(*args, **kwargs)
 
+    @staticmethod
+    def get_many(instances, keys):
+        """
+        Load many cached values at once.
+
+        The values are fetched from the cache with a single query, and only
+        the missing ones are computed and stored. Afterwards, reading them
+        from the instances does not query the cache again.
+
+        :arg instances: model instances with a ``cached_values`` dict.
+        :arg keys: the keys in ``cached_values`` to load. Values that take
+            arguments are not supported.
+        """
+        cached_values = {}
+        cache_keys = []
+        for instance in instances:
+            for key in keys:
+                cached_value = instance.cached_values[key]
+                cache_key = cached_value._get_cache_key()
+                cached_values[cache_key] = cached_value
+                cache_keys.append(cache_key)
+                if cached_value.soft_timeout is not None:
+                    cache_keys.append(cached_value._get_fresh_key())
+        if not cached_values:
+            return
+        found = cache.get_many(cache_keys)
+        missing = defaultdict(dict)
+        for cache_key, cached_value in cached_values.items():
+            value = found.get(cache_key)
+            if value is None:
+                value = cached_value.get_value()
+                missing[cached_value.timeout][cache_key] = value
+                if cached_value.soft_timeout is not None:
+                    missing[cached_value.soft_timeout][
+                        cached_value._get_fresh_key()] = True
+            elif cached_value.soft_timeout is not None:
+                cached_value._refresh_if_stale(
+                    found.get(cached_value._get_fresh_key()))
+            cached_value._prefetched = value
+        for timeout, values in missing.items():
+            cache.set_many(values, timeout)
+
 
 class ModelCachedValue(CachedValue):
 
@@ -72,40 +187,44 @@ class ModelCachedValue(CachedValue):
                 self.cache_key)
         raise NotImplementedError
 
+    def schedule_rebuild(self, *args, **kwargs):
+        """Rebuild a stale value in a background task."""
+        if args or kwargs:
+            return super(ModelCachedValue, self).schedule_rebuild(
+                *args, **kwargs)
+        from hyperkitty.tasks import rebuild_cached_value  # circular import
+        rebuild_cached_value(
+            self.instance._meta.label, self.instance.pk, self.cache_key)
+
+
+def make_votes_dict(likes, dislikes):
+    """Describe the votes on an email or a thread."""
+    # XXX: use an Enum?
+    if likes - dislikes >= 10:
+        status = "likealot"
+    elif likes - dislikes > 0:
+        status = "like"
+    else:
+        status = "neutral"
+    return {"likes": likes, "dislikes": dislikes, "status": status}
+
 
 class VotesCachedValue(ModelCachedValue):
 
     cache_key = "votes"
 
     def get_value(self):
-        from .email import Email
-        from .thread import Thread
         from .vote import Vote
-        if isinstance(self.instance, Thread):
-            filters = {"email__thread_id": self.instance.id}
-        elif isinstance(self.instance, Email):
-            filters = {"email_id": self.instance.id}
-        else:
-            ValueError("The 'votes' cached value only accepts 'Email' "
-                       "and 'Thread' instance")
-        votes = list(Vote.objects.filter(**filters).values_list(
-            "value", flat=True))
+        votes = list(Vote.objects.filter(
+            email_id=self.instance.id).values_list("value", flat=True))
         return (
                 len([v for v in votes if v == 1]),
                 len([v for v in votes if v == -1]),
             )
 
     def get_or_set(self):
-        votes = super(VotesCachedValue, self).get_or_set()
-        likes, dislikes = votes
-        # XXX: use an Enum?
-        if likes - dislikes >= 10:
-            status = "likealot"
-        elif likes - dislikes > 0:
-            status = "like"
-        else:
-            status = "neutral"
-        return {"likes": likes, "dislikes": dislikes, "status": status}
+        likes, dislikes = super(VotesCachedValue, self).get_or_set()
+        return make_votes_dict(likes, dislikes)
 
 
 class Search(models.Lookup):
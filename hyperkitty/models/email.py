@@ -20,20 +20,24 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+import hashlib
+import io
 import logging
 import os
 import re
+import tempfile
 from email.message import EmailMessage
 from email.utils import formataddr
 
 from django.conf import settings
-from django.db import IntegrityError, models
+from django.db import IntegrityError, models, transaction
 from django.utils.timezone import get_fixed_timezone, now
 
 from hyperkitty.lib.analysis import compute_thread_order_and_depth
 from .common import VotesCachedValue
 from .mailinglist import MailingList
-from .thread import Thread
+from .stats import get_day, update_daily_stats
+from .thread import Thread, update_thread_counts
 from .vote import Vote
 
 
@@ -85,6 +89,9 @@ class Email(models.Model):
 
     class Meta:
         unique_together = ("mailinglist", "message_id")
+        # For the keyset pagination of the emails of a list.
+        indexes = [
+            models.Index(fields=["mailinglist", "archived_date", "id"])]
 
     def get_votes(self):
         return self.cached_values["votes"]()
@@ -133,15 +140,24 @@ class Email(models.Model):
             parent.save(update_fields=["parent_id"])
             # do it after setting the new parent_id to avoid having two
             # parent_ids set to None at the same time (IntegrityError)
+        if old_parent_id is None:
+            # The thread starters have changed.
+            days = set([get_day(self.date)])
+            if parent in subthread:
+                days.add(get_day(parent.date))
+            for day in days:
+                update_daily_stats(self.mailinglist, day)
         if self.thread_id != parent.thread_id:
             # we changed the thread, reattach the subthread
             former_thread = self.thread
             for child in subthread:
                 child.thread = parent.thread
                 child.save(update_fields=["thread_id"])
+                self.mailinglist.on_month_changed(child.date)
                 if child.date > parent.thread.date_active:
                     parent.thread.date_active = child.date
             parent.thread.save()
+            update_thread_counts([parent.thread_id, former_thread.id])
             # if we were the starting email, or former thread may be empty
             if former_thread.emails.count() == 0:
                 former_thread.delete()
@@ -186,8 +202,10 @@ class Email(models.Model):
         msg.set_content(content, subtype='plain')
         msg.make_mixed()
 
-        # Attachments
-        for attachment in self.attachments.order_by("counter"):
+        # Attachments. Sort them here, so that they can be prefetched.
+        attachments = sorted(
+            self.attachments.all(), key=lambda att: att.counter)
+        for attachment in attachments:
             mimetype = attachment.content_type.split('/', 1)
             msg.add_attachment(attachment.get_content(), maintype=mimetype[0],
                                subtype=mimetype[1], filename=attachment.name)
@@ -251,6 +269,7 @@ class Email(models.Model):
             starter.parent = None
             starter.save(update_fields=["parent"])
             children.all().update(parent=starter)
+            update_daily_stats(self.mailinglist, get_day(starter.date))
         else:
             children.update(parent=self.parent)
 
@@ -275,6 +294,176 @@ class Email(models.Model):
     on_vote_deleted = on_vote_added
 
 
+def _get_blob_path(sha256):
+    global_folder = getattr(settings, "HYPERKITTY_ATTACHMENT_FOLDER", None)
+    if global_folder is None:
+        return None
+    return os.path.join(
+        global_folder, "blobs", sha256[0:2], sha256[2:4], sha256)
+
+
+def _write_blob_file(path, content):
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    # Write it atomically, another process may store the same blob.
+    fd, tmppath = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmppath, path)
+
+
+def _check_blob_files(paths):
+    # The deletion of a previous blob with the same content may have removed
+    # the file before this one was committed.
+    for path, content in paths.items():
+        if not os.path.exists(path):
+            _write_blob_file(path, content)
+
+
+class DeferredContentManager(models.Manager):
+    """
+    Don't fetch the content with the other columns, it is only loaded when
+    it is accessed.
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().defer("content")
+
+
+class AttachmentBlob(models.Model):
+    """
+    The content of attachments, stored once for all the attachments that
+    share it and identified by its SHA-256 hash. It is written to the
+    ``HYPERKITTY_ATTACHMENT_FOLDER`` directory if it is set, or to the
+    database otherwise.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.IntegerField()
+    content = models.BinaryField(null=True)
+
+    objects = DeferredContentManager()
+
+    def __str__(self):
+        return self.sha256
+
+    @classmethod
+    def store(cls, content):
+        """
+        Return the blob of this content, storing it if it is new.
+
+        The blob is locked until the end of the transaction: call it in the
+        transaction that saves the attachment using it, or delete_unused()
+        may remove it in the meantime.
+        """
+        return cls.store_many([content])[0]
+
+    @classmethod
+    def store_many(cls, contents):
+        """
+        Like store(), for many contents at once with a fixed number of
+        queries. Return the list of their blobs.
+        """
+        hashes = [hashlib.sha256(content).hexdigest() for content in contents]
+        contents = dict(zip(hashes, contents))
+        if not contents:
+            return []
+        with transaction.atomic():
+            while True:
+                blobs = dict(
+                    (blob.sha256, blob) for blob in
+                    cls.objects.select_for_update().filter(
+                        sha256__in=list(contents)))
+                missing = [sha256 for sha256 in contents
+                           if sha256 not in blobs]
+                if not missing:
+                    break
+                # Another process may store the same content, or a blob may
+                # be deleted by delete_unused() before it is locked.
+                cls.objects.bulk_create([
+                    cls(sha256=sha256, size=len(contents[sha256]),
+                        content=(contents[sha256]
+                                 if _get_blob_path(sha256) is None
+                                 else None))
+                    for sha256 in missing
+                    ], ignore_conflicts=True)
+            paths = {}
+            for sha256, content in contents.items():
+                path = _get_blob_path(sha256)
+                if path is None:
+                    continue
+                paths[path] = content
+                if not os.path.exists(path):
+                    _write_blob_file(path, content)
+        if paths:
+            transaction.on_commit(lambda: _check_blob_files(paths))
+        return [blobs[sha256] for sha256 in hashes]
+
+    @classmethod
+    def delete_unused(cls, blob_ids=None):
+        """
+        Delete the blobs that no attachment uses anymore, and return their
+        number.
+        """
+        blobs = cls.objects.filter(attachments__isnull=True)
+        if blob_ids is not None:
+            blobs = blobs.filter(id__in=blob_ids)
+        count = 0
+        for blob in blobs:
+            try:
+                blob.delete()
+            except models.ProtectedError:
+                continue  # An attachment has just started to use it.
+            count += 1
+        return count
+
+    def get_path(self):
+        """
+        Return the path of the content on the filesystem, or None if it is
+        stored in the database.
+        """
+        path = _get_blob_path(self.sha256)
+        if path is None or not os.path.exists(path):
+            return None
+        return path
+
+    def move_to_folder(self):
+        """
+        Write the content stored in the database to the attachments folder.
+        Return False if there is nothing to move.
+        """
+        path = _get_blob_path(self.sha256)
+        if path is None or self.content is None:
+            return False
+        _write_blob_file(path, bytes(self.content))
+        self.content = None
+        self.save(update_fields=["content"])
+        return True
+
+    def open(self):
+        path = self.get_path()
+        if path is None:
+            if self.content is None:
+                raise FileNotFoundError(
+                    "The content of blob %s is missing" % self.sha256)
+            return io.BytesIO(self.content)
+        return open(path, "rb")
+
+    def on_post_delete(self):
+        path = _get_blob_path(self.sha256)
+        if path is None:
+            return
+
+        def _remove_file():
+            if AttachmentBlob.objects.filter(sha256=self.sha256).exists():
+                return  # The same content has been stored again.
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        # Keep the file if the deletion is rolled back.
+        transaction.on_commit(_remove_file)
+
+
 class Attachment(models.Model):
     email = models.ForeignKey(
         "Email", related_name="attachments", on_delete=models.CASCADE)
@@ -283,16 +472,28 @@ class Attachment(models.Model):
     content_type = models.CharField(max_length=255)
     encoding = models.CharField(max_length=255, null=True)
     size = models.IntegerField(null=True)
+    # The attachments stored before the blobs have their content in this
+    # column or in a per-email folder.
     content = models.BinaryField(null=True)
+    blob = models.ForeignKey(
+        "AttachmentBlob", related_name="attachments", null=True,
+        on_delete=models.PROTECT)
+
+    objects = DeferredContentManager()
 
     class Meta:
         unique_together = ("email", "counter")
 
     def on_pre_save(self):
-        # set the size
-        if not self.size and self.content is not None:
+        # set the size, without loading a deferred content
+        if (not self.size and "content" not in self.get_deferred_fields()
+                and self.content is not None):
             self.size = len(self.content)
 
+    def on_post_delete(self):
+        if self.blob_id is not None:
+            AttachmentBlob.delete_unused([self.blob_id])
+
     def _get_folder(self):
         global_folder = getattr(
             settings, "HYPERKITTY_ATTACHMENT_FOLDER", None)
@@ -312,32 +513,58 @@ class Attachment(models.Model):
             str(self.email.id),
         )
 
-    def get_content(self):
+    def get_path(self):
+        """
+        Return the path of the content on the filesystem, or None if it is
+        stored in the database.
+        """
+        if self.blob_id is not None:
+            return self.blob.get_path()
         folder = self._get_folder()
         if folder is None:
-            return bytes(self.content)
-        filepath = os.path.join(folder, str(self.counter))
-        if not os.path.exists(filepath):
+            return None
+        path = os.path.join(folder, str(self.counter))
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def open_content(self):
+        """
+        Return a binary file object to read the content. When it is stored on
+        the filesystem, it is not loaded in memory.
+
+        :raises FileNotFoundError: if the file of the content is missing.
+        """
+        if self.blob_id is not None:
+            return self.blob.open()
+        filepath = self.get_path()
+        if filepath is None:
+            if self.content is None:
+                raise FileNotFoundError(
+                    "The content of attachment %s is missing" % self.id)
+            return io.BytesIO(self.content)
+        return open(filepath, "rb")
+
+    def get_content(self):
+        try:
+            with self.open_content() as f:
+                return f.read()
+        except FileNotFoundError:
             logger.error("Could not find local attachment %s for email %s",
-                         self.counter, self.email.id)
+                         self.counter, self.email_id)
             return ""
-        with open(filepath, "rb") as f:
-            content = f.read()
-        return content
 
-    def set_content(self, content):
+    def encode_content(self, content):
+        """Return the content as bytes, in the attachment's encoding."""
         if isinstance(content, str):
             if self.encoding is not None:
                 content = content.encode(self.encoding, errors='replace')
             else:
                 content = content.encode('utf-8')
+        return content
+
+    def set_content(self, content):
+        content = self.encode_content(content)
         self.size = len(content)
-        folder = self._get_folder()
-        if folder is None:
-            self.content = content
-            return
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        with open(os.path.join(folder, str(self.counter)), "wb") as f:
-            f.write(content)
+        self.blob = AttachmentBlob.store(content)
         self.content = None
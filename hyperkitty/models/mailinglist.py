@@ -35,6 +35,8 @@ from mailmanclient import MailmanConnectionError
 
 from hyperkitty.lib.utils import pgsql_disable_indexscan
 from .common import ModelCachedValue
+from .stats import (
+    get_day, get_days_between, update_activity, update_daily_stats)
 from .thread import Thread
 
 
@@ -117,13 +119,21 @@ class MailingList(models.Model):
         begin_date = end_date - datetime.timedelta(days=32)
         return begin_date, end_date
 
+    def rebuild_recent_cache(self):
+        """Rebuild the recent cached values from the database."""
+        for cached_value in self.recent_cached_values:
+            cached_value.rebuild()
+        update_activity(self)
+
     def get_participants_count_between(self, begin_date, end_date):
         # We filter on emails dates instead of threads dates because that would
         # also include last month's participants when threads carry from one
-        # month to the next
-        # TODO: caching?
-        return self.emails.filter(
-                date__gte=begin_date, date__lt=end_date
+        # month to the next.
+        # The daily statistics are used, so the first and last days are
+        # counted entirely.
+        first_day, last_day = get_days_between(begin_date, end_date)
+        return self.daily_posters.filter(
+                date__gte=first_day, date__lte=last_day
             ).values("sender_id").distinct().count()
 
     def get_threads_between(self, begin_date, end_date):
@@ -239,13 +249,14 @@ class MailingList(models.Model):
             # Cache handling will be done at the end of the import
             # process.
             return
-        # Rebuild the cached values.
+        # Update the cached values.
         from hyperkitty.tasks import (
             rebuild_mailinglist_cache_for_month,
-            rebuild_mailinglist_cache_recent)
-        rebuild_mailinglist_cache_recent(self.name)
+            update_mailinglist_cache_recent)
+        update_mailinglist_cache_recent(self.name, get_day(email.date))
         rebuild_mailinglist_cache_for_month(
             self.name, email.date.year, email.date.month)
+        self.on_month_changed(email.date)
 
     def on_email_deleted(self, email):
         # Don't use on_email_added, it will try appending to the
@@ -253,6 +264,8 @@ class MailingList(models.Model):
         # when they are deleted.
         # It's not semantically identical to on_thread_deleted() but it's the
         # same code, so DRY.
+        update_daily_stats(self, get_day(email.date))
+        self.on_month_changed(email.date)
         try:
             email.thread
         except Thread.DoesNotExist:
@@ -260,6 +273,13 @@ class MailingList(models.Model):
         else:
             self.on_thread_deleted(email.thread)
 
+    def on_month_changed(self, date):
+        """The emails of the month of this date have changed."""
+        from hyperkitty.lib.archives import (  # circular import
+            invalidate_month_archive)
+        date = date.astimezone(utc)
+        invalidate_month_archive(self, date.year, date.month)
+
     def on_vote_added(self, vote):
         from hyperkitty.tasks import rebuild_cache_popular_threads
         rebuild_cache_popular_threads(self.name)
@@ -267,9 +287,32 @@ class MailingList(models.Model):
     on_vote_deleted = on_vote_added
 
 
-class RecentThreads(ModelCachedValue):
+# The recent values are expensive to compute: after this number of seconds,
+# they are rebuilt in the background while the previous value is served.
+RECENT_SOFT_TIMEOUT = 60 * 60
+
+
+class ThreadsCachedValue(ModelCachedValue):
+    """
+    A cached list of thread ids, returned as Thread instances.
+
+    The threads are loaded with a single query, along with the data used to
+    display them in thread lists.
+    """
+
+    def get_or_set(self):
+        thread_ids = super(ThreadsCachedValue, self).get_or_set()
+        threads = Thread.objects.select_related(
+            "starting_email", "starting_email__sender", "category",
+            ).in_bulk(thread_ids)
+        # Threads may have been deleted since the ids were cached.
+        return [threads[pk] for pk in thread_ids if pk in threads]
+
+
+class RecentThreads(ThreadsCachedValue):
 
     cache_key = "recent_threads"
+    soft_timeout = RECENT_SOFT_TIMEOUT
 
     def get_value(self):
         # Only cache the list of thread ids, or it may go over memcached's size
@@ -285,17 +328,15 @@ class RecentThreads(ModelCachedValue):
         cache.set("%s_count" % self._get_cache_key(), len(value), None)
         return value
 
-    def get_or_set(self):
-        thread_ids = super(RecentThreads, self).get_or_set()
-        return [Thread.objects.get(pk=pk) for pk in thread_ids]
-
     def add_thread(self, thread):
         # Add the thread to the recent_threads.
         # Just append to the cache, a daily cron job will rebuild
         # the cache entirely to remove older threads.
-        recent_thread_ids = self.get_value()
+        recent_thread_ids = cache.get(self._get_cache_key())
         if recent_thread_ids is None:
-            recent_thread_ids = []
+            # The thread is already in the database.
+            self.rebuild()
+            return
         if thread.id in recent_thread_ids:
             # If the thread is already recent, make it the most recent.
             recent_thread_ids.remove(thread.id)
@@ -322,6 +363,7 @@ class ParticipantsCountForMonth(ModelCachedValue):
 class RecentParticipantsCount(ModelCachedValue):
 
     cache_key = "recent_participants_count"
+    soft_timeout = RECENT_SOFT_TIMEOUT
 
     def get_value(self):
         begin_date, end_date = self.instance.get_recent_dates()
@@ -332,38 +374,37 @@ class RecentParticipantsCount(ModelCachedValue):
 class TopPosters(ModelCachedValue):
 
     cache_key = "top_posters"
+    soft_timeout = RECENT_SOFT_TIMEOUT
 
     def get_value(self):
-        from .email import Email  # avoid circular imports
+        # The number of posters and the number of days can be configured.
+        count = getattr(settings, "HYPERKITTY_TOP_POSTERS_COUNT", 5)
+        days = getattr(settings, "HYPERKITTY_TOP_POSTERS_DAYS", None)
         begin_date, end_date = self.instance.get_recent_dates()
-        query = Email.objects.filter(
-                mailinglist=self.instance,
-                date__gte=begin_date,
-                date__lt=end_date,
-            ).only("sender", "sender_name").select_related("sender")
-        posters = {}
-        for email in query:
-            key = (email.sender.address, email.sender_name)
-            if key not in posters:
-                posters[key] = 1
-            else:
-                posters[key] += 1
+        if days is not None:
+            begin_date = end_date - datetime.timedelta(days=days)
+        first_day, last_day = get_days_between(begin_date, end_date)
+        posters = self.instance.daily_posters.filter(
+            date__gte=first_day, date__lte=last_day,
+            ).values("sender_id").annotate(
+            count=models.Sum("emails_count"),
+            name=models.Max("sender_name"),
+            ).order_by("-count", "sender_id")[:count]
         # It's not necessary to return instances since it's only used in
         # templates where access to instance attributes or dictionnary keys is
         # identical.
-        posters = [
-            {"address": p[0], "name": p[1], "count": c}
-            for p, c in posters.items()
+        return [
+            {"address": p["sender_id"], "name": p["name"],
+             "count": p["count"]}
+            for p in posters
             ]
-        sorted_posters = sorted(
-            posters, key=lambda p: p["count"], reverse=True)
-        return sorted_posters[:5]
 
 
-class TopThreads(ModelCachedValue):
+class TopThreads(ThreadsCachedValue):
     """Threads with the most answers."""
 
     cache_key = "top_threads"
+    soft_timeout = RECENT_SOFT_TIMEOUT
 
     def get_value(self):
         # Filter on the recent_threads ids instead of re-using the date
@@ -373,22 +414,17 @@ class TopThreads(ModelCachedValue):
         recent_thread_ids = self.instance.get_threads_between(
             begin_date, end_date).values("id")
         threads = Thread.objects.filter(
-            id__in=recent_thread_ids).annotate(
-            models.Count("emails")).order_by("-emails__count")[:20]
-        # (not sure about using .values_list() here because of the annotation)
+            id__in=recent_thread_ids).order_by("-emails_count")[:20]
         # Only cache the list of thread ids, or it may go over memcached's size
         # limit (1MB)
-        return [t.id for t in threads]
-
-    def get_or_set(self):
-        thread_ids = super(TopThreads, self).get_or_set()
-        return [Thread.objects.get(pk=pk) for pk in thread_ids]
+        return list(threads.values_list("id", flat=True))
 
 
-class PopularThreads(ModelCachedValue):
+class PopularThreads(ThreadsCachedValue):
     """Threads with the most votes."""
 
     cache_key = "popular_threads"
+    soft_timeout = RECENT_SOFT_TIMEOUT
 
     def get_value(self):
         # Filter on the recent_threads ids instead of re-using the date
@@ -397,23 +433,14 @@ class PopularThreads(ModelCachedValue):
         begin_date, end_date = self.instance.get_recent_dates()
         recent_thread_ids = self.instance.get_threads_between(
             begin_date, end_date).values("id")
+        votes_total = models.F("votes_likes") - models.F("votes_dislikes")
         threads = Thread.objects.filter(
-            id__in=recent_thread_ids).annotate(
-            models.Sum("emails__votes__value")).order_by(
-            "-emails__votes__value__sum")[:20]
-        # (not sure about using .values_list() here because of the annotation)
-        for thread in threads:
-            value = thread.emails__votes__value__sum
-            if value is None:
-                value = 0
-            cache.set("Thread:%s:votes_total" % thread.id, value, None)
+            id__in=recent_thread_ids,
+            votes_likes__gt=models.F("votes_dislikes"),
+            ).order_by(votes_total.desc())[:20]
         # Only cache the list of thread ids, or it may go over memcached's size
         # limit (1MB)
-        return [t.id for t in threads if t.votes_total > 0]
-
-    def get_or_set(self):
-        thread_ids = super(PopularThreads, self).get_or_set()
-        return [Thread.objects.get(pk=pk) for pk in thread_ids]
+        return list(threads.values_list("id", flat=True))
 
 
 class FirstDate(ModelCachedValue):
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+
+from django.db import models, transaction
+from django.utils.timezone import now, utc
+
+
+BULK_CREATE_SIZE = 1000
+
+
+class MailingListDailyStats(models.Model):
+    """
+    The activity of a mailing-list on a given day (in UTC).
+    """
+    mailinglist = models.ForeignKey(
+        "MailingList", related_name="daily_stats", on_delete=models.CASCADE)
+    date = models.DateField()
+    emails_count = models.IntegerField(default=0)
+    # The number of threads started on that day.
+    threads_count = models.IntegerField(default=0)
+    participants_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("mailinglist", "date")
+
+    def __str__(self):
+        return "Activity of {} on {}".format(self.mailinglist, self.date)
+
+
+class MailingListDailyPoster(models.Model):
+    """
+    The number of emails sent by a poster to a mailing-list on a given day
+    (in UTC). The number of participants over several days is counted from
+    these rows.
+    """
+    mailinglist = models.ForeignKey(
+        "MailingList", related_name="daily_posters",
+        on_delete=models.CASCADE)
+    date = models.DateField()
+    sender = models.ForeignKey(
+        "Sender", related_name="daily_posts", on_delete=models.CASCADE)
+    sender_name = models.CharField(max_length=255, null=True, blank=True)
+    emails_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("mailinglist", "date", "sender")
+
+    def __str__(self):
+        return "Posts of {} to {} on {}".format(
+            self.sender_id, self.mailinglist, self.date)
+
+
+class MailingListActivity(models.Model):
+    """
+    A summary of the recent activity of a mailing-list, stored to sort the
+    lists in the database. It is refreshed with the recent cached values.
+    """
+    mailinglist = models.OneToOneField(
+        "MailingList", related_name="activity", primary_key=True,
+        on_delete=models.CASCADE)
+    recent_threads_count = models.IntegerField(default=0)
+    recent_participants_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(default=now)
+
+    def __str__(self):
+        return "Activity of {}".format(self.mailinglist)
+
+
+def get_day(value):
+    """Return the day (in UTC) of an aware datetime."""
+    return value.astimezone(utc).date()
+
+
+def get_days_between(begin_date, end_date):
+    """
+    Return the first and last days (in UTC) covered by the period between
+    these aware datetimes, the end being excluded.
+    """
+    last_day = get_day(end_date - datetime.timedelta(microseconds=1))
+    return get_day(begin_date), last_day
+
+
+def update_daily_stats(mailinglist, first_day, last_day=None):
+    """
+    Compute the daily statistics of a mailing-list from its emails, for the
+    days between first_day and last_day (included).
+
+    Concurrent updates of a mailing-list are serialized by locking its row,
+    and the emails are read once the lock is held, so the last update to run
+    always stores the latest counts.
+    """
+    from .mailinglist import MailingList  # circular import
+    if last_day is None:
+        last_day = first_day
+    begin_date = datetime.datetime.combine(
+        first_day, datetime.time.min, tzinfo=utc)
+    end_date = datetime.datetime.combine(
+        last_day + datetime.timedelta(days=1), datetime.time.min, tzinfo=utc)
+    with transaction.atomic():
+        MailingList.objects.select_for_update().only("id").get(
+            pk=mailinglist.pk)
+        emails = mailinglist.emails.filter(
+            date__gte=begin_date, date__lt=end_date,
+            ).order_by("date").values_list(
+            "date", "sender_id", "sender_name", "parent_id")
+        stats = {}
+        posters = {}
+        for date, sender_id, sender_name, parent_id in emails.iterator():
+            day = get_day(date)
+            day_stats = stats.setdefault(day, MailingListDailyStats(
+                mailinglist=mailinglist, date=day))
+            day_stats.emails_count += 1
+            if parent_id is None:
+                day_stats.threads_count += 1
+            poster = posters.get((day, sender_id))
+            if poster is None:
+                day_stats.participants_count += 1
+                poster = posters[(day, sender_id)] = MailingListDailyPoster(
+                    mailinglist=mailinglist, date=day, sender_id=sender_id)
+            poster.emails_count += 1
+            # Keep the latest name.
+            poster.sender_name = sender_name
+        for model in (MailingListDailyStats, MailingListDailyPoster):
+            model.objects.filter(
+                mailinglist=mailinglist,
+                date__gte=first_day, date__lte=last_day,
+                ).delete()
+        MailingListDailyStats.objects.bulk_create(
+            stats.values(), batch_size=BULK_CREATE_SIZE)
+        MailingListDailyPoster.objects.bulk_create(
+            posters.values(), batch_size=BULK_CREATE_SIZE)
+
+
+def update_activity(mailinglist):
+    """Store the recent activity of a mailing-list, from its cached values."""
+    MailingListActivity.objects.update_or_create(
+        mailinglist=mailinglist, defaults=dict(
+            recent_threads_count=mailinglist.recent_threads_count,
+            recent_participants_count=mailinglist.recent_participants_count,
+            updated_at=now(),
+        ))
@@ -20,14 +20,14 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 import logging
-from collections import namedtuple
+from collections import Counter, namedtuple
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils.timezone import now, utc
 
 from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from .common import ModelCachedValue, VotesCachedValue
+from .common import make_votes_dict
 
 
 logger = logging.getLogger(__name__)
@@ -49,19 +49,16 @@ class Thread(models.Model):
     starting_email = models.OneToOneField(
         "Email", related_name="started_thread", null=True,
         on_delete=models.SET_NULL)
-
-    def __init__(self, *args, **kwargs):
-        super(Thread, self).__init__(*args, **kwargs)
-        self.cached_values = {
-            "participants_count": ParticipantsCount(self),
-            "emails_count": EmailsCount(self),
-            "subject": Subject(self),
-            "votes": VotesCachedValue(self),
-            "votes_total": VotesTotal(self),
-        }
+    # Statistics, kept up-to-date by the email and vote hooks.
+    emails_count = models.IntegerField(default=0)
+    participants_count = models.IntegerField(default=0)
+    votes_likes = models.IntegerField(default=0)
+    votes_dislikes = models.IntegerField(default=0)
 
     class Meta:
         unique_together = ("mailinglist", "thread_id")
+        # For the keyset pagination of the threads of a list.
+        indexes = [models.Index(fields=["mailinglist", "date_active", "id"])]
 
     @property
     def participants(self):
@@ -74,10 +71,6 @@ class Thread(models.Model):
                 "sender__address", "sender_name").distinct()
             ]
 
-    @property
-    def participants_count(self):
-        return self.cached_values["participants_count"]()
-
     def replies_after(self, date):
         return self.emails.filter(date__gt=date)
 
@@ -98,20 +91,18 @@ class Thread(models.Model):
     #     self.category_id = category.id
     # category = property(_get_category, _set_category)
 
-    @property
-    def emails_count(self):
-        return self.cached_values["emails_count"]()
-
     @property
     def subject(self):
-        return self.cached_values["subject"]()
+        if self.starting_email is None:
+            return ""
+        return self.starting_email.subject
 
     def get_votes(self):
-        return self.cached_values["votes"]()
+        return make_votes_dict(self.votes_likes, self.votes_dislikes)
 
     @property
     def votes_total(self):
-        return self.cached_values["votes_total"]()
+        return self.votes_likes - self.votes_dislikes
 
     @property
     def prev_thread(self):  # TODO: Make it a relationship
@@ -162,12 +153,39 @@ class Thread(models.Model):
     def on_post_delete(self):
         self.mailinglist.on_thread_deleted(self)
 
+    def update_counts(self):
+        """Count the emails and the participants again."""
+        update_thread_counts([self.id])
+        self.refresh_from_db(fields=["emails_count", "participants_count"])
+
+    def update_votes(self):
+        """Count the votes again."""
+        from .vote import Vote  # circular import
+        votes = Vote.objects.filter(email__thread_id=self.id).aggregate(
+            likes=models.Count("id", filter=models.Q(value=1)),
+            dislikes=models.Count("id", filter=models.Q(value=-1)))
+        self.votes_likes = votes["likes"]
+        self.votes_dislikes = votes["dislikes"]
+        self.save(update_fields=["votes_likes", "votes_dislikes"])
+
     def on_email_added(self, email):
         self.find_starting_email()
         self.date_active = email.date
         if self.starting_email is None:
             self.starting_email = email
-        self.save()
+        with transaction.atomic():
+            # Lock the thread row, so that concurrent emails from the same
+            # new sender don't all count as a new participant.
+            Thread.objects.select_for_update().only("id").get(id=self.id)
+            new_participant = not self.emails.filter(
+                sender_id=email.sender_id, sender_name=email.sender_name,
+                ).exclude(id=email.id).exists()
+            self.save(update_fields=["starting_email", "date_active"])
+            Thread.objects.filter(id=self.id).update(
+                emails_count=models.F("emails_count") + 1,
+                participants_count=(
+                    models.F("participants_count") + int(new_participant)))
+        self.refresh_from_db(fields=["emails_count", "participants_count"])
         if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
             # Cache handling and thread positions will be handled at the end of
             # the import process.
@@ -187,47 +205,50 @@ class Thread(models.Model):
                 self.find_starting_email()
                 self.save(update_fields=["starting_email"])
             compute_thread_order_and_depth(self)
+            self.update_counts()
             self.date_active = self.emails.order_by("-date").first().date
             rebuild_thread_cache_new_email(self.id)
 
     def on_vote_added(self, vote):
-        from hyperkitty.tasks import rebuild_thread_cache_votes
-        rebuild_thread_cache_votes(self.id)
+        self.update_votes()
 
     on_vote_deleted = on_vote_added
 
 
-class ParticipantsCount(ModelCachedValue):
-
-    cache_key = "participants_count"
-
-    def get_value(self):
-        return len(self.instance.participants)
-
-
-class EmailsCount(ModelCachedValue):
-
-    cache_key = "emails_count"
-
-    def get_value(self):
-        return self.instance.emails.count()
-
-
-class Subject(ModelCachedValue):
-
-    cache_key = "subject"
-
-    def get_value(self):
-        return self.instance.starting_email.subject
-
-
-class VotesTotal(ModelCachedValue):
+def update_thread_counts(thread_ids):
+    """
+    Count the emails, the participants and the votes of many threads again.
 
-    cache_key = "votes_total"
+    This is used when the emails are not added one by one, or are moved to
+    another thread, and thus the thread hooks were not called.
 
-    def get_value(self):
-        votes = self.instance.get_votes()
-        return votes["likes"] - votes["dislikes"]
+    :arg thread_ids: a list of thread ids.
+    """
+    from .email import Email  # circular import
+    from .vote import Vote  # circular import
+    emails = Email.objects.filter(thread_id__in=thread_ids).order_by()
+    emails_counts = dict(emails.values_list("thread_id").annotate(
+        models.Count("id")))
+    participants_counts = Counter(
+        thread_id for thread_id, _sender, _name in emails.values_list(
+            "thread_id", "sender_id", "sender_name").distinct())
+    votes = {
+        thread_id: (likes, dislikes)
+        for thread_id, likes, dislikes in Vote.objects.filter(
+            email__thread_id__in=thread_ids).order_by().values_list(
+            "email__thread_id").annotate(
+            likes=models.Count("id", filter=models.Q(value=1)),
+            dislikes=models.Count("id", filter=models.Q(value=-1)))
+        }
+    Thread.objects.bulk_update([
+        Thread(id=thread_id,
+               emails_count=emails_counts.get(thread_id, 0),
+               participants_count=participants_counts[thread_id],
+               votes_likes=votes.get(thread_id, (0, 0))[0],
+               votes_dislikes=votes.get(thread_id, (0, 0))[1])
+        for thread_id in thread_ids
+        ], ["emails_count", "participants_count", "votes_likes",
+            "votes_dislikes"])
 
 
 class LastView(models.Model):
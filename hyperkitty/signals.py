@@ -22,14 +22,17 @@
 from contextlib import contextmanager
 
 from django.conf import settings
+from django.contrib.sites.models import Site
 from django.db.models.signals import (
     post_delete, post_init, post_save, pre_delete, pre_save)
 from django.dispatch import receiver
 
+from django_mailman3.models import MailDomain
 from django_mailman3.signals import mailinglist_created, mailinglist_modified
 
-from hyperkitty.lib.mailman import import_list_from_mailman
-from hyperkitty.models.email import Attachment, Email
+from hyperkitty.lib.mailman import (
+    import_list_from_mailman, invalidate_mail_domains)
+from hyperkitty.models.email import Attachment, AttachmentBlob, Email
 from hyperkitty.models.mailinglist import MailingList
 from hyperkitty.models.profile import Profile
 from hyperkitty.models.thread import Thread
@@ -73,6 +76,16 @@ def Attachment_on_pre_save(sender, **kwargs):
     kwargs["instance"].on_pre_save()
 
 
+@receiver(post_delete, sender=Attachment)
+def Attachment_on_post_delete(sender, **kwargs):
+    kwargs["instance"].on_post_delete()
+
+
+@receiver(post_delete, sender=AttachmentBlob)
+def AttachmentBlob_on_post_delete(sender, **kwargs):
+    kwargs["instance"].on_post_delete()
+
+
 # MailingList
 
 @receiver(pre_save, sender=MailingList)
@@ -121,6 +134,16 @@ def Vote_on_post_delete(sender, **kwargs):
     kwargs["instance"].on_post_delete()
 
 
+# Mail domains
+
+@receiver(post_save, sender=MailDomain)
+@receiver(post_delete, sender=MailDomain)
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def on_mail_domain_changed(sender, **kwargs):
+    invalidate_mail_domains()
+
+
 # Mailman signals
 
 @receiver(mailinglist_created)
@@ -23,25 +23,102 @@ Definition of async tasks using Django-Q.
 Author: Aurelien Bompard <abompard@fedoraproject.org>
 """
 
+import hashlib
 import logging
 
-from django.core.cache import cache
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.cache.utils import make_template_fragment_key
 
 from django_q.tasks import AsyncTask
 from mailmanclient import MailmanConnectionError
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.analysis import (
+    compute_email_order_and_depth, compute_thread_order_and_depth)
+from hyperkitty.lib.archives import build_month_archive
 from hyperkitty.lib.utils import run_with_lock
 from hyperkitty.models.email import Email
 from hyperkitty.models.mailinglist import MailingList
 from hyperkitty.models.sender import Sender
+from hyperkitty.models.stats import (
+    get_days_between, update_activity, update_daily_stats)
 from hyperkitty.models.thread import Thread
 from hyperkitty.search_indexes import update_index
 
 
 log = logging.getLogger(__name__)
 
+#
+# Coalescing
+#
+
+
+def _get_coalesce_key(task_name, args):
+    args_hash = hashlib.sha1(repr(args).encode("utf-8")).hexdigest()
+    return "hyperkitty:task:%s:%s" % (task_name, args_hash)
+
+
+def _get_absorbed_key(task_name):
+    return "hyperkitty:task_absorbed:%s" % task_name
+
+
+def _is_cache_shared():
+    """
+    Whether the pending markers set here can be removed by the worker that
+    runs the task. The process-local cache backends are only visible to the
+    workers when the tasks are run synchronously.
+    """
+    if getattr(settings, "Q_CLUSTER", {}).get("sync", False):
+        return True
+    return not isinstance(
+        caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+def run_coalesced(task_name, func, *args):
+    """
+    Enqueue a task, unless the same task with the same arguments is already
+    waiting to be run.
+
+    The pending task is remembered until it starts running, so an enqueue
+    that comes later always leads to a new run. The
+    ``HYPERKITTY_TASKS_COALESCE_WINDOW`` setting is the maximum time to
+    remember it, in case it is lost. Set it to ``0`` to disable coalescing.
+    It is also disabled if the cache is not shared with the workers.
+    """
+    window = getattr(settings, "HYPERKITTY_TASKS_COALESCE_WINDOW", 300)
+    key = None
+    if window and _is_cache_shared():
+        key = _get_coalesce_key(task_name, args)
+        if not cache.add(key, True, window):
+            absorbed_key = _get_absorbed_key(task_name)
+            cache.add(absorbed_key, 0, None)
+            cache.incr(absorbed_key)
+            log.debug("Task %s%r is already pending", task_name, args)
+            return
+    try:
+        AsyncTask(_run_pending, key, func, *args,
+                  q_options={'task_name': task_name}).run()
+    except Exception:
+        if key is not None:
+            cache.delete(key)
+        raise
+
+
+def _run_pending(key, func, *args):
+    if key is not None:
+        # From now on, the same task must be enqueued again.
+        cache.delete(key)
+    func(*args)
+
+
+def get_absorbed_count(task_name):
+    """Return the number of enqueues of this task that were coalesced."""
+    return cache.get(_get_absorbed_key(task_name), 0)
+
+
 #
 # Tasks
 #
@@ -58,21 +135,74 @@ def update_search_index():
 #     run_with_lock(update_index, remove=True)
 
 def rebuild_mailinglist_cache_recent(mlist_name):
-    AsyncTask(
-        _rebuild_mailinglist_cache_recent, mlist_name,
-        q_options={'task_name': 'rebuild_mailinglist_cache_recent'}).run()
+    run_coalesced('rebuild_mailinglist_cache_recent',
+                  _rebuild_mailinglist_cache_recent, mlist_name)
 
 
 def _rebuild_mailinglist_cache_recent(mlist_name):
     mlist = MailingList.objects.get(name=mlist_name)
-    for cached_value in mlist.recent_cached_values:
+    mlist.rebuild_recent_cache()
+
+
+def update_mailinglist_cache_recent(mlist_name, day):
+    run_coalesced('update_mailinglist_cache_recent',
+                  _update_mailinglist_cache_recent, mlist_name, day)
+
+
+def _update_mailinglist_cache_recent(mlist_name, day):
+    """
+    Update the recent cached values of a mailing-list after emails were
+    added on that day.
+
+    The daily statistics are the per-day buckets of the recent values: only
+    the bucket of that day is counted again, and the recent values are
+    summed from the buckets of the recent period. The task is coalesced per
+    list and day, so a burst of emails leads to a single update.
+    """
+    try:
+        mlist = MailingList.objects.get(name=mlist_name)
+    except MailingList.DoesNotExist:
+        log.warning(
+            "Cannot update the recent cache: list %s does not exist.",
+            mlist_name)
+        return
+    update_daily_stats(mlist, day)
+    first_day, last_day = get_days_between(*mlist.get_recent_dates())
+    if day < first_day or day > last_day:
+        return
+    # Those don't scan the recent emails anymore: the threads values only
+    # query the threads table, and the posters values sum the daily buckets.
+    for key in ["recent_threads", "recent_participants_count", "top_posters",
+                "top_threads"]:
+        mlist.cached_values[key].rebuild()
+    update_activity(mlist)
+
+
+def rebuild_cached_value(model_label, pk, key):
+    run_coalesced('rebuild_cached_value',
+                  _rebuild_cached_value, model_label, pk, key)
+
+
+def _rebuild_cached_value(model_label, pk, key):
+    model = apps.get_model(model_label)
+    try:
+        instance = model.objects.get(pk=pk)
+    except model.DoesNotExist:
+        log.warning("Cannot rebuild the %s cache: %s %s does not exist.",
+                    key, model_label, pk)
+        return
+    cached_value = instance.cached_values[key]
+    try:
         cached_value.rebuild()
+    finally:
+        # Release the lock taken when the value was found stale.
+        cache.delete(cached_value._get_refresh_key())
 
 
 def rebuild_mailinglist_cache_for_month(mlist_name, year, month):
-    AsyncTask(
-        _rebuild_mailinglist_cache_for_month, mlist_name, year, month,
-        q_options={'task_name': 'rebuild_mailinglist_cache_for_month'}).run()
+    run_coalesced(
+        'rebuild_mailinglist_cache_for_month',
+        _rebuild_mailinglist_cache_for_month, mlist_name, year, month)
 
 
 def _rebuild_mailinglist_cache_for_month(mlist_name, year, month):
@@ -80,9 +210,25 @@ def _rebuild_mailinglist_cache_for_month(mlist_name, year, month):
     mlist.cached_values["participants_count_for_month"].rebuild(year, month)
 
 
+def rebuild_mbox_archive(mlist_name, year, month):
+    run_coalesced('rebuild_mbox_archive',
+                  _rebuild_mbox_archive, mlist_name, year, month)
+
+
+def _rebuild_mbox_archive(mlist_name, year, month):
+    try:
+        mlist = MailingList.objects.get(name=mlist_name)
+    except MailingList.DoesNotExist:
+        log.warning(
+            "Cannot build the mbox archive: list %s does not exist.",
+            mlist_name)
+        return
+    build_month_archive(mlist, year, month)
+
+
 def rebuild_thread_cache_new_email(thread_id):
-    AsyncTask(_rebuild_thread_cache_new_email, thread_id,
-              q_options={'task_name': 'rebuild_thread_cache_new_email'}).run()
+    run_coalesced('rebuild_thread_cache_new_email',
+                  _rebuild_thread_cache_new_email, thread_id)
 
 
 def _rebuild_thread_cache_new_email(thread_id):
@@ -93,16 +239,14 @@ def _rebuild_thread_cache_new_email(thread_id):
             "Cannot rebuild the thread cache: thread %s does not exist.",
             thread_id)
         return
-    for cached_key in ["participants_count", "emails_count"]:
-        thread.cached_values[cached_key].rebuild()
-    # Don't forget the cached template fragment.
+    # The cached template fragment.
     cache.delete(make_template_fragment_key(
         "thread_participants", [thread.id]))
 
 
 def rebuild_cache_popular_threads(mlist_name):
-    AsyncTask(_rebuild_cache_popular_threads, mlist_name,
-              q_options={'task_name': 'rebuild_cache_popular_threads'}).run()
+    run_coalesced('rebuild_cache_popular_threads',
+                  _rebuild_cache_popular_threads, mlist_name)
 
 
 def _rebuild_cache_popular_threads(mlist_name):
@@ -111,8 +255,8 @@ def _rebuild_cache_popular_threads(mlist_name):
 
 
 def compute_thread_positions(thread_id):
-    AsyncTask(_compute_thread_positions, thread_id,
-              q_options={'task_name': 'compute_thread_positions'}).run()
+    run_coalesced('compute_thread_positions',
+                  _compute_thread_positions, thread_id)
 
 
 def _compute_thread_positions(thread_id):
@@ -124,12 +268,17 @@ def _compute_thread_positions(thread_id):
             "Cannot rebuild the thread cache: thread %s does not exist.",
             thread_id)
         return
-    compute_thread_order_and_depth(thread)
+    # The emails added since the last run have no position yet. A single one
+    # is inserted at its place, several of them need the whole thread.
+    new_emails = list(thread.emails.filter(thread_order__isnull=True)[:2])
+    if len(new_emails) == 1:
+        compute_email_order_and_depth(new_emails[0])
+    elif new_emails:
+        compute_thread_order_and_depth(thread)
 
 
 def update_from_mailman(mlist_name):
-    AsyncTask(_update_from_mailman, mlist_name,
-              q_options={'task_name': 'update_from_mailman'}).run()
+    run_coalesced('update_from_mailman', _update_from_mailman, mlist_name)
 
 
 def _update_from_mailman(mlist_name):
@@ -138,8 +287,7 @@ def _update_from_mailman(mlist_name):
 
 
 def sender_mailman_id(sender_id):
-    AsyncTask(_sender_mailman_id, sender_id,
-              q_options={'task_name': 'sender_mailman_id'}).run()
+    run_coalesced('sender_mailman_id', _sender_mailman_id, sender_id)
 
 
 def _sender_mailman_id(sender_id):
@@ -151,8 +299,7 @@ def _sender_mailman_id(sender_id):
 
 
 def check_orphans(email_id):
-    AsyncTask(_check_orphans, email_id,
-              q_options={'task_name': 'check_orphans'}).run()
+    run_coalesced('check_orphans', _check_orphans, email_id)
 
 
 def _check_orphans(email_id):
@@ -180,26 +327,9 @@ def _check_orphans(email_id):
         orphan.set_parent(email)
 
 
-def rebuild_thread_cache_votes(thread_id):
-    AsyncTask(_rebuild_thread_cache_votes, thread_id,
-              q_options={'task_name': 'rebuild_thread_cache_votes'}).run()
-
-
-def _rebuild_thread_cache_votes(thread_id):
-    try:
-        thread = Thread.objects.get(id=thread_id)
-    except Thread.DoesNotExist:
-        log.warning('Thread with id {thread_id} does not exist'.format(
-            thread_id=thread_id))
-        return
-
-    for cached_key in ["votes", "votes_total"]:
-        thread.cached_values[cached_key].rebuild()
-
-
 def rebuild_email_cache_votes(email_id):
-    AsyncTask(_rebuild_email_cache_votes, email_id,
-              q_options={'task_name': 'rebuild_email_cache_votes'}).run()
+    run_coalesced('rebuild_email_cache_votes',
+                  _rebuild_email_cache_votes, email_id)
 
 
 def _rebuild_email_cache_votes(email_id):
@@ -282,6 +282,9 @@ def strip_subject(subject, mlist):
 
 @register.filter
 def is_unread_by(thread, user):
+    # The thread lists compute it for the whole page.
+    if hasattr(thread, "unread"):
+        return thread.unread
     return thread.is_unread_by(user)
 
 
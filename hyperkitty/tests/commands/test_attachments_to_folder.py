@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+from email.message import EmailMessage
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models import Attachment, AttachmentBlob, Email
+from hyperkitty.tests.utils import TestCase
+
+
+class AttachmentsToFolderTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(self.tmpdir, "attachments")
+        for num in range(3):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_content("Dummy message")
+            msg.add_attachment("Content %d" % num, subtype="plain")
+            add_to_list("list@example.com", msg)
+        # An attachment stored before the deduplicated storage.
+        Attachment.objects.create(
+            email=Email.objects.get(message_id="msg0"), counter=3,
+            name="logo.png", content_type="image/png", content=b"logo")
+
+    def _call_command(self, *args, **kwargs):
+        output = StringIO()
+        call_command("hyperkitty_attachments_to_folder", *args,
+                     stdout=output, stderr=StringIO(), **kwargs)
+        return output.getvalue()
+
+    def test_no_folder(self):
+        self.assertRaises(
+            CommandError, call_command, "hyperkitty_attachments_to_folder")
+
+    def test_move(self):
+        self.assertEqual(
+            AttachmentBlob.objects.filter(content__isnull=False).count(), 3)
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.folder):
+            output = self._call_command(batch_size=2)
+            # The older attachment was directly written to the folder.
+            self.assertIn("1 attachments moved", output)
+            self.assertIn("3 contents moved", output)
+            self.assertFalse(
+                AttachmentBlob.objects.filter(content__isnull=False).exists())
+            self.assertFalse(
+                Attachment.objects.filter(content__isnull=False).exists())
+            for attachment in Attachment.objects.all():
+                self.assertTrue(os.path.exists(attachment.get_path()))
+            self.assertEqual(
+                Attachment.objects.get(
+                    email__message_id="msg1", counter=2).get_content(),
+                b"Content 1\n")
+            self.assertEqual(
+                Attachment.objects.get(counter=3).get_content(), b"logo")
+            # Running it again does nothing.
+            self.assertIn("0 contents moved", self._call_command())
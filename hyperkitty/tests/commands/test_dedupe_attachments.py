@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+from email.message import EmailMessage
+from io import StringIO
+
+from django.core.management import call_command
+
+from mock import patch
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models import Attachment, AttachmentBlob, Email
+from hyperkitty.tests.utils import TestCase
+
+
+class DedupeAttachmentsTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(self.tmpdir, "attachments")
+        for num in range(3):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("Dummy message")
+            add_to_list("list@example.com", msg)
+        # Attachments stored before the deduplicated storage.
+        self.emails = list(Email.objects.order_by("message_id"))
+        for email in self.emails:
+            Attachment.objects.create(
+                email=email, counter=2, name="logo.png",
+                content_type="image/png", content=b"logo")
+
+    def _call_command(self, *args, **kwargs):
+        output = StringIO()
+        errors = StringIO()
+        with patch("hyperkitty.management.commands."
+                   "hyperkitty_dedupe_attachments.transaction.on_commit",
+                   lambda func: func()):
+            call_command("hyperkitty_dedupe_attachments", *args,
+                         stdout=output, stderr=errors, **kwargs)
+        return output.getvalue(), errors.getvalue()
+
+    def test_database(self):
+        output, errors = self._call_command(batch_size=2)
+        self.assertEqual(errors, "")
+        self.assertIn("3 attachments moved, 1 distinct contents", output)
+        self.assertEqual(AttachmentBlob.objects.count(), 1)
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(bytes(blob.content), b"logo")
+        for attachment in Attachment.objects.all():
+            self.assertEqual(attachment.blob_id, blob.id)
+            self.assertIsNone(attachment.content)
+            self.assertEqual(attachment.get_content(), b"logo")
+        # Running it again does nothing.
+        output, errors = self._call_command()
+        self.assertIn("0 attachments moved", output)
+
+    def test_folder(self):
+        attachment = Attachment.objects.get(email=self.emails[0])
+        attachment.content = None
+        attachment.save()
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.folder):
+            old_path = os.path.join(attachment._get_folder(), "2")
+            os.makedirs(os.path.dirname(old_path))
+            with open(old_path, "wb") as f:
+                f.write(b"logo")
+            self.assertEqual(attachment.get_path(), old_path)
+            self._call_command()
+            attachment.refresh_from_db()
+            new_path = attachment.get_path()
+            self.assertEqual(attachment.get_content(), b"logo")
+        self.assertFalse(os.path.exists(old_path))
+        self.assertFalse(os.path.exists(os.path.dirname(old_path)))
+        self.assertTrue(os.path.exists(new_path))
+        self.assertEqual(AttachmentBlob.objects.count(), 1)
+
+    def test_missing_content(self):
+        attachment = Attachment.objects.get(email=self.emails[0])
+        attachment.content = None
+        attachment.save()
+        output, errors = self._call_command()
+        self.assertIn("2 attachments moved", output)
+        self.assertIn(
+            "Could not find the content of attachment 2 of email %s"
+            % self.emails[0].id, errors)
+        attachment.refresh_from_db()
+        self.assertIsNone(attachment.blob)
+
+    def test_unused_blobs(self):
+        AttachmentBlob.objects.create(sha256="dummy", size=0, content=b"")
+        output, errors = self._call_command()
+        self.assertIn("1 unused contents deleted", output)
+        self.assertFalse(
+            AttachmentBlob.objects.filter(sha256="dummy").exists())
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import json
 import mailbox
 import os.path
-from datetime import datetime
+from datetime import date, datetime
 from email import message_from_file
 from email.message import EmailMessage
 from io import StringIO
@@ -10,15 +12,15 @@ from traceback import format_exc
 from unittest import SkipTest, expectedFailure
 
 from django.conf import settings
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.db import DEFAULT_DB_ALIAS
 from django.utils.timezone import utc
 
 from mock import Mock, patch
 
-from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.incoming import add_batch_to_list, add_to_list
 from hyperkitty.management.commands.hyperkitty_import import Command
-from hyperkitty.models import Email, MailingList
+from hyperkitty.models import Email, MailingList, MailingListDailyStats, Thread
 from hyperkitty.tests.utils import TestCase, get_test_file
 
 
@@ -54,13 +56,15 @@ class CommandTestCase(TestCase):
         # do the import
         output = StringIO()
         with patch("hyperkitty.management.commands.hyperkitty_import"
-                   ".compute_thread_order_and_depth") as mock_compute:
+                   ".compute_threads_order_and_depth") as mock_compute:
             kw = self.common_cmd_args.copy()
             kw["stdout"] = kw["stderr"] = output
             call_command('hyperkitty_import',
                          os.path.join(self.tmpdir, "test.mbox"), **kw)
         self.assertEqual(mock_compute.call_count, 1)
-        thread = mock_compute.call_args[0][0]
+        thread_ids = mock_compute.call_args[0][0]
+        self.assertEqual(len(thread_ids), 1)
+        thread = Thread.objects.get(id=list(thread_ids)[0])
         self.assertEqual(thread.emails.count(), 1)
         self.assertEqual(thread.starting_email.message_id, "msg2")
 
@@ -80,6 +84,7 @@ class CommandTestCase(TestCase):
                    ".DbImporter") as DbImporterMock:
             instance = Mock()
             instance.impacted_thread_ids = []
+            instance.impacted_days = set()
             DbImporterMock.side_effect = lambda *a, **kw: instance
             kw = self.common_cmd_args.copy()
             kw["stdout"] = kw["stderr"] = output
@@ -103,6 +108,7 @@ class CommandTestCase(TestCase):
                    ".DbImporter") as DbImporterMock:
             instance = Mock()
             instance.impacted_thread_ids = []
+            instance.impacted_days = set()
             DbImporterMock.side_effect = lambda *a, **kw: instance
             kw = self.common_cmd_args.copy()
             kw["stdout"] = kw["stderr"] = output
@@ -526,16 +532,288 @@ class CommandTestCase(TestCase):
         mbox.close()
         # do the import
         output = StringIO()
-        with patch("hyperkitty.management.commands.hyperkitty_import"
-                   ".compute_thread_order_and_depth") as mock_compute:
+        # The threads are computed by batches.
+        with patch("hyperkitty.lib.analysis.THREADS_BATCH_SIZE", 100):
             kw = self.common_cmd_args.copy()
             kw["stdout"] = kw["stderr"] = output
             call_command('hyperkitty_import',
                          os.path.join(self.tmpdir, "test.mbox"), **kw)
-        called_thread_ids = set([
-            call[0][0].starting_email.message_id
-            for call in mock_compute.call_args_list
-            ])
+        self.assertEqual(Thread.objects.count(), 250)
+        self.assertEqual(
+            Email.objects.filter(thread_order=0, thread_depth=0).count(),
+            250)
+
+    def test_batch_size(self):
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(25):
+            msg = EmailMessage()
+            msg["From"] = "dummy%d@example.com" % (i % 3)
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Jan 2015 12:%02d:00" % i
+            if i % 5:
+                # Reply to the first message of each group of 5, the parent
+                # may be in a previous batch.
+                msg["In-Reply-To"] = "<msg%d>" % (i - i % 5)
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        # A duplicate
+        mbox.add(msg)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["batch_size"] = 7
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(Email.objects.count(), 25)
+        self.assertEqual(Thread.objects.count(), 5)
+        self.assertIn("Duplicate email with message-id 'msg24'",
+                      output.getvalue())
+        for thread in Thread.objects.all():
+            self.assertEqual(thread.emails.count(), 5)
+            starter = thread.starting_email
+            self.assertEqual(starter.thread_order, 0)
+            self.assertEqual(
+                list(thread.emails.order_by("thread_order").values_list(
+                     "thread_depth", flat=True)),
+                [0, 1, 1, 1, 1])
+            for email in thread.emails.exclude(id=starter.id):
+                self.assertEqual(email.parent_id, starter.id)
+
+    def test_batch_size_invalid(self):
+        mailbox.mbox(os.path.join(self.tmpdir, "test.mbox")).close()
+        kw = self.common_cmd_args.copy()
+        kw["batch_size"] = 0
+        with self.assertRaises(CommandError):
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+
+    def test_workers(self):
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(30):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Jan 2015 12:%02d:00" % i
+            if i % 10:
+                msg["In-Reply-To"] = "<msg%d>" % (i - 1)
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["workers"] = 2
+        kw["batch_size"] = 8
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertIn("msg29", output.getvalue())
+        self.assertEqual(Email.objects.count(), 30)
+        self.assertEqual(Thread.objects.count(), 3)
+        for thread in Thread.objects.all():
+            self.assertEqual(
+                list(thread.emails.order_by("thread_order").values_list(
+                     "thread_depth", flat=True)),
+                list(range(10)))
+
+    def test_workers_close_connections(self):
+        # The workers don't inherit the database connections.
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        mbox.close()
+        connection = Mock(in_atomic_block=False)
+        closed_before_fork = []
+
+        def pool(*args, **kwargs):
+            closed_before_fork.append(connection.close.called)
+            raise RuntimeError("stop here")
+        kw = self.common_cmd_args.copy()
+        kw["workers"] = 2
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".connections") as connections, \
+                patch("hyperkitty.management.commands.hyperkitty_import"
+                      ".multiprocessing") as mp:
+            connections.all.return_value = [connection]
+            mp.get_context.return_value.Pool.side_effect = pool
+            self.assertRaises(
+                RuntimeError, call_command, 'hyperkitty_import',
+                os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(closed_before_fork, [True])
+
+    def test_workers_errors(self):
+        # Errors in the worker processes are reported.
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg1>"
+        msg["Date"] = "01 Jan 2015 12:00:00"
+        msg.set_payload("msg1")
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        mbox.add(msg)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["workers"] = 2
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".parse_message") as parse_message:
+            parse_message.side_effect = ValueError("test error")
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertIn("Failed adding message", output.getvalue())
+        self.assertIn("test error", output.getvalue())
+        self.assertEqual(Email.objects.count(), 0)
+
+    def test_gzip(self):
+        mbox_path = os.path.join(self.tmpdir, "test.mbox")
+        mbox = mailbox.mbox(mbox_path)
+        for i in range(3):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Jan 2015 12:%02d:00" % i
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+        with open(mbox_path, "rb") as mbox_file:
+            with gzip.open(mbox_path + ".gz", "wb") as gz_file:
+                gz_file.write(mbox_file.read())
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        call_command('hyperkitty_import', mbox_path + ".gz", **kw)
+        self.assertEqual(
+            sorted(Email.objects.values_list("message_id", flat=True)),
+            ["msg0", "msg1", "msg2"])
+        self.assertIn("<msg2> (2, 100%)", output.getvalue())
+
+    def test_daily_stats(self):
+        # The daily statistics are computed at the end of the import.
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(4):
+            msg = EmailMessage()
+            msg["From"] = "dummy%d@example.com" % (i % 2)
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "0%d Jan 2015 12:00:00" % (1 + i // 3)
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["batch_size"] = 2
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(
+            list(MailingListDailyStats.objects.order_by("date").values_list(
+                "date", "emails_count", "participants_count")),
+            [(date(2015, 1, 1), 3, 2), (date(2015, 1, 2), 1, 1)])
+
+    def _make_thread_mbox(self, count):
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(count):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            # Out-of-order dates, --since would skip some of them.
+            msg["Date"] = "01 Jan 2015 12:%02d:00" % ((i * 7) % count)
+            if i:
+                msg["In-Reply-To"] = "<msg%d>" % (i - 1)
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+        return os.path.join(self.tmpdir, "test.mbox")
+
+    def test_checkpoint(self):
+        mbox_path = self._make_thread_mbox(5)
+        checkpoint_path = os.path.join(self.tmpdir, "checkpoint.json")
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["batch_size"] = 2
+        kw["checkpoint"] = checkpoint_path
+        call_command('hyperkitty_import', mbox_path, **kw)
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.assertEqual(checkpoint["list"], "list@example.com")
+        self.assertEqual(
+            checkpoint["mbox"],
+            {os.path.abspath(mbox_path): {
+                "end": os.path.getsize(mbox_path) - 1, "count": 5}})
+
+    def test_resume(self):
+        mbox_path = self._make_thread_mbox(10)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["batch_size"] = 3
+        kw["checkpoint"] = os.path.join(self.tmpdir, "checkpoint.json")
+        calls = []
+
+        def crash_on_second_batch(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError("interrupted")
+            return add_batch_to_list(*args)
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".add_batch_to_list") as mock_add:
+            mock_add.side_effect = crash_on_second_batch
+            with self.assertRaises(RuntimeError):
+                call_command('hyperkitty_import', mbox_path, **kw)
+        self.assertEqual(Email.objects.count(), 3)
+        # Resume the import.
+        output = StringIO()
+        kw["stdout"] = kw["stderr"] = output
+        kw["resume"] = True
+        call_command('hyperkitty_import', mbox_path, **kw)
+        self.assertIn("Resuming after 3 messages", output.getvalue())
+        self.assertNotIn("Duplicate", output.getvalue())
+        self.assertIn("<msg9> (9, ", output.getvalue())
+        self.assertEqual(Email.objects.count(), 10)
+        self.assertEqual(Thread.objects.count(), 1)
+        # The thread structure includes the emails from the first run.
         self.assertEqual(
-            called_thread_ids,
-            set([("msg%d" % i) for i in range(250)]))
+            list(Email.objects.order_by("thread_order").values_list(
+                 "thread_depth", flat=True)),
+            list(range(10)))
+
+    def test_resume_serial(self):
+        mbox_path = self._make_thread_mbox(4)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["checkpoint"] = os.path.join(self.tmpdir, "checkpoint.json")
+        call_command('hyperkitty_import', mbox_path, **kw)
+        # Nothing is read again when resuming a complete import.
+        output = StringIO()
+        kw["stdout"] = kw["stderr"] = output
+        kw["resume"] = True
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".add_to_list") as mock_add:
+            call_command('hyperkitty_import', mbox_path, **kw)
+        self.assertFalse(mock_add.called)
+        self.assertIn("Resuming after 4 messages", output.getvalue())
+
+    def test_checkpoint_serial_throttled(self):
+        mbox_path = self._make_thread_mbox(5)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["checkpoint"] = os.path.join(self.tmpdir, "checkpoint.json")
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".CHECKPOINT_INTERVAL", 2), \
+                patch("hyperkitty.management.commands.hyperkitty_import"
+                      ".Checkpoint.save") as mock_save:
+            call_command('hyperkitty_import', mbox_path, **kw)
+        # Every 2 messages, and once at the end.
+        self.assertEqual(
+            [call[0][2] for call in mock_save.call_args_list], [2, 4, 5])
+        self.assertEqual(mock_save.call_args[0][1],
+                         os.path.getsize(mbox_path) - 1)
+
+    def test_resume_errors(self):
+        mbox_path = self._make_thread_mbox(1)
+        checkpoint_path = os.path.join(self.tmpdir, "checkpoint.json")
+        kw = self.common_cmd_args.copy()
+        kw["resume"] = True
+        with self.assertRaises(CommandError):
+            call_command('hyperkitty_import', mbox_path, **kw)
+        with open(checkpoint_path, "w") as checkpoint_file:
+            json.dump({"list": "other@example.com", "mbox": {}},
+                      checkpoint_file)
+        kw["checkpoint"] = checkpoint_path
+        with self.assertRaises(CommandError):
+            call_command('hyperkitty_import', mbox_path, **kw)
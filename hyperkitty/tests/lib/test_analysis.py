@@ -20,11 +20,16 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+from datetime import timedelta
 from email.message import EmailMessage
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.analysis import (
+    compute_email_order_and_depth, compute_thread_order_and_depth,
+    compute_threads_order_and_depth)
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import Email, MailingList, Sender, Thread
 from hyperkitty.tests.utils import TestCase
@@ -187,3 +192,176 @@ class TestThreadOrderDepth(TestCase):
         msg1.save()
         compute_thread_order_and_depth(thread)
         # Don't traceback with a "maximum recursion depth exceeded" error
+
+    def test_long_reply_chain(self):
+        # Each email replies to the previous one, deeper than Python's
+        # recursion limit.
+        thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id="msg0")
+        sender = Sender.objects.create(address="sender@example.com")
+        date = now()
+        Email.objects.bulk_create([
+            Email(id=num + 1, mailinglist=self.mlist, thread=thread,
+                  message_id="msg%d" % num, sender=sender, content="",
+                  subject="subject", date=date + timedelta(seconds=num),
+                  timezone=0, parent_id=num or None)
+            for num in range(3000)])
+        thread.starting_email_id = 1
+        thread.save()
+        compute_thread_order_and_depth(thread)
+        self.assertEqual(
+            list(thread.emails.order_by("id").values_list(
+                 "thread_order", "thread_depth")),
+            [(num, num) for num in range(3000)])
+
+
+class TestThreadsOrderDepth(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList.objects.create(name="example-list")
+        self.sender = Sender.objects.create(address="sender@example.com")
+        self.date = now()
+
+    def make_thread(self, name, parents):
+        """
+        Create a thread from a list of parent indexes, in date order.
+        """
+        thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id=name)
+        emails = []
+        for num, parent in enumerate(parents):
+            self.date += timedelta(minutes=1)
+            email = Email.objects.create(
+                mailinglist=self.mlist, thread=thread,
+                message_id="%s-%d" % (name, num), sender=self.sender,
+                subject=name, content="", date=self.date, timezone=0,
+                parent=None if parent is None else emails[parent])
+            emails.append(email)
+        thread.starting_email = emails[0]
+        thread.save()
+        return thread
+
+    def get_positions(self, thread):
+        return list(thread.emails.order_by("date").values_list(
+            "thread_order", "thread_depth"))
+
+    def test_many_threads(self):
+        # 0
+        # |-1
+        # | `-3
+        # `-2
+        thread1 = self.make_thread("thread1", [None, 0, 0, 1])
+        thread2 = self.make_thread("thread2", [None, 0, 1, 2])
+        compute_threads_order_and_depth([thread1.id, thread2.id])
+        self.assertEqual(
+            self.get_positions(thread1), [(0, 0), (1, 1), (3, 1), (2, 2)])
+        self.assertEqual(
+            self.get_positions(thread2), [(0, 0), (1, 1), (2, 2), (3, 3)])
+
+    def test_same_as_single_thread(self):
+        thread = self.make_thread(
+            "thread", [None, 0, 0, 2, 1, 3, 0, 4, 2, 5])
+        compute_thread_order_and_depth(thread)
+        expected = self.get_positions(thread)
+        Email.objects.update(thread_order=None, thread_depth=0)
+        compute_threads_order_and_depth([thread.id])
+        self.assertEqual(self.get_positions(thread), expected)
+
+    def test_reply_loops(self):
+        thread = self.make_thread("thread", [None, 0, 1])
+        emails = list(thread.emails.order_by("date"))
+        # The starting email replies to the last one.
+        Email.objects.filter(id=emails[0].id).update(parent=emails[2])
+        compute_threads_order_and_depth([thread.id])
+        self.assertEqual(
+            self.get_positions(thread), [(0, 0), (1, 1), (2, 2)])
+
+    def test_only_changed(self):
+        thread = self.make_thread("thread", [None, 0, 1])
+        compute_threads_order_and_depth([thread.id])
+        with CaptureQueriesContext(connection) as queries:
+            compute_threads_order_and_depth([thread.id])
+        self.assertFalse(any(
+            query["sql"].startswith("UPDATE") for query in queries))
+
+
+class TestEmailOrderDepth(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList.objects.create(name="example-list")
+        self.sender = Sender.objects.create(address="sender@example.com")
+        self.thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id="msg0")
+        self.date = now()
+        self.emails = []
+
+    def add_email(self, parent, minutes=None):
+        """Add an email without running the post-save hooks."""
+        if minutes is None:
+            minutes = len(self.emails)
+        num = len(self.emails)
+        email = Email(
+            id=num + 1, mailinglist=self.mlist, thread=self.thread,
+            message_id="msg%d" % num, sender=self.sender, subject="",
+            content="", date=self.date + timedelta(minutes=minutes),
+            timezone=0,
+            parent_id=None if parent is None else self.emails[parent].id)
+        Email.objects.bulk_create([email])
+        self.emails.append(email)
+        if parent is None:
+            self.thread.starting_email = email
+            self.thread.save()
+        return email
+
+    def get_positions(self):
+        return list(self.thread.emails.order_by("id").values_list(
+            "thread_order", "thread_depth"))
+
+    def assert_same_as_full(self):
+        positions = self.get_positions()
+        compute_thread_order_and_depth(self.thread)
+        self.assertEqual(positions, self.get_positions())
+
+    def test_insert(self):
+        # msg0
+        # |-msg1
+        # | `-msg3
+        # `-msg2
+        for parent in (None, 0, 0):
+            self.add_email(parent)
+        compute_thread_order_and_depth(self.thread)
+        email = self.add_email(1)
+        with CaptureQueriesContext(connection) as queries:
+            compute_email_order_and_depth(email)
+        updates = [query for query in queries
+                   if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual((email.thread_order, email.thread_depth), (2, 2))
+        self.assertEqual(
+            self.get_positions(), [(0, 0), (1, 1), (3, 1), (2, 2)])
+        self.assert_same_as_full()
+
+    def test_insert_between_siblings(self):
+        # The new reply is older than an existing reply to the same email.
+        for parent in (None, 0, 1, 0, 3):
+            self.add_email(parent)
+        compute_thread_order_and_depth(self.thread)
+        compute_email_order_and_depth(self.add_email(0, minutes=2))
+        self.assert_same_as_full()
+
+    def test_append(self):
+        for parent in (None, 0, 1, 2):
+            self.add_email(parent)
+        compute_thread_order_and_depth(self.thread)
+        email = self.add_email(3)
+        compute_email_order_and_depth(email)
+        self.assertEqual((email.thread_order, email.thread_depth), (4, 4))
+        self.assert_same_as_full()
+
+    def test_fallback(self):
+        # The rest of the thread has not been positioned yet.
+        for parent in (None, 0):
+            self.add_email(parent)
+        email = self.add_email(1)
+        compute_email_order_and_depth(email)
+        self.assertEqual(self.get_positions(), [(0, 0), (1, 1), (2, 2)])
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+import mailbox
+import os
+from email.message import EmailMessage
+
+from django.http import FileResponse
+from django.utils.timezone import now
+
+from hyperkitty.lib.archives import (
+    build_missing_month_archives, build_month_archive)
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models import Email, MailingList
+from hyperkitty.tests.utils import TestCase
+from hyperkitty.utils import reverse
+
+
+def _add_email(num, date, reply_to=None):
+    msg = EmailMessage()
+    msg["From"] = "dummy@example.com"
+    msg["Message-ID"] = "<msg%d>" % num
+    msg["Subject"] = "Message %d" % num
+    msg["Date"] = date
+    if reply_to is not None:
+        msg["In-Reply-To"] = "<msg%d>" % reply_to
+    msg.set_payload("Dummy message %d" % num)
+    add_to_list("list@example.com", msg)
+
+
+class MonthArchivesTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(self.tmpdir, "archives")
+        self._override_setting("HYPERKITTY_MBOX_ARCHIVES_FOLDER", self.folder)
+        _add_email(1, "Wed, 01 Jul 2020 12:00:00 +0000")
+        _add_email(2, "Fri, 31 Jul 2020 23:00:00 +0000", reply_to=1)
+        _add_email(3, "Sat, 01 Aug 2020 00:30:00 +0200")
+        self.mlist = MailingList.objects.get(name="list@example.com")
+        self.path = os.path.join(
+            self.folder, "example.com/list/2020-07.mbox.gz")
+        self.url = "%s?start=2020-07-01&end=2020-08-01" % reverse(
+            "hk_list_export_mbox", kwargs={
+                "mlist_fqdn": "list@example.com", "filename": "list-2020-07"})
+
+    def _get_message_ids(self, path):
+        with gzip.open(path) as archive:
+            mbox_path = os.path.join(self.tmpdir, "export.mbox")
+            with open(mbox_path, "wb") as mbox_file:
+                mbox_file.write(archive.read())
+        return [msg["Message-ID"] for msg in mailbox.mbox(mbox_path)]
+
+    def test_build(self):
+        os.remove(self.path)
+        self.assertEqual(
+            build_month_archive(self.mlist, 2020, 7),
+            "example.com/list/2020-07.mbox.gz")
+        # The third email was sent in July, but in another timezone.
+        self.assertEqual(
+            self._get_message_ids(self.path),
+            ["<msg1>", "<msg2>", "<msg3>"])
+
+    def test_rebuild_while_serving(self):
+        # The archive is replaced atomically, an ongoing download gets the
+        # whole previous file.
+        build_month_archive(self.mlist, 2020, 7)
+        with open(self.path, "rb") as archive:
+            content = archive.read()
+        response = self.client.get(self.url)
+        _add_email(4, "Thu, 02 Jul 2020 12:00:00 +0000")
+        self.assertEqual(
+            self._get_message_ids(self.path),
+            ["<msg1>", "<msg2>", "<msg3>", "<msg4>"])
+        self.assertEqual(response["Content-Length"], str(len(content)))
+        self.assertEqual(b"".join(response.streaming_content), content)
+        self.assertEqual(
+            os.listdir(os.path.dirname(self.path)), ["2020-07.mbox.gz"])
+
+    def test_build_current_month(self):
+        today = now()
+        self.assertIsNone(
+            build_month_archive(self.mlist, today.year, today.month))
+
+    def test_disabled(self):
+        self._override_setting("HYPERKITTY_MBOX_ARCHIVES_FOLDER", None)
+        self.assertIsNone(build_month_archive(self.mlist, 2020, 7))
+        response = self.client.get(self.url)
+        self.assertNotIsInstance(response, FileResponse)
+
+    def test_build_missing(self):
+        _add_email(4, "Mon, 02 Feb 2015 12:00:00 +0000")
+        build_missing_month_archives(self.mlist)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.folder, "example.com/list"))),
+            ["2015-02.mbox.gz", "2020-07.mbox.gz"])
+
+    def test_invalidate_on_delete(self):
+        build_month_archive(self.mlist, 2020, 7)
+        Email.objects.get(message_id="msg1").delete()
+        # It was rebuilt by the task.
+        self.assertEqual(
+            self._get_message_ids(self.path), ["<msg2>", "<msg3>"])
+
+    def test_invalidate_on_add(self):
+        build_month_archive(self.mlist, 2020, 7)
+        _add_email(4, "Thu, 02 Jul 2020 12:00:00 +0000")
+        self.assertEqual(
+            self._get_message_ids(self.path),
+            ["<msg1>", "<msg2>", "<msg3>", "<msg4>"])
+
+    def test_invalidate_on_reattach(self):
+        build_month_archive(self.mlist, 2020, 7)
+        os.utime(self.path, (0, 0))
+        email = Email.objects.get(message_id="msg3")
+        email.set_parent(Email.objects.get(message_id="msg1"))
+        self.assertNotEqual(os.path.getmtime(self.path), 0)
+
+    def test_export(self):
+        build_month_archive(self.mlist, 2020, 7)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="list-2020-07.mbox.gz"')
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertIn("ETag", response)
+        self.assertIn("Last-Modified", response)
+        with open(self.path, "rb") as archive:
+            content = archive.read()
+        self.assertEqual(response["Content-Length"], str(len(content)))
+        self.assertEqual(b"".join(response.streaming_content), content)
+
+    def test_export_not_built(self):
+        # The archive is built in the background, and the month is exported
+        # as usual in the meantime.
+        os.remove(self.path)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIsInstance(response, FileResponse)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_export_not_a_month(self):
+        build_month_archive(self.mlist, 2020, 7)
+        for query in ("start=2020-07-01&end=2020-07-15",
+                      "start=2020-07-01&end=2020-08-01&thread=dummy"):
+            response = self.client.get(
+                "%s?%s" % (self.url.split("?")[0], query))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIsInstance(response, FileResponse)
+
+    def test_export_not_modified(self):
+        build_month_archive(self.mlist, 2020, 7)
+        response = self.client.get(self.url)
+        response = self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_export_range(self):
+        build_month_archive(self.mlist, 2020, 7)
+        with open(self.path, "rb") as archive:
+            content = archive.read()
+        size = len(content)
+        for header, expected, content_range in (
+                ("bytes=10-19", content[10:20], "10-19"),
+                ("bytes=10-", content[10:], "10-%d" % (size - 1)),
+                ("bytes=-10", content[-10:], "%d-%d" % (size - 10, size - 1)),
+                ):
+            response = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(
+                response["Content-Range"],
+                "bytes %s/%d" % (content_range, size))
+            self.assertEqual(
+                response["Content-Length"], str(len(expected)))
+            self.assertEqual(b"".join(response.streaming_content), expected)
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=%d-" % size)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */%d" % size)
+        # Multiple ranges are not supported, send the whole file.
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-1,5-6")
+        self.assertEqual(response.status_code, 200)
+
+    def test_export_if_range(self):
+        build_month_archive(self.mlist, 2020, 7)
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        # The archive has changed.
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE='"dummy"')
+        self.assertEqual(response.status_code, 200)
@@ -27,14 +27,17 @@ from email.message import EmailMessage
 from email.policy import default
 
 from django.core.cache import cache
-from django.db import DataError, IntegrityError
+from django.db import DataError, IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 import mock
 
-from hyperkitty.lib.incoming import DuplicateMessage, add_to_list
+from hyperkitty.lib.incoming import (
+    DuplicateMessage, add_batch_to_list, add_to_list, parse_message)
 from hyperkitty.lib.utils import get_message_id_hash
-from hyperkitty.models import Attachment, Email, MailingList, Thread
+from hyperkitty.models import (
+    ArchivePolicy, Attachment, AttachmentBlob, Email, MailingList, Thread)
 from hyperkitty.tests.utils import TestCase, get_test_file
 
 
@@ -202,7 +205,7 @@ class TestAddToList(TestCase):
         except Exception as e:
             self.fail(e)
         self.assertEqual(Attachment.objects.count(), 1)
-        self.assertEqual(Attachment.objects.all()[0].content,
+        self.assertEqual(Attachment.objects.all()[0].get_content(),
                          b'All votes are reported in the form "*Y-N-A*" '
                          b'(*in favor-Y???opposed-N???abstentions-A*; e.g. '
                          b'"5-1-2" means "5 in favor, 1 opposed, and 2 '
@@ -220,10 +223,11 @@ class TestAddToList(TestCase):
         attachment = Attachment.objects.all().first()
         self.assertIsNone(attachment.content, None)
         self.assertEqual(attachment.size, 49)
+        sha256 = attachment.blob.sha256
         filepath = os.path.join(
-            attachment_folder, "example.com", "list", "E3", "YP", "52",
-            "1", "2",
-        )
+            attachment_folder, "blobs", sha256[:2], sha256[2:4], sha256)
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=attachment_folder):
+            self.assertEqual(attachment.get_path(), filepath)
         self.assertTrue(os.path.exists(filepath))
         self.assertEqual(os.path.getsize(filepath), 49)
 
@@ -237,18 +241,22 @@ class TestAddToList(TestCase):
         with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=attachment_folder):
             add_to_list("list.example.com", msg)
             add_to_list("list@local@example.com", msg)
-        email1 = Email.objects.filter(
-            mailinglist__name="list.example.com").first()
-        email2 = Email.objects.filter(
-            mailinglist__name="list@local@example.com").first()
-        self.assertTrue(os.path.exists(os.path.join(
-            attachment_folder, "list.example.com", "none", "E3", "YP", "52",
-            str(email1.id), "2",
-        )))
-        self.assertTrue(os.path.exists(os.path.join(
-            attachment_folder, "example.com", "list@local", "E3", "YP", "52",
-            str(email2.id), "2",
-        )))
+            self.assertEqual(Email.objects.count(), 2)
+            for attachment in Attachment.objects.all():
+                self.assertTrue(os.path.exists(attachment.get_path()))
+
+    def test_attachment_deduplication(self):
+        # The same content is stored once.
+        with open(get_test_file("attachment-1.txt")) as email_file:
+            msg = message_from_file(email_file, EmailMessage, policy=default)
+        attachment_folder = os.path.join(self.tmpdir, "attachments")
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=attachment_folder):
+            add_to_list("list@example.com", msg)
+            add_to_list("list2@example.com", msg)
+            blob = AttachmentBlob.objects.get()
+            self.assertEqual(os.path.getsize(blob.get_path()), 49)
+        self.assertEqual(Attachment.objects.count(), 2)
+        self.assertEqual(blob.attachments.count(), 2)
 
     def test_thread_neighbors(self):
         # Create 3 threads
@@ -555,3 +563,176 @@ class TestAddToList(TestCase):
             filter_mock.exists.return_value = False
             Email.objects.filter.return_value = filter_mock
             self.assertRaises(ValueError, add_to_list, "example-list", msg)
+
+
+class TestAddBatchToList(TestCase):
+
+    def _make_message(self, msg_id, in_reply_to=None,
+                      date="Fri, 02 Nov 2012 16:07:54"):
+        msg = EmailMessage()
+        msg["From"] = "Dummy Sender <dummy@example.com>"
+        msg["Subject"] = "Fake Subject"
+        msg["Message-ID"] = "<%s>" % msg_id
+        msg["Date"] = date
+        if in_reply_to is not None:
+            msg["In-Reply-To"] = "<%s>" % in_reply_to
+        msg.set_payload("Fake Message")
+        return msg
+
+    def test_basic(self):
+        batch = [parse_message(self._make_message("msg%d" % i))
+                 for i in range(3)]
+        emails, failures = add_batch_to_list("example-list", batch)
+        self.assertEqual(len(emails), 3)
+        self.assertEqual(failures, [])
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertEqual(Thread.objects.count(), 3)
+        email = Email.objects.get(message_id="msg0")
+        self.assertEqual(email.sender_id, "dummy@example.com")
+        self.assertEqual(email.sender_name, "Dummy Sender")
+        self.assertEqual(email.subject, "Fake Subject")
+        self.assertIsNone(email.parent_id)
+        self.assertEqual(email.thread.thread_id, email.message_id_hash)
+        self.assertEqual(email.thread.starting_email, email)
+        self.assertEqual(email.thread.date_active, email.date)
+
+    def test_threading(self):
+        # Replies are attached to parents in the database and in the batch.
+        add_to_list("example-list", self._make_message("msg1"))
+        batch = [parse_message(m) for m in [
+            self._make_message(
+                "msg2", "msg1", date="Sat, 03 Nov 2012 16:07:54"),
+            self._make_message("msg3"),
+            self._make_message(
+                "msg4", "msg3", date="Sun, 04 Nov 2012 16:07:54"),
+            self._make_message("msg5", "msg4"),
+            ]]
+        emails, failures = add_batch_to_list("example-list", batch)
+        self.assertEqual(len(emails), 4)
+        self.assertEqual(failures, [])
+        self.assertEqual(Thread.objects.count(), 2)
+        msg1, msg2, msg3, msg4, msg5 = [
+            Email.objects.get(message_id="msg%d" % i) for i in range(1, 6)]
+        self.assertEqual(msg2.parent_id, msg1.id)
+        self.assertEqual(msg2.thread_id, msg1.thread_id)
+        self.assertEqual(msg1.thread.date_active, msg2.date)
+        self.assertIsNone(msg3.parent_id)
+        self.assertEqual(msg4.parent_id, msg3.id)
+        self.assertEqual(msg5.parent_id, msg4.id)
+        self.assertEqual(msg5.thread_id, msg3.thread_id)
+        self.assertEqual(msg3.thread.starting_email, msg3)
+        self.assertEqual(msg3.thread.date_active, msg4.date)
+
+    def test_thread_counts(self):
+        add_to_list("example-list", self._make_message("msg1"))
+        batch = [parse_message(m) for m in [
+            self._make_message("msg2", "msg1"),
+            self._make_message("msg3"),
+            self._make_message("msg4", "msg3"),
+            ]]
+        add_batch_to_list("example-list", batch)
+        for msg_id in ("msg1", "msg3"):
+            thread = Email.objects.get(message_id=msg_id).thread
+            self.assertEqual(thread.emails_count, 2)
+            self.assertEqual(thread.participants_count, 1)
+
+    def test_duplicate(self):
+        add_to_list("example-list", self._make_message("msg1"))
+        batch = [parse_message(m) for m in [
+            self._make_message("msg1"),
+            self._make_message("msg2"),
+            self._make_message("msg2"),
+            ]]
+        emails, failures = add_batch_to_list("example-list", batch)
+        self.assertEqual([e.message_id for e in emails], ["msg2"])
+        self.assertEqual(len(failures), 2)
+        for parsed, error in failures:
+            self.assertIsInstance(error, DuplicateMessage)
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_existing_thread(self):
+        # A thread with the same thread_id already exists.
+        mlist = MailingList.objects.create(name="example-list")
+        thread = Thread.objects.create(
+            mailinglist=mlist, thread_id=get_message_id_hash("msg1"))
+        batch = [parse_message(m) for m in [
+            self._make_message("msg1"),
+            self._make_message("msg2", "msg1"),
+            ]]
+        emails, failures = add_batch_to_list("example-list", batch)
+        self.assertEqual(len(emails), 2)
+        self.assertEqual(failures, [])
+        self.assertEqual(thread.emails.count(), 2)
+        self.assertEqual(
+            Email.objects.get(message_id="msg2").parent.message_id, "msg1")
+
+    def test_attachments(self):
+        with open(get_test_file("attachment-1.txt")) as email_file:
+            msg = message_from_file(email_file, EmailMessage, policy=default)
+        emails, failures = add_batch_to_list(
+            "example-list", [parse_message(msg)])
+        self.assertEqual(failures, [])
+        email = Email.objects.get(id=emails[0].id)
+        self.assertEqual(email.attachments.count(), 1)
+        attachment = email.attachments.get()
+        self.assertEqual(attachment.size, len(attachment.get_content()))
+
+    def test_attachments_queries(self):
+        # The blobs of a batch are stored with a fixed number of queries.
+        AttachmentBlob.store(b"Existing content\n")
+        batch = []
+        for num in range(5):
+            msg = self._make_message("msg%d" % num)
+            msg.make_mixed()
+            msg.add_attachment("Existing content", subtype="plain")
+            msg.add_attachment("Shared content", subtype="plain")
+            msg.add_attachment("Content %d" % num, subtype="plain")
+            batch.append(parse_message(msg))
+        with CaptureQueriesContext(connection) as queries:
+            emails, failures = add_batch_to_list("example-list", batch)
+        self.assertEqual(failures, [])
+        self.assertEqual(len([
+            q for q in queries.captured_queries
+            if "hyperkitty_attachmentblob" in q["sql"]]), 3)
+        self.assertEqual(Attachment.objects.count(), 15)
+        self.assertEqual(AttachmentBlob.objects.count(), 7)
+        self.assertEqual(
+            sorted(att.get_content() for att in Attachment.objects.filter(
+                email__message_id="msg3")),
+            [b"Content 3\n", b"Existing content\n", b"Shared content\n"])
+
+    def test_database_error(self):
+        # When the bulk insert fails, the emails are stored one by one.
+        batch = [parse_message(self._make_message("msg%d" % i))
+                 for i in range(2)]
+        with mock.patch("hyperkitty.lib.incoming._store_batch") as sb:
+            sb.side_effect = DataError("test error")
+            emails, failures = add_batch_to_list("example-list", batch)
+        self.assertEqual(len(emails), 2)
+        self.assertEqual(failures, [])
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_database_error_mid_batch(self):
+        # The emails and threads inserted before the error are rolled back.
+        batch = [parse_message(self._make_message("msg1")),
+                 parse_message(self._make_message("msg2", "msg1")),
+                 parse_message(self._make_message("msg3"))]
+        with mock.patch("hyperkitty.lib.incoming.Attachment.objects."
+                        "bulk_create") as bulk_create:
+            bulk_create.side_effect = DataError("test error")
+            emails, failures = add_batch_to_list("example-list", batch)
+        self.assertEqual(failures, [])
+        self.assertEqual(len(emails), 3)
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertEqual(Thread.objects.count(), 2)
+        reply = Email.objects.get(message_id="msg2")
+        self.assertEqual(reply.parent.message_id, "msg1")
+        self.assertEqual(reply.thread.starting_email.message_id, "msg1")
+
+    def test_archive_policy_never(self):
+        MailingList.objects.create(
+            name="example-list", archive_policy=ArchivePolicy.never.value)
+        emails, failures = add_batch_to_list(
+            "example-list", [parse_message(self._make_message("msg1"))])
+        self.assertEqual(emails, [])
+        self.assertEqual(Email.objects.count(), 0)
@@ -23,8 +23,10 @@
 from urllib.error import HTTPError
 
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
 from django.core.cache import cache
 
+from django_mailman3.models import MailDomain
 from django_mailman3.tests.utils import FakeMMList, FakeMMPage
 from mock import Mock, patch
 
@@ -231,3 +233,37 @@ class MailmanSyncTestCase(TestCase):
             self.mailman_client.get_list.call_args_list[0][0],
             ("list.example.com", ))
         self.assertEqual(update_from_mailman.call_count, 1)
+
+
+class MailDomainsTestCase(TestCase):
+
+    def setUp(self):
+        self.site = Site.objects.create(domain="www.example.com", name="www")
+        MailDomain.objects.create(site=self.site, mail_domain="example.com")
+
+    def test_get_mail_domains(self):
+        self.assertEqual(
+            mailman.get_mail_domains(), {"example.com": "www.example.com"})
+        # The map is cached.
+        with self.assertNumQueries(0):
+            mailman.get_mail_domains()
+
+    def test_invalidate_on_mail_domain_change(self):
+        mailman.get_mail_domains()
+        mail_domain = MailDomain.objects.create(
+            site=self.site, mail_domain="lists.example.com")
+        self.assertEqual(mailman.get_mail_domains(), {
+            "example.com": "www.example.com",
+            "lists.example.com": "www.example.com",
+            })
+        mail_domain.delete()
+        self.assertEqual(
+            mailman.get_mail_domains(), {"example.com": "www.example.com"})
+
+    def test_invalidate_on_site_change(self):
+        mailman.get_mail_domains()
+        self.site.domain = "archives.example.com"
+        self.site.save()
+        self.assertEqual(
+            mailman.get_mail_domains(),
+            {"example.com": "archives.example.com"})
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+import mailbox
+import os
+from email.message import EmailMessage
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.mbox import MboxReader, gzip_stream, iter_mbox
+from hyperkitty.models import Email
+from hyperkitty.tests.utils import TestCase
+
+
+MBOX = (
+    b"Junk before the first message\n"
+    b"From dummy@example.com Mon Jan  1 12:00:00 2015\n"
+    b"Message-ID: <msg1>\n"
+    b"\n"
+    b"First message\n"
+    b"\n"
+    b"From dummy@example.com Tue Jan  2 12:00:00 2015\n"
+    b"Message-ID: <msg2>\n"
+    b"\n"
+    b"Second message, no blank line after it\n"
+    b"From dummy@example.com Wed Jan  3 12:00:00 2015\n"
+    b"Message-ID: <msg3>\n"
+    b"\n"
+    b"Third message\n"
+    b"\n"
+)
+
+
+class MboxReaderTestCase(TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.tmpdir, "test.mbox")
+        with open(self.path, "wb") as f:
+            f.write(MBOX)
+        with gzip.open(self.path + ".gz", "wb") as f:
+            f.write(MBOX)
+
+    def _read(self, path, start=0):
+        with MboxReader(path, start) as reader:
+            return [(m.unixfrom, m.content, m.end) for m in reader]
+
+    def test_same_as_mailbox(self):
+        mbox = mailbox.mbox(self.path)
+        expected = [
+            (msg.get_from(), msg.as_bytes(unixfrom=False))
+            for msg in mbox
+            ]
+        mbox.close()
+        messages = self._read(self.path)
+        self.assertEqual(len(messages), 3)
+        self.assertEqual([m[:2] for m in messages], expected)
+        self.assertEqual(messages[-1][2], len(MBOX) - 1)
+
+    def test_gzip(self):
+        self.assertEqual(
+            self._read(self.path + ".gz"), self._read(self.path))
+
+    def test_position(self):
+        with MboxReader(self.path) as reader:
+            self.assertEqual(reader.size, len(MBOX))
+            self.assertFalse(reader.compressed)
+            positions = [m.position for m in reader]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(positions[-1], len(MBOX) - 1)
+        with MboxReader(self.path + ".gz") as reader:
+            self.assertTrue(reader.compressed)
+            self.assertEqual(
+                [m.position for m in reader][-1], reader.size)
+
+    def test_start(self):
+        messages = self._read(self.path)
+        for index, message in enumerate(messages):
+            self.assertEqual(
+                self._read(self.path, message[2]), messages[index + 1:])
+            self.assertEqual(
+                self._read(self.path + ".gz", message[2]),
+                messages[index + 1:])
+
+    def test_empty(self):
+        open(self.path, "wb").close()
+        self.assertEqual(self._read(self.path), [])
+
+
+class MboxWriterTestCase(TestCase):
+
+    def setUp(self):
+        for num in range(5):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Message %d" % num
+            msg.set_content("Message %d" % num)
+            msg.add_attachment(
+                b"attached %d" % num, maintype="application",
+                subtype="octet-stream", filename="file%d.bin" % num)
+            add_to_list("list@example.com", msg)
+
+    def _read_mbox(self, data):
+        path = os.path.join(self.tmpdir, "export.mbox")
+        with open(path, "wb") as f:
+            f.write(data)
+        return mailbox.mbox(path)
+
+    def test_iter_mbox(self):
+        mbox = self._read_mbox(b"".join(iter_mbox(Email.objects.all())))
+        self.assertEqual(
+            [msg["Message-ID"] for msg in mbox],
+            ["<msg%d>" % num for num in range(5)])
+        attachment = mbox.values()[0].get_payload()[1]
+        self.assertEqual(attachment.get_filename(), "file0.bin")
+        self.assertEqual(attachment.get_payload(decode=True), b"attached 0")
+
+    def test_queries(self):
+        # The ids, then the emails and their attachments for each chunk.
+        with self.assertNumQueries(1 + 3 * 2):
+            self.assertEqual(
+                len(list(iter_mbox(Email.objects.all(), chunk_size=2))), 5)
+
+    def test_gzip_stream(self):
+        chunks = [b"chunk %d\n" % num for num in range(100)]
+        expected = b"".join(chunks)
+        self.assertEqual(
+            gzip.decompress(b"".join(gzip_stream(chunks))), expected)
+        self.assertEqual(
+            gzip.decompress(b"".join(gzip_stream(chunks, threaded=True))),
+            expected)
+
+    def test_gzip_stream_threaded_error(self):
+        self.assertRaises(
+            TypeError, list, gzip_stream([b"bytes", "not bytes"], True))
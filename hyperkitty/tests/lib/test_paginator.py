@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+from email.message import EmailMessage
+
+from django.test import override_settings
+from django.utils.timezone import utc
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.paginator import (
+    InvalidCursor, cursor_paginate, decode_cursor, encode_cursor)
+from hyperkitty.models import Email, Sender, Thread
+from hyperkitty.tests.utils import TestCase
+from hyperkitty.utils import reverse
+
+
+class CursorPaginateTestCase(TestCase):
+
+    def setUp(self):
+        for num in range(7):
+            msg = EmailMessage()
+            msg["From"] = "sender@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg["Subject"] = "Message %d" % num
+            msg["Date"] = "%02d Jul 2020 12:00:00 +0000" % (num + 1)
+            msg.set_payload("message %d" % num)
+            add_to_list("list@example.com", msg)
+        # Some threads were active at the same time.
+        Thread.objects.filter(
+            starting_email__message_id__in=["msg2", "msg3", "msg4"],
+            ).update(date_active=datetime(2020, 7, 3, tzinfo=utc))
+        self.threads = Thread.objects.all()
+        self.expected = list(self.threads.order_by("-date_active", "-id"))
+
+    def test_cursor(self):
+        thread = self.threads.first()
+        ordering = ("-date_active", "-id")
+        cursor = encode_cursor(thread, ordering)
+        self.assertNotIn("date_active", cursor)
+        self.assertEqual(
+            decode_cursor(cursor, Thread, ordering),
+            ([thread.date_active, thread.id], False))
+
+    def test_invalid_cursor(self):
+        ordering = ("-date_active", "-id")
+        for cursor in ("dummy", "e30", encode_cursor(
+                self.threads.first(), ("-date_active", ))):
+            self.assertRaises(
+                InvalidCursor, cursor_paginate, self.threads, cursor, 3,
+                ordering)
+
+    def test_forward(self):
+        page = cursor_paginate(self.threads, None, 3)
+        self.assertEqual(list(page), self.expected[:3])
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+        self.assertIsNone(page.previous_cursor)
+        page = cursor_paginate(self.threads, page.next_cursor, 3)
+        self.assertEqual(list(page), self.expected[3:6])
+        self.assertTrue(page.has_next())
+        self.assertTrue(page.has_previous())
+        page = cursor_paginate(self.threads, page.next_cursor, 3)
+        self.assertEqual(list(page), self.expected[6:])
+        self.assertFalse(page.has_next())
+        self.assertIsNone(page.next_cursor)
+
+    def test_backward(self):
+        page = cursor_paginate(self.threads, None, 3)
+        page = cursor_paginate(self.threads, page.next_cursor, 3)
+        page = cursor_paginate(self.threads, page.previous_cursor, 3)
+        self.assertEqual(list(page), self.expected[:3])
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+
+    def test_ascending(self):
+        ordering = ("date_active", "id")
+        expected = list(reversed(self.expected))
+        page = cursor_paginate(self.threads, None, 4, ordering)
+        self.assertEqual(list(page), expected[:4])
+        page = cursor_paginate(self.threads, page.next_cursor, 4, ordering)
+        self.assertEqual(list(page), expected[4:])
+
+    def test_queries(self):
+        # One query, whatever the page.
+        page = cursor_paginate(self.threads, None, 3)
+        with self.assertNumQueries(1):
+            page = cursor_paginate(self.threads, page.next_cursor, 3)
+            list(page)
+
+    def test_archives(self):
+        url = reverse('hk_archives_latest', args=["list@example.com"])
+        response = self.client.get(url, {"cursor": "", "count": 3})
+        self.assertEqual(response.status_code, 200)
+        threads = response.context["threads"]
+        self.assertEqual(list(threads), self.expected[:3])
+        self.assertContains(response, "cursor=%s" % threads.next_cursor)
+        response = self.client.get(
+            url, {"cursor": threads.next_cursor, "count": 3})
+        self.assertEqual(
+            list(response.context["threads"]), self.expected[3:6])
+        response = self.client.get(url, {"cursor": "dummy"})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(HYPERKITTY_CURSOR_PAGINATION=True)
+    def test_archives_setting(self):
+        response = self.client.get(reverse(
+            'hk_archives_latest', args=["list@example.com"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["threads"].cursor_pagination)
+        self.assertNotContains(response, "page=2")
+
+    def test_api(self):
+        url = reverse('hk_api_thread_list', args=["list@example.com"])
+        response = self.client.get(url, {"cursor": "", "limit": 4})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [t["thread_id"] for t in response.data["results"]],
+            [t.thread_id for t in self.expected[:4]])
+        self.assertIsNone(response.data["previous"])
+        response = self.client.get(response.data["next"])
+        self.assertEqual(
+            [t["thread_id"] for t in response.data["results"]],
+            [t.thread_id for t in self.expected[4:]])
+        self.assertIsNone(response.data["next"])
+        self.assertIsNotNone(response.data["previous"])
+        response = self.client.get(url, {"cursor": "dummy"})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(HYPERKITTY_CURSOR_PAGINATION=True)
+    def test_posts(self):
+        # The posts of a user are in chronological order.
+        Email.objects.update(sender_id="sender@example.com")
+        Sender.objects.filter(address="sender@example.com").update(
+            mailman_id="dummy_user_id")
+        expected = list(Email.objects.order_by("date", "id"))
+        url = reverse("hk_user_posts", args=("dummy_user_id",))
+        params = {"list": "list@example.com", "count": 3}
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        emails = response.context["emails"]
+        self.assertEqual(list(emails), expected[:3])
+        self.assertContains(response, "Newer &rarr;")
+        self.assertNotContains(response, "Older &rarr;")
+        response = self.client.get(
+            url, dict(params, cursor=emails.next_cursor))
+        emails = response.context["emails"]
+        self.assertEqual(list(emails), expected[3:6])
+        self.assertTrue(emails.has_previous())
+        # Back to the first page.
+        response = self.client.get(
+            url, dict(params, cursor=emails.previous_cursor))
+        emails = response.context["emails"]
+        self.assertEqual(list(emails), expected[:3])
+        self.assertTrue(emails.has_next())
+        self.assertFalse(emails.has_previous())
+        self.assertIsNone(emails.previous_cursor)
@@ -21,10 +21,16 @@
 #
 
 import datetime
+from email.message import EmailMessage
 
+from django.contrib.auth.models import AnonymousUser, User
 from django.utils.timezone import utc
 
-from hyperkitty.lib.view_helpers import get_display_dates
+from mock import Mock
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.lib.view_helpers import get_display_dates, set_user_votes
+from hyperkitty.models import Email
 from hyperkitty.tests.utils import TestCase
 
 
@@ -48,3 +54,46 @@ class GetDisplayDatesTestCase(TestCase):
         begin_date, end_date = get_display_dates('2012', '4', '2')
         self.assertEqual(begin_date, datetime.datetime(2012, 4, 2, tzinfo=utc))
         self.assertEqual(end_date, datetime.datetime(2012, 4, 3, tzinfo=utc))
+
+
+class SetUserVotesTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            'testuser', 'user@example.com', 'testPass')
+        for num in range(3):
+            msg = EmailMessage()
+            msg["From"] = "sender@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("message %d" % num)
+            add_to_list("list@example.com", msg)
+        self.emails = list(Email.objects.order_by("message_id"))
+        self.emails[0].vote(1, self.user)
+        self.emails[2].vote(-1, self.user)
+
+    def test_votes(self):
+        with self.assertNumQueries(1):
+            set_user_votes(self.emails, self.user)
+        self.assertEqual(self.emails[0].myvote.value, 1)
+        self.assertIsNone(self.emails[1].myvote)
+        self.assertEqual(self.emails[2].myvote.value, -1)
+
+    def test_other_user(self):
+        other = User.objects.create_user(
+            'otheruser', 'other@example.com', 'testPass')
+        set_user_votes(self.emails, other)
+        for email in self.emails:
+            self.assertIsNone(email.myvote)
+
+    def test_anonymous(self):
+        with self.assertNumQueries(0):
+            set_user_votes(self.emails, AnonymousUser())
+        for email in self.emails:
+            self.assertIsNone(email.myvote)
+
+    def test_search_results(self):
+        # Search results have a string primary key.
+        results = [Mock(pk=str(email.pk)) for email in self.emails]
+        set_user_votes(results, self.user)
+        self.assertEqual(results[0].myvote.value, 1)
+        self.assertIsNone(results[1].myvote)
@@ -26,8 +26,11 @@ from datetime import datetime
 from email.message import EmailMessage
 from mimetypes import guess_all_extensions
 
+from mock import patch
+
 from hyperkitty.lib.incoming import add_to_list
-from hyperkitty.models import Email, MailingList, Sender, Thread
+from hyperkitty.models import (
+    Attachment, AttachmentBlob, Email, MailingList, Sender, Thread)
 from hyperkitty.tests.utils import TestCase
 
 
@@ -121,20 +124,19 @@ class EmailTestCase(TestCase):
         with tempfile.TemporaryDirectory() as tmpdir:
             with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=tmpdir):
                 self.test_as_message_attachments()
-                # Test that attachments are indeed saved on the fs.  The
-                # download path is deterministic and is based on the
-                # email.message_id_hash which is going to be consistent because
-                # we set the Message-ID in the test case above.  Name of the
-                # attachment files are also deterministic since we know the
-                # order in which they are added.
-                download_path = os.path.join(
-                    tmpdir, 'example.com/list/DH/ZU/5Y/1')
-                files = sorted(os.listdir(download_path))
-                self.assertEqual(len(files), 2)
-                self.assertEqual(files, ['2', '3'])
-                with open(os.path.join(download_path, '2')) as fd:
+                # Test that attachments are indeed saved on the fs, in
+                # files named after the hash of their content.
+                for attachment in Attachment.objects.order_by("counter"):
+                    sha256 = attachment.blob.sha256
+                    self.assertEqual(
+                        attachment.get_path(), os.path.join(
+                            tmpdir, "blobs", sha256[:2], sha256[2:4], sha256))
+                    self.assertIsNone(attachment.blob.content)
+                with open(Attachment.objects.get(
+                        counter=2).get_path()) as fd:
                     self.assertEqual(fd.read(), "Dummy message\n")
-                with open(os.path.join(download_path, '3')) as fd:
+                with open(Attachment.objects.get(
+                        counter=3).get_path()) as fd:
                     self.assertEqual(
                         fd.read(),
                         "<html><body>Dummy message</body></html>\n")
@@ -253,3 +255,90 @@ class EmailDeleteTestCase(TestCase):
         email2.delete()
         email3.refresh_from_db()
         self.assertEqual(email3.parent_id, email1.id)
+
+
+class AttachmentBlobTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = os.path.join(self.tmpdir, "attachments")
+        for num in range(2):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_content("Hello World.")
+            msg.add_attachment("Shared content", subtype="plain")
+            msg.add_attachment("Content %d" % num, subtype="plain")
+            with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.folder):
+                add_to_list("list@example.com", msg)
+
+    def test_store(self):
+        self.assertEqual(Attachment.objects.count(), 4)
+        self.assertEqual(AttachmentBlob.objects.count(), 3)
+        blob = AttachmentBlob.store(b"Shared content\n")
+        self.assertEqual(blob.attachments.count(), 2)
+        self.assertEqual(blob.size, 15)
+        self.assertEqual(AttachmentBlob.objects.count(), 3)
+
+    def test_store_database(self):
+        blob = AttachmentBlob.store(b"Other content")
+        self.assertIsNone(blob.get_path())
+        self.assertEqual(bytes(blob.content), b"Other content")
+        with blob.open() as f:
+            self.assertEqual(f.read(), b"Other content")
+
+    def test_delete_email(self):
+        shared = Attachment.objects.get(
+            email__message_id="msg0", counter=2).blob
+        own = Attachment.objects.get(
+            email__message_id="msg0", counter=3).blob
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.folder), \
+                patch("hyperkitty.models.email.transaction.on_commit",
+                      lambda func: func()):
+            own_path = own.get_path()
+            Email.objects.get(message_id="msg0").delete()
+        # The shared content is kept, the other one is deleted.
+        self.assertTrue(AttachmentBlob.objects.filter(id=shared.id).exists())
+        self.assertFalse(AttachmentBlob.objects.filter(id=own.id).exists())
+        self.assertFalse(os.path.exists(own_path))
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.folder):
+            self.assertTrue(os.path.exists(shared.get_path()))
+
+    def test_store_while_deleting(self):
+        # The same content is stored again while its blob is being deleted.
+        own = Attachment.objects.get(
+            email__message_id="msg0", counter=3).blob
+        on_commit = []
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=self.folder), \
+                patch("hyperkitty.models.email.transaction.on_commit",
+                      on_commit.append):
+            path = own.get_path()
+            Email.objects.get(message_id="msg0").delete()
+            self.assertFalse(AttachmentBlob.objects.filter(
+                id=own.id).exists())
+            blob = AttachmentBlob.store(b"Content 0\n")
+            remove_file, check_file = on_commit
+            # The file of the deleted blob is kept for the new one.
+            remove_file()
+            self.assertTrue(os.path.exists(path))
+            # And it is written again if it was removed before the commit.
+            os.remove(path)
+            check_file()
+            with blob.open() as f:
+                self.assertEqual(f.read(), b"Content 0\n")
+
+    def test_delete_unused(self):
+        AttachmentBlob.objects.create(sha256="dummy", size=0, content=b"")
+        self.assertEqual(AttachmentBlob.delete_unused(), 1)
+        self.assertEqual(AttachmentBlob.objects.count(), 3)
+
+    def test_deferred_content(self):
+        # The content is only loaded when it is accessed.
+        attachment = Attachment.objects.first()
+        self.assertIn("content", attachment.get_deferred_fields())
+        email = Email.objects.get(message_id="msg0")
+        self.assertIn(
+            "content", email.attachments.first().get_deferred_fields())
+        self.assertIn(
+            "content", AttachmentBlob.objects.first().get_deferred_fields())
+        with self.assertNumQueries(1):
+            attachment.save()
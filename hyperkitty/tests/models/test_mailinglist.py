@@ -23,10 +23,12 @@
 from datetime import date, datetime, timedelta
 from email.message import EmailMessage
 from random import shuffle
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from django.contrib.auth.models import User
-from django.utils.timezone import utc
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils.timezone import now, utc
 
 from allauth.account.models import EmailAddress
 from django_mailman3.tests.utils import FakeMMList
@@ -34,7 +36,8 @@ from django_mailman3.tests.utils import FakeMMList
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import ArchivePolicy, MailingList, Thread
 from hyperkitty.models.mailinglist import (
-    FirstDate, PopularThreads, RecentThreads, TopThreads)
+    FirstDate, PopularThreads, RecentThreads, TopPosters, TopThreads)
+from hyperkitty.models.stats import update_daily_stats
 from hyperkitty.tests.utils import TestCase
 
 
@@ -239,6 +242,30 @@ class RecentThreadsTestCase(TestCase):
             ["msg%d" % i for i in range(1, 21)]
             )
 
+    def test_single_query(self):
+        for i in range(3):
+            msg = EmailMessage()
+            msg["From"] = "sender@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg.set_payload("message %d" % i)
+            add_to_list(self.ml.name, msg)
+        self.cached_value.rebuild()
+        with self.assertNumQueries(1):
+            threads = self.cached_value()
+            self.assertEqual(
+                sorted(t.starting_email.sender.address for t in threads),
+                ["sender@example.com"] * 3)
+
+    def test_deleted_thread(self):
+        msg = EmailMessage()
+        msg["From"] = "sender@example.com"
+        msg["Message-ID"] = "<msg1>"
+        msg.set_payload("message 1")
+        add_to_list(self.ml.name, msg)
+        self.cached_value.rebuild()
+        Thread.objects.all().delete()
+        self.assertEqual(self.cached_value(), [])
+
 
 class TopThreadsTestCase(TestCase):
 
@@ -331,3 +358,139 @@ class FirstDateTestCase(TestCase):
             msg.set_payload("message %d" % i)
             add_to_list(self.ml.name, msg)
         self.assertEqual(self.cached_value(), today - timedelta(days=20))
+
+
+class StaleCachedValueTestCase(TestCase):
+
+    def setUp(self):
+        self.ml = MailingList.objects.create(name="list@example.com")
+        self.cached_value = TopPosters(self.ml)
+
+    def _add_email(self, num):
+        msg = EmailMessage()
+        msg["From"] = "sender%d@example.com" % num
+        msg["Message-ID"] = "<msg%d>" % num
+        msg.set_payload("message %d" % num)
+        add_to_list(self.ml.name, msg)
+
+    def test_stale_value_served(self):
+        # A stale value is returned while a single task rebuilds it.
+        self._add_email(1)
+        cache.set(self.cached_value._get_cache_key(), ["stale"])
+        cache.delete(self.cached_value._get_fresh_key())
+        with patch("hyperkitty.tasks.rebuild_cached_value") as mock_rebuild:
+            self.assertEqual(self.cached_value(), ["stale"])
+            self.assertEqual(self.cached_value(), ["stale"])
+        mock_rebuild.assert_called_once_with(
+            "hyperkitty.MailingList", self.ml.pk, "top_posters")
+
+    def test_stale_value_rebuilt(self):
+        self._add_email(1)
+        cache.set(self.cached_value._get_cache_key(), ["stale"])
+        cache.delete(self.cached_value._get_fresh_key())
+        # The task runs synchronously in the tests.
+        self.assertEqual(self.cached_value(), ["stale"])
+        self.assertEqual(len(self.cached_value()), 1)
+        self.assertTrue(cache.get(self.cached_value._get_fresh_key()))
+        self.assertIsNone(cache.get(self.cached_value._get_refresh_key()))
+
+    def test_fresh_value(self):
+        self.cached_value.rebuild()
+        with patch("hyperkitty.tasks.rebuild_cached_value") as mock_rebuild:
+            self.cached_value()
+        self.assertFalse(mock_rebuild.called)
+
+    def test_missing_value_locked(self):
+        # Another worker is building the value: wait for it.
+        cache.add(self.cached_value._get_lock_key(), True)
+
+        def other_worker(delay):
+            cache.set(self.cached_value._get_cache_key(), ["built"])
+        with patch("hyperkitty.models.common.time.sleep") as mock_sleep, \
+                patch.object(self.cached_value, "get_value") as get_value:
+            mock_sleep.side_effect = other_worker
+            self.assertEqual(self.cached_value(), ["built"])
+        self.assertFalse(get_value.called)
+
+    def test_missing_value_while_refreshing(self):
+        # A pending background refresh does not make the missing value wait.
+        cache.add(self.cached_value._get_refresh_key(), True)
+        with patch("hyperkitty.models.common.time.sleep") as mock_sleep, \
+                patch.object(self.cached_value, "get_value") as get_value:
+            get_value.return_value = ["built"]
+            self.assertEqual(self.cached_value(), ["built"])
+        self.assertFalse(mock_sleep.called)
+        self.assertIsNone(cache.get(self.cached_value._get_lock_key()))
+
+    def test_missing_value_lock_expired(self):
+        # Don't wait forever if the other worker does not store the value.
+        cache.add(self.cached_value._get_lock_key(), True)
+        self.cached_value.lock_wait = 0
+        with patch.object(self.cached_value, "get_value") as get_value:
+            get_value.return_value = ["built"]
+            self.assertEqual(self.cached_value(), ["built"])
+        self.assertTrue(get_value.called)
+
+
+class TopPostersTestCase(TestCase):
+
+    def setUp(self):
+        self.ml = MailingList.objects.create(name="list@example.com")
+        self.cached_value = TopPosters(self.ml)
+
+    def _add_email(self, num, sender, days_ago=0):
+        msg = EmailMessage()
+        msg["From"] = "%s@example.com" % sender
+        msg["Message-ID"] = "<msg%d>" % num
+        msg["Date"] = (now() - timedelta(days=days_ago)).strftime(
+            "%a, %d %b %Y %H:%M:%S +0000")
+        msg.set_payload("message %d" % num)
+        add_to_list(self.ml.name, msg)
+
+    def _get_posters(self):
+        return [(p["address"], p["count"]) for p in self.cached_value()]
+
+    def test_recent_values(self):
+        self._add_email(1, "sender1")
+        self._add_email(2, "sender1", days_ago=3)
+        self._add_email(3, "sender2", days_ago=10)
+        self._add_email(4, "sender3", days_ago=40)
+        self.assertEqual(self.ml.recent_participants_count, 2)
+        self.assertEqual(self._get_posters(), [
+            ("sender1@example.com", 2), ("sender2@example.com", 1)])
+        self.assertEqual(
+            self.cached_value()[0]["name"], "sender1@example.com")
+
+    def test_incremental(self):
+        # Only the day of the new email is counted again.
+        self._add_email(1, "sender1")
+        self._add_email(2, "sender2", days_ago=10)
+        with patch("hyperkitty.tasks.update_daily_stats",
+                   side_effect=update_daily_stats) as mock_update:
+            self._add_email(3, "sender2", days_ago=3)
+        mock_update.assert_called_once_with(
+            self.ml, (now() - timedelta(days=3)).astimezone(utc).date())
+        self.assertEqual(self.ml.recent_participants_count, 2)
+        self.assertEqual(self._get_posters(), [
+            ("sender2@example.com", 2), ("sender1@example.com", 1)])
+
+    def test_single_query(self):
+        for num in range(10):
+            self._add_email(num, "sender%d" % (num % 3), days_ago=num)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.cached_value.get_value()), 3)
+
+    @override_settings(HYPERKITTY_TOP_POSTERS_COUNT=2)
+    def test_count(self):
+        for num in range(6):
+            self._add_email(num, "sender%d" % (num % 3), days_ago=num % 3)
+        self._add_email(6, "sender2")
+        self.assertEqual(self._get_posters(), [
+            ("sender2@example.com", 3), ("sender0@example.com", 2)])
+
+    @override_settings(HYPERKITTY_TOP_POSTERS_DAYS=7)
+    def test_days(self):
+        self._add_email(1, "sender1")
+        self._add_email(2, "sender2", days_ago=10)
+        self._add_email(3, "sender2", days_ago=20)
+        self.assertEqual(self._get_posters(), [("sender1@example.com", 1)])
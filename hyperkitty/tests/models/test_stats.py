@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import date, datetime, timedelta
+from email.message import EmailMessage
+
+from django.db import transaction
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models.email import Email
+from hyperkitty.models.mailinglist import MailingList
+from hyperkitty.models.stats import (
+    MailingListActivity, MailingListDailyPoster, MailingListDailyStats,
+    update_daily_stats)
+from hyperkitty.tests.utils import TestCase
+
+
+def _add_email(num, sender, day, reply_to=None):
+    msg = EmailMessage()
+    msg["From"] = "%s@example.com" % sender
+    msg["Message-ID"] = "<msg%d>" % num
+    msg["Date"] = "%s 12:00:00 +0000" % day.strftime("%d %b %Y")
+    if reply_to is not None:
+        msg["In-Reply-To"] = "<msg%d>" % reply_to
+    msg.set_payload("message %d" % num)
+    add_to_list("list@example.com", msg)
+
+
+class DailyStatsTestCase(TestCase):
+
+    def _get_stats(self):
+        return list(MailingListDailyStats.objects.order_by("date").values_list(
+            "date", "emails_count", "threads_count", "participants_count"))
+
+    def test_add_email(self):
+        _add_email(1, "sender1", date(2020, 7, 1))
+        _add_email(2, "sender2", date(2020, 7, 1), reply_to=1)
+        _add_email(3, "sender2", date(2020, 7, 1), reply_to=1)
+        _add_email(4, "sender1", date(2020, 7, 3))
+        self.assertEqual(self._get_stats(), [
+            (date(2020, 7, 1), 3, 1, 2),
+            (date(2020, 7, 3), 1, 1, 1),
+            ])
+        self.assertEqual(
+            list(MailingListDailyPoster.objects.order_by(
+                "date", "sender_id").values_list(
+                "date", "sender_id", "emails_count")), [
+                (date(2020, 7, 1), "sender1@example.com", 1),
+                (date(2020, 7, 1), "sender2@example.com", 2),
+                (date(2020, 7, 3), "sender1@example.com", 1),
+            ])
+
+    def test_timezone(self):
+        # The days are in UTC.
+        msg = EmailMessage()
+        msg["From"] = "sender@example.com"
+        msg["Message-ID"] = "<msg>"
+        msg["Date"] = "Thu, 02 Jul 2020 01:00:00 +0200"
+        msg.set_payload("message")
+        add_to_list("list@example.com", msg)
+        self.assertEqual(self._get_stats(), [(date(2020, 7, 1), 1, 1, 1)])
+
+    def test_set_parent(self):
+        # An orphan reply does not start a thread anymore when its parent
+        # arrives.
+        _add_email(2, "sender2", date(2020, 7, 2), reply_to=1)
+        self.assertEqual(self._get_stats(), [(date(2020, 7, 2), 1, 1, 1)])
+        _add_email(1, "sender1", date(2020, 7, 1))
+        self.assertEqual(self._get_stats(), [
+            (date(2020, 7, 1), 1, 1, 1),
+            (date(2020, 7, 2), 1, 0, 1),
+            ])
+
+    def test_delete(self):
+        _add_email(1, "sender1", date(2020, 7, 1))
+        _add_email(2, "sender2", date(2020, 7, 2), reply_to=1)
+        Email.objects.get(message_id="msg1").delete()
+        # The reply now starts the thread.
+        self.assertEqual(self._get_stats(), [(date(2020, 7, 2), 1, 1, 1)])
+        self.assertEqual(MailingListDailyPoster.objects.count(), 1)
+
+    def test_update_range(self):
+        _add_email(1, "sender1", date(2020, 7, 1))
+        _add_email(2, "sender1", date(2020, 7, 5))
+        MailingListDailyStats.objects.all().delete()
+        MailingListDailyPoster.objects.all().delete()
+        mlist = MailingList.objects.get(name="list@example.com")
+        update_daily_stats(mlist, date(2020, 7, 1), date(2020, 7, 4))
+        self.assertEqual(self._get_stats(), [(date(2020, 7, 1), 1, 1, 1)])
+
+    def test_update_twice(self):
+        # Concurrent updates of the same day are serialized, the last one
+        # stores the latest counts.
+        _add_email(1, "sender1", date(2020, 7, 1))
+        mlist = MailingList.objects.get(name="list@example.com")
+        with transaction.atomic():
+            update_daily_stats(mlist, date(2020, 7, 1))
+            _add_email(2, "sender2", date(2020, 7, 1), reply_to=1)
+            update_daily_stats(mlist, date(2020, 7, 1))
+        self.assertEqual(self._get_stats(), [(date(2020, 7, 1), 2, 1, 2)])
+        self.assertEqual(MailingListDailyPoster.objects.count(), 2)
+
+    def test_participants_count_for_month(self):
+        # A participant is counted once, whatever the number of days.
+        _add_email(1, "sender1", date(2020, 7, 1))
+        _add_email(2, "sender1", date(2020, 7, 2))
+        _add_email(3, "sender2", date(2020, 7, 31))
+        _add_email(4, "sender3", date(2020, 8, 1))
+        mlist = MailingList.objects.get(name="list@example.com")
+        self.assertEqual(mlist.get_participants_count_for_month(2020, 7), 2)
+        self.assertEqual(mlist.get_participants_count_for_month(2020, 8), 1)
+
+
+class ActivityTestCase(TestCase):
+
+    def test_add_email(self):
+        today = datetime.utcnow().date()
+        _add_email(1, "sender1", today)
+        _add_email(2, "sender2", today, reply_to=1)
+        _add_email(3, "sender1", today - timedelta(days=100))
+        activity = MailingListActivity.objects.get(
+            mailinglist__name="list@example.com")
+        self.assertEqual(activity.recent_threads_count, 1)
+        self.assertEqual(activity.recent_participants_count, 2)
+
+    def test_rebuild_recent_cache(self):
+        _add_email(1, "sender1", datetime.utcnow().date())
+        MailingListActivity.objects.all().delete()
+        mlist = MailingList.objects.get(name="list@example.com")
+        mlist.rebuild_recent_cache()
+        self.assertEqual(mlist.activity.recent_threads_count, 1)
+        self.assertEqual(mlist.activity.recent_participants_count, 1)
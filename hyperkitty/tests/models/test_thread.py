@@ -24,6 +24,10 @@ import random
 import string
 from email.message import EmailMessage
 
+from django.contrib.auth.models import User
+
+from mock import patch
+
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models.email import Email
 from hyperkitty.models.mailinglist import MailingList
@@ -102,7 +106,8 @@ class ThreadTestCase(TestCase):
 
     def test_thread_no_email(self):
         mlist = MailingList.objects.create(name="example-list")
-        Thread.objects.create(mailinglist=mlist, thread_id="<msg1>")
+        thread = Thread.objects.create(mailinglist=mlist, thread_id="<msg1>")
+        self.assertEqual(thread.subject, "")
 
     def test_long_subject(self):
         # PostgreSQL will raise an OperationalError if the subject's index is
@@ -125,3 +130,66 @@ class ThreadTestCase(TestCase):
         self.assertTrue(
             len(msg_db.subject) < 2712,
             "Very long subjects are not trimmed")
+
+    def _add_email(self, num, sender, parent=None):
+        msg = EmailMessage()
+        msg["From"] = sender
+        msg["Message-ID"] = "<msg%d>" % num
+        if parent is not None:
+            msg["In-Reply-To"] = "<msg%d>" % parent
+        msg.set_payload("message %d" % num)
+        add_to_list("example-list", msg)
+        return Email.objects.get(message_id="msg%d" % num)
+
+    def test_counts(self):
+        self._add_email(1, "sender1@example.com")
+        self._add_email(2, "sender2@example.com", 1)
+        email = self._add_email(3, "sender1@example.com", 2)
+        self.assertEqual(email.thread.emails_count, 3)
+        self.assertEqual(email.thread.participants_count, 2)
+        thread = Thread.objects.get()
+        self.assertEqual(thread.emails_count, 3)
+        self.assertEqual(thread.participants_count, 2)
+        # Reads don't query the emails.
+        with self.assertNumQueries(0):
+            thread.emails_count
+            thread.participants_count
+        email.delete()
+        thread.refresh_from_db()
+        self.assertEqual(thread.emails_count, 2)
+        self.assertEqual(thread.participants_count, 2)
+
+    def test_counts_locked(self):
+        # The participants are checked with the thread row locked.
+        self._add_email(1, "sender1@example.com")
+        with patch.object(
+                Thread.objects, "select_for_update",
+                wraps=Thread.objects.select_for_update) as mock_lock:
+            email = self._add_email(2, "sender2@example.com", 1)
+        self.assertTrue(mock_lock.called)
+        self.assertEqual(email.thread.participants_count, 2)
+
+    def test_counts_reattach(self):
+        self._add_email(1, "sender1@example.com")
+        email = self._add_email(2, "sender2@example.com")
+        self._add_email(3, "sender3@example.com", 2)
+        self.assertEqual(Thread.objects.count(), 2)
+        email.set_parent(Email.objects.get(message_id="msg1"))
+        thread = Thread.objects.get()
+        self.assertEqual(thread.emails_count, 3)
+        self.assertEqual(thread.participants_count, 3)
+
+    def test_votes_reattach(self):
+        user = User.objects.create_user("testuser", "test@example.com")
+        self._add_email(1, "sender1@example.com")
+        self._add_email(2, "sender2@example.com").vote(1, user)
+        email = self._add_email(3, "sender3@example.com", 2)
+        email.vote(1, user)
+        self._add_email(4, "sender4@example.com", 2).vote(-1, user)
+        email.set_parent(Email.objects.get(message_id="msg1"))
+        new_thread = Thread.objects.get(starting_email__message_id="msg1")
+        self.assertEqual(new_thread.votes_likes, 1)
+        self.assertEqual(new_thread.votes_dislikes, 0)
+        former_thread = Thread.objects.get(starting_email__message_id="msg2")
+        self.assertEqual(former_thread.votes_likes, 1)
+        self.assertEqual(former_thread.votes_dislikes, 1)
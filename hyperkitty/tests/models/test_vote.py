@@ -23,9 +23,13 @@
 from email.message import EmailMessage
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import Email, Thread
+from hyperkitty.models.common import CachedValue
 from hyperkitty.tests.utils import TestCase
 
 
@@ -116,6 +120,20 @@ class VoteTestCase(TestCase):
         self.assertEqual(votes["likes"], 0)
         self.assertEqual(votes["dislikes"], 1)
 
+    def test_revote_thread(self):
+        # The thread's vote counts follow the changes
+        _create_email(1)
+        msg = Email.objects.get(message_id="msg1")
+        msg.vote(1, self.user)
+        msg.vote(-1, self.user)
+        thread = Thread.objects.get()
+        self.assertEqual(thread.votes_likes, 0)
+        self.assertEqual(thread.votes_dislikes, 1)
+        self.assertEqual(thread.votes_total, -1)
+        msg.votes.all().delete()
+        thread.refresh_from_db()
+        self.assertEqual(thread.votes_dislikes, 0)
+
     def test_revote_identical(self):
         # Voting in the same manner twice should not fail
         _create_email(1)
@@ -128,3 +146,33 @@ class VoteTestCase(TestCase):
         _create_email(1)
         msg = Email.objects.get(message_id="msg1")
         self.assertRaises(ValueError, msg.vote, 2, self.user)
+
+    def test_get_many(self):
+        # Only the missing values are computed, and reading them afterwards
+        # does not query the database nor the cache.
+        for num in range(1, 4):
+            _create_email(num, reply_to=(num - 1 if num > 1 else None))
+        Email.objects.get(message_id="msg1").vote(1, self.user)
+        cache.clear()
+        Email.objects.get(message_id="msg1").get_votes()  # in the cache
+        emails = list(Email.objects.order_by("message_id"))
+        with CaptureQueriesContext(connection) as queries:
+            CachedValue.get_many(emails, ["votes"])
+        # One query per missing value, none for the cached one.
+        self.assertEqual(len(queries), 2)
+        with CaptureQueriesContext(connection) as queries:
+            votes = [email.get_votes() for email in emails]
+        self.assertEqual(len(queries), 0)
+        self.assertEqual([v["likes"] for v in votes], [1, 0, 0])
+        # The missing values have been stored.
+        self.assertEqual(cache.get("Email:%s:votes" % emails[2].id), (0, 0))
+
+    def test_get_many_rebuild(self):
+        # A rebuild replaces the prefetched value.
+        _create_email(1)
+        email = Email.objects.get(message_id="msg1")
+        CachedValue.get_many([email], ["votes"])
+        self.assertEqual(email.get_votes()["likes"], 0)
+        email.vote(1, self.user)
+        email.cached_values["votes"].rebuild()
+        self.assertEqual(email.get_votes()["likes"], 1)
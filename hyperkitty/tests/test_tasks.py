@@ -20,13 +20,21 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+import os
+from datetime import date
 from email.message import EmailMessage
 
-from mock import patch
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import override_settings
+
+from mock import Mock, patch
 
 from hyperkitty import tasks
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models.email import Email
+from hyperkitty.models.mailinglist import MailingList
 from hyperkitty.models.thread import Thread
 from hyperkitty.tests.utils import TestCase
 
@@ -39,18 +47,61 @@ class TaskTestCase(TestCase):
         except Thread.DoesNotExist:
             self.fail("No protection when the thread is deleted")
 
-    def test_rebuild_thread_cache_votes_no_thread(self):
-        try:
-            tasks.rebuild_thread_cache_votes(42)
-        except Thread.DoesNotExist:
-            self.fail("No protection when the thread is deleted")
-
     def test_compute_thread_positions_no_thread(self):
         try:
             tasks.compute_thread_positions(42)
         except Thread.DoesNotExist:
             self.fail("No protection when the thread is deleted")
 
+    def test_compute_thread_positions_new_email(self):
+        msg = EmailMessage()
+        msg["From"] = "sender@example.com"
+        msg["Message-ID"] = "<msgid1>"
+        msg.set_payload("message")
+        add_to_list("example-list", msg)
+        email = Email.objects.get(message_id="msgid1")
+        thread = email.thread
+        # Nothing to do when all the emails are positioned.
+        with patch("hyperkitty.tasks.compute_email_order_and_depth") \
+                as mock_email, \
+                patch("hyperkitty.tasks.compute_thread_order_and_depth") \
+                as mock_thread:
+            tasks.compute_thread_positions(thread.id)
+        self.assertFalse(mock_email.called)
+        self.assertFalse(mock_thread.called)
+        # A single new email is inserted at its place.
+        thread.emails.update(thread_order=None)
+        with patch("hyperkitty.tasks.compute_email_order_and_depth") \
+                as mock_compute:
+            tasks.compute_thread_positions(thread.id)
+        mock_compute.assert_called_once_with(email)
+        # Several new emails are positioned with the whole thread.
+        msg = EmailMessage()
+        msg["From"] = "sender@example.com"
+        msg["Message-ID"] = "<msgid2>"
+        msg["In-Reply-To"] = "<msgid1>"
+        msg.set_payload("reply")
+        add_to_list("example-list", msg)
+        thread.emails.update(thread_order=None)
+        with patch("hyperkitty.tasks.compute_thread_order_and_depth") \
+                as mock_compute:
+            tasks.compute_thread_positions(thread.id)
+        mock_compute.assert_called_once_with(thread)
+
+    def test_rebuild_cached_value_no_instance(self):
+        try:
+            tasks.rebuild_cached_value(
+                "hyperkitty.MailingList", 42, "top_posters")
+        except MailingList.DoesNotExist:
+            self.fail("No protection when the mailing-list is deleted")
+
+    def test_update_mailinglist_cache_recent_no_list(self):
+        try:
+            tasks.update_mailinglist_cache_recent(
+                "example-list", date(2020, 7, 1))
+        except MailingList.DoesNotExist:
+            self.fail("No protection when the mailing-list is deleted")
+
     def test_check_orphans_no_email(self):
         try:
             tasks.check_orphans(42)
@@ -79,3 +130,112 @@ class TaskTestCase(TestCase):
         tasks.check_orphans(orig.id)
         reply.refresh_from_db()
         self.assertEqual(reply.parent_id, orig.pk)
+
+
+class CoalescingTestCase(TestCase):
+
+    def test_pending(self):
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            for i in range(3):
+                tasks.rebuild_mailinglist_cache_recent("list@example.com")
+            tasks.rebuild_mailinglist_cache_recent("other@example.com")
+        self.assertEqual(AsyncTask.call_count, 2)
+        self.assertEqual(
+            tasks.get_absorbed_count("rebuild_mailinglist_cache_recent"), 2)
+        self.assertEqual(tasks.get_absorbed_count("check_orphans"), 0)
+
+    def test_recent_cache_burst(self):
+        # A burst of emails on a list updates its recent values once.
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            for num in range(3):
+                msg = EmailMessage()
+                msg["From"] = "dummy@example.com"
+                msg["Message-ID"] = "<msg%d>" % num
+                msg["Date"] = "Wed, 01 Jul 2020 12:0%d:00 +0000" % num
+                msg.set_payload("Dummy message")
+                add_to_list("list@example.com", msg)
+        calls = [
+            c for c in AsyncTask.call_args_list
+            if c[1]["q_options"]["task_name"] ==
+            "update_mailinglist_cache_recent"]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            calls[0][0][3:], ("list@example.com", date(2020, 7, 1)))
+
+    def test_thread_positions_burst(self):
+        # A burst of replies in a thread positions its emails once.
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            for num in range(3):
+                msg = EmailMessage()
+                msg["From"] = "dummy@example.com"
+                msg["Message-ID"] = "<msg%d>" % num
+                if num:
+                    msg["In-Reply-To"] = "<msg0>"
+                msg.set_payload("Dummy message")
+                add_to_list("list@example.com", msg)
+        calls = [
+            c for c in AsyncTask.call_args_list
+            if c[1]["q_options"]["task_name"] == "compute_thread_positions"]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            calls[0][0][3:], (Thread.objects.get().id, ))
+
+    def test_run(self):
+        # Once the task runs, it can be enqueued again.
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            tasks.check_orphans(42)
+        key = AsyncTask.call_args[0][1]
+        self.assertTrue(cache.get(key))
+        func = Mock()
+        tasks._run_pending(key, func, 42)
+        func.assert_called_once_with(42)
+        self.assertIsNone(cache.get(key))
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            tasks.check_orphans(42)
+        self.assertEqual(AsyncTask.call_count, 1)
+
+    def test_enqueue_error(self):
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            AsyncTask.return_value.run.side_effect = ValueError
+            self.assertRaises(ValueError, tasks.check_orphans, 42)
+            AsyncTask.return_value.run.side_effect = None
+            tasks.check_orphans(42)
+        self.assertEqual(AsyncTask.call_count, 2)
+
+    @override_settings(HYPERKITTY_TASKS_COALESCE_WINDOW=0)
+    def test_disabled(self):
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            tasks.check_orphans(42)
+            tasks.check_orphans(42)
+        self.assertEqual(AsyncTask.call_count, 2)
+        self.assertIsNone(AsyncTask.call_args[0][1])
+
+    def _enqueue_twice(self, enqueue_cache, worker_cache):
+        # The marker is removed by a worker in another process, which has
+        # its own cache instance.
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask, \
+                patch("hyperkitty.tasks.caches", {"default": enqueue_cache}), \
+                patch("hyperkitty.tasks.cache", enqueue_cache):
+            tasks.check_orphans(42)
+            key = AsyncTask.call_args[0][1]
+            with patch("hyperkitty.tasks.cache", worker_cache):
+                tasks._run_pending(key, Mock(), 42)
+            tasks.check_orphans(42)
+        return AsyncTask.call_count
+
+    @override_settings(Q_CLUSTER={"orm": "default"})
+    def test_shared_cache(self):
+        location = os.path.join(self.tmpdir, "cache")
+        self.assertEqual(self._enqueue_twice(
+            FileBasedCache(location, {}), FileBasedCache(location, {})), 2)
+
+    @override_settings(Q_CLUSTER={"orm": "default"})
+    def test_local_cache(self):
+        # The worker can't remove the marker, don't coalesce.
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            tasks.check_orphans(42)
+            tasks.check_orphans(42)
+        self.assertEqual(AsyncTask.call_count, 2)
+        self.assertIsNone(AsyncTask.call_args[0][1])
+        self.assertEqual(self._enqueue_twice(
+            LocMemCache("web", {}), LocMemCache("worker", {})), 2)
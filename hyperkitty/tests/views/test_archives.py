@@ -23,6 +23,7 @@
 
 import datetime
 import gzip
+import json
 import mailbox
 import os
 import shutil
@@ -31,6 +32,9 @@ from email.message import EmailMessage
 
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
 from bs4 import BeautifulSoup
 from django_mailman3.tests.utils import FakeMMList, FakeMMMember
@@ -38,7 +42,8 @@ from mock import Mock
 
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import (
-    ArchivePolicy, Email, Favorite, MailingList, Sender, Thread)
+    ArchivePolicy, Email, Favorite, LastView, MailingList, Sender,
+    Thread, ThreadCategory)
 from hyperkitty.tests.utils import TestCase
 from hyperkitty.utils import reverse
 
@@ -134,6 +139,78 @@ class ListArchivesTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context["threads"]), 1)
 
+    def test_overview_threads_queries(self):
+        # The number of queries does not depend on the number of threads.
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse(
+                    'hk_list_overview_recent_threads',
+                    args=["list@example.com"]))
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+        before = count_queries()
+        for num in range(5):
+            msg = EmailMessage()
+            msg["From"] = "dummy%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("Dummy message")
+            add_to_list("list@example.com", msg)
+        self.assertEqual(count_queries(), before)
+
+    def test_archives_threads_queries(self):
+        # The number of queries does not depend on the number of threads.
+        user = User.objects.create_user(
+            'testuser', 'dummy@example.com', 'testPass')
+        self.client.login(username='testuser', password='testPass')
+        ThreadCategory.objects.create(name="question")
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse(
+                    'hk_archives_latest', args=["list@example.com"]))
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+        count_queries()  # Warm up the cache
+        before = count_queries()
+        for num in range(5):
+            msg = EmailMessage()
+            msg["From"] = "dummy%d@example.com" % num
+            msg["Message-ID"] = "<msg%d>" % num
+            msg.set_payload("Dummy message")
+            add_to_list("list@example.com", msg)
+        for thread in Thread.objects.all()[:3]:
+            Favorite.objects.create(thread=thread, user=user)
+            LastView.objects.create(thread=thread, user=user)
+        self.assertEqual(count_queries(), before)
+
+    def test_archives_favorites_and_unread(self):
+        user = User.objects.create_user(
+            'testuser', 'dummy@example.com', 'testPass')
+        self.client.login(username='testuser', password='testPass')
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg2>"
+        msg.set_payload("Dummy message")
+        add_to_list("list@example.com", msg)
+        category = ThreadCategory.objects.create(name="question")
+        thread = Thread.objects.get(starting_email__message_id="msg")
+        thread.category = category
+        thread.save()
+        Favorite.objects.create(thread=thread, user=user)
+        LastView.objects.create(thread=thread, user=user)
+        response = self.client.get(reverse(
+            'hk_archives_latest', args=["list@example.com"]))
+        self.assertEqual(response.status_code, 200)
+        threads = dict(
+            (t.starting_email.message_id, t)
+            for t in response.context["threads"])
+        self.assertTrue(threads["msg"].favorite)
+        self.assertFalse(threads["msg"].unread)
+        self.assertEqual(threads["msg"].category_hk, category)
+        self.assertFalse(threads["msg2"].favorite)
+        self.assertTrue(threads["msg2"].unread)
+        self.assertIsNone(threads["msg2"].category_hk)
+
     def test_overview_cleaned_cache(self):
         # Test the overview page with a clean cache (different code path for
         # MailingList.recent_threads)
@@ -161,6 +238,17 @@ class ListArchivesTestCase(TestCase):
         self.assertContains(response, "dummy", status_code=200)
         self.assertNotContains(response, "dummy@example.com", status_code=200)
 
+    def test_recent_activity(self):
+        response = self.client.get(reverse(
+            'hk_list_recent_activity', args=["list@example.com"]))
+        self.assertEqual(response.status_code, 200)
+        evolution = json.loads(response.content.decode("utf-8"))["evolution"]
+        self.assertEqual(len(evolution), 32)
+        self.assertEqual(evolution[-1], {
+            "date": datetime.datetime.utcnow().strftime("%Y-%m-%d"),
+            "count": 1})
+        self.assertEqual(sum(day["count"] for day in evolution), 1)
+
 
 class ExportMboxTestCase(TestCase):
 
@@ -211,6 +299,12 @@ class ExportMboxTestCase(TestCase):
         content = email.get_payload()[0]
         self.assertEqual(content.get_payload(), "Dummy message\n")
 
+    @override_settings(HYPERKITTY_MBOX_EXPORT_COMPRESSION_THREAD=True)
+    def test_threaded_compression(self):
+        mbox = self._get_mbox()
+        self.assertEqual(len(mbox), 1)
+        self.assertEqual(mbox.values()[0]["Message-ID"], "<msg>")
+
     def test_with_sender_name(self):
         email = Email.objects.get(message_id="msg")
         email.sender_name = "Dummy Sender"
@@ -52,6 +52,25 @@ class CompatURLsTestCase(TestCase):
             response = self.client.get(reverse("hk_root") + url)
             self.assertRedirects(response, expected_url)
 
+    def test_redirect_month_mbox(self):
+        url = reverse("hk_root") + "pipermail/list/2015-February.txt.gz"
+        response = self.client.get(url)
+        self.assertRedirects(
+            response, "%s?start=2015-02-01&end=2015-03-01" % reverse(
+                'hk_list_export_mbox', kwargs={
+                    'mlist_fqdn': 'list@example.com',
+                    'filename': '2015-February'}),
+            fetch_redirect_response=False)
+        response = self.client.get(response["Location"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/gzip")
+
+    def test_redirect_month_mbox_december(self):
+        url = reverse("hk_root") + "pipermail/list/2014-December.txt.gz"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("start=2014-12-01&end=2015-01-01", response["Location"])
+
     # def test_redirect_message(self):
     #     url_list = ["pipermail/list/2015-February/000001.html",
     #                 "list/list@example.com/2015-February/000001.html"]
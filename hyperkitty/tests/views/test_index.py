@@ -34,7 +34,7 @@ from django_mailman3.tests.utils import FakeMMList, FakeMMMember
 from mock import Mock
 
 from hyperkitty.lib.incoming import add_to_list
-from hyperkitty.models import ArchivePolicy, MailingList
+from hyperkitty.models import ArchivePolicy, MailingList, MailingListActivity
 from hyperkitty.tests.utils import TestCase
 from hyperkitty.utils import reverse
 
@@ -260,3 +260,82 @@ class DomainFilteringTestCase(TestCase):
 
     def test_different_single_component_domain(self):
         self._do_test("intranet", "extranet", 0)
+
+    def test_number_of_queries(self):
+        for name in ("list-1", "list-2", "list-3"):
+            MailingList.objects.create(name="%s@example.com" % name)
+        self.client.get(reverse("hk_root"), HTTP_HOST="www.example.com")
+        # The mail domains are cached, the queries do not depend on the
+        # number of lists (the lists missing an activity summary, the count
+        # and the page).
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse("hk_root"), HTTP_HOST="www.example.com")
+        self.assertEqual(
+            response.context["all_lists"].paginator.count, 3)
+
+
+class ActivitySortingTestCase(TestCase):
+
+    def setUp(self):
+        for name, threads, participants in [
+                ("list-a@example.com", 1, 3),
+                ("list-b@example.com", 3, 1),
+                ("list-c@example.com", 2, 2)]:
+            mlist = MailingList.objects.create(name=name)
+            MailingListActivity.objects.create(
+                mailinglist=mlist, recent_threads_count=threads,
+                recent_participants_count=participants)
+        # No activity summary yet.
+        MailingList.objects.create(name="list-d@example.com")
+
+    def _get_names(self, sort_mode, **kwargs):
+        kwargs["sort"] = sort_mode
+        response = self.client.get(reverse("hk_root"), kwargs)
+        self.assertEqual(response.status_code, 200)
+        return [ml.name for ml in response.context["all_lists"]]
+
+    def test_sort_active(self):
+        self.assertEqual(self._get_names("active"), [
+            "list-b@example.com", "list-c@example.com",
+            "list-a@example.com", "list-d@example.com"])
+
+    def test_sort_popular(self):
+        self.assertEqual(self._get_names("popular"), [
+            "list-a@example.com", "list-c@example.com",
+            "list-b@example.com", "list-d@example.com"])
+
+    def test_paginate(self):
+        self.assertEqual(self._get_names("active", count=2, page=2), [
+            "list-a@example.com", "list-d@example.com"])
+
+    def test_paginate_default(self):
+        # All the lists are on the first page by default.
+        self.assertEqual(len(self._get_names("name")), 4)
+        with self.settings(HYPERKITTY_INDEX_LISTS_PER_PAGE=3):
+            self.assertEqual(len(self._get_names("name")), 3)
+
+    def test_missing_activity(self):
+        # A list without an activity summary gets it computed.
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg>"
+        msg["Subject"] = "Dummy message"
+        msg.set_payload("Dummy message")
+        add_to_list("list-e@example.com", msg)
+        MailingListActivity.objects.filter(
+            mailinglist__name="list-e@example.com").delete()
+        self.assertEqual(self._get_names("popular"), [
+            "list-a@example.com", "list-c@example.com",
+            "list-b@example.com", "list-e@example.com",
+            "list-d@example.com"])
+        activity = MailingListActivity.objects.get(
+            mailinglist__name="list-e@example.com")
+        self.assertEqual(activity.recent_threads_count, 1)
+        self.assertEqual(activity.recent_participants_count, 1)
+
+    def test_inactive(self):
+        response = self.client.get(reverse("hk_root"), {"sort": "name"})
+        # Only the list without recent activity is marked as inactive.
+        self.assertContains(
+            response, '<span class="list-tags">inactive</span>', count=1)
@@ -505,21 +505,20 @@ class MessageViewsTestCase(TestCase):
             "attachment; filename*=UTF-8''puntogil.vcf"
         )
         self.assertEqual(
-            response.content,
+            b"".join(response.streaming_content),
             b'begin:vcard\nfn:gil\nn:;gil\nversion:2.1\nend:vcard\n\n'
         )
 
     def test_attachment_local_storage(self):
-        # Tests getting an attachment when it's stored on the filesystem.
+        # Tests getting an attachment when it's stored on the filesystem, in
+        # the folder of its email (before the deduplicated storage).
         msg = Email.objects.get(mailinglist__name="list@example.com",
                                 message_id="msg")
         # Add the attachment object
-        att = Attachment.objects.create(
+        Attachment.objects.create(
             email=msg, counter=1, name="testattach.txt",
-            content_type="text/plain", encoding="ascii",
+            content_type="text/plain", encoding="ascii", size=12,
         )
-        att.set_content("test_content")
-        att.save()
         # Create the attachment on the filesystem
         attachment_folder = os.path.join(self.tmpdir, "attachments")
         filedir = os.path.join(
@@ -546,4 +545,90 @@ class MessageViewsTestCase(TestCase):
             response['Content-Disposition'],
             "attachment; filename*=UTF-8''testattach.txt"
         )
-        self.assertEqual(response.content, contents.encode("ascii"))
+        self.assertEqual(
+            b"".join(response.streaming_content), contents.encode("ascii"))
+
+    def _add_local_attachment(self, attachment_folder):
+        msg = Email.objects.get(mailinglist__name="list@example.com",
+                                message_id="msg")
+        att = Attachment(
+            email=msg, counter=1, name="testattach.txt",
+            content_type="text/plain", encoding="ascii",
+        )
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=attachment_folder):
+            att.set_content("test content")
+            att.save()
+        return reverse('hk_message_attachment', args=(
+            "list@example.com",
+            get_message_id_hash("msg"),
+            "1", "testattach.txt",
+        ))
+
+    def test_attachment_range(self):
+        attachment_folder = os.path.join(self.tmpdir, "attachments")
+        url = self._add_local_attachment(attachment_folder)
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=attachment_folder):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Accept-Ranges"], "bytes")
+            etag = response["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertNotIn("Content-Disposition", response)
+            response = self.client.get(url, HTTP_RANGE="bytes=5-")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 5-11/12")
+        self.assertEqual(response["Content-Length"], "7")
+        self.assertEqual(
+            response['Content-Disposition'],
+            "attachment; filename*=UTF-8''testattach.txt"
+        )
+        self.assertEqual(b"".join(response.streaming_content), b"content")
+
+    def test_attachment_missing_file(self):
+        attachment_folder = os.path.join(self.tmpdir, "attachments")
+        url = self._add_local_attachment(attachment_folder)
+        other_folder = os.path.join(self.tmpdir, "other")
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=other_folder):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_attachment_sendfile(self):
+        attachment_folder = os.path.join(self.tmpdir, "attachments")
+        url = self._add_local_attachment(attachment_folder)
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=attachment_folder,
+                           HYPERKITTY_ATTACHMENT_SENDFILE="X-Sendfile"):
+            response = self.client.get(url)
+            filepath = Attachment.objects.get().get_path()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response['Content-Type'], "text/plain")
+        self.assertEqual(response['X-Sendfile'], filepath)
+        self.assertEqual(
+            response['Content-Disposition'],
+            "attachment; filename*=UTF-8''testattach.txt"
+        )
+
+    def test_attachment_accel_redirect(self):
+        attachment_folder = os.path.join(self.tmpdir, "attachments")
+        url = self._add_local_attachment(attachment_folder)
+        with self.settings(HYPERKITTY_ATTACHMENT_FOLDER=attachment_folder,
+                           HYPERKITTY_ATTACHMENT_SENDFILE="X-Accel-Redirect",
+                           HYPERKITTY_ATTACHMENT_SENDFILE_PREFIX="/internal/"):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"")
+        sha256 = Attachment.objects.get().blob.sha256
+        self.assertEqual(
+            response['X-Accel-Redirect'],
+            "/internal/blobs/%s/%s/%s" % (sha256[:2], sha256[2:4], sha256))
+
+    def test_attachment_sendfile_database(self):
+        # Attachments stored in the database are sent by Django.
+        url = self._add_local_attachment(None)
+        with self.settings(HYPERKITTY_ATTACHMENT_SENDFILE="X-Sendfile"):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Sendfile", response)
+        self.assertEqual(
+            b"".join(response.streaming_content), b"test content")
@@ -27,7 +27,7 @@ import urllib
 from email.message import EmailMessage
 
 from django.contrib.auth.models import User
-from django.test import override_settings
+from django.test import RequestFactory, override_settings
 
 from bs4 import BeautifulSoup
 from django_mailman3.tests.utils import get_flash_messages
@@ -37,6 +37,7 @@ from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import Email, MailingList, Tag, Tagging, Thread
 from hyperkitty.tests.utils import SearchEnabledTestCase, TestCase
 from hyperkitty.utils import reverse
+from hyperkitty.views.thread import _get_thread_replies
 
 
 class ReattachTestCase(SearchEnabledTestCase):
@@ -415,6 +416,26 @@ class ThreadTestCase(TestCase):
         self.assertFalse(resp["more_pending"])
         self.assertIsNone(resp["next_offset"])
 
+    def test_replies_user_votes_queries(self):
+        # The votes of the user are loaded with a single query.
+        for num in range(3):
+            self._make_msg("reply%d" % num, {"In-Reply-To": "<msgid>"})
+        replies = Email.objects.filter(message_id__startswith="reply")
+        for email in replies:
+            email.vote(1, self.user)
+        thread = Thread.objects.get(thread_id=self.threadid)
+        request = RequestFactory().get("/")
+        request.user = self.user
+        _get_thread_replies(request, thread, limit=10)  # Warm up the cache
+        thread = Thread.objects.select_related(
+            "mailinglist", "starting_email").get(thread_id=self.threadid)
+        # The replies and the votes.
+        with self.assertNumQueries(2):
+            emails = _get_thread_replies(request, thread, limit=10)
+        self.assertEqual(len(emails), 3)
+        for email in emails:
+            self.assertEqual(email.myvote.value, 1)
+
     def test_replies_without_thread_order_show_in_ui(self):
         # In certain cases, emails without thread_order should show up in UI,
         # even though they are somewhat staggered in order.
@@ -424,14 +445,19 @@ class ThreadTestCase(TestCase):
         self._make_msg("id2", {
             "In-Reply-To": "<id1>", "Subject": "A reply"
             })
-        with patch("hyperkitty.tasks.compute_thread_order_and_depth") as ctoad:
+        with patch("hyperkitty.tasks.compute_email_order_and_depth") \
+                as ceoad, \
+                patch("hyperkitty.tasks.compute_thread_order_and_depth") \
+                as ctoad:
             self._make_msg("id3", {
                 "In-Reply-To": "<id2>", "Subject": "A reply"
                 })
             self._make_msg("id4", {
                 "In-Reply-To": "<id3>", "Subject": "A reply"
                 })
-        self.assertEqual(ctoad.call_count, 2)
+        # The second unpositioned email makes the whole thread computed.
+        self.assertEqual(ceoad.call_count, 1)
+        self.assertEqual(ctoad.call_count, 1)
         self.assertIsNone(Email.objects.get(message_id="id3").thread_order)
         self.assertIsNone(Email.objects.get(message_id="id4").thread_order)
         # All set. Now test.
@@ -35,7 +35,9 @@ from django_mailman3.lib.mailman import (
     get_mailman_client, get_mailman_user_id, get_subscriptions)
 from django_mailman3.lib.paginator import paginate
 
-from hyperkitty.lib.view_helpers import is_mlist_authorized
+from hyperkitty.lib.paginator import (
+    InvalidCursor, cursor_paginate, use_cursor_pagination)
+from hyperkitty.lib.view_helpers import is_mlist_authorized, set_user_votes
 from hyperkitty.models import Email, Favorite, LastView, MailingList, Vote
 
 
@@ -221,10 +223,17 @@ def posts(request, user_id):
     emails = Email.objects.filter(
             mailinglist=mlist, sender__mailman_id=user_id
         ).order_by("date")
-    emails = paginate(emails, request.GET.get("page"))
+    if use_cursor_pagination(request):
+        try:
+            emails = cursor_paginate(
+                emails, request.GET.get("cursor"), request.GET.get("count"),
+                ordering=("date", "id"))
+        except InvalidCursor:
+            raise Http404("Invalid cursor")
+    else:
+        emails = paginate(emails, request.GET.get("page"))
 
-    for email in emails:
-        email.myvote = email.votes.filter(user=request.user).first()
+    set_user_votes(emails, request.user)
 
     context = {
         'user_id': user_id,
@@ -20,18 +20,14 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
-import datetime
-import gzip
-import mailbox
-import os
-import tempfile
-from io import StringIO
+from urllib.parse import urlencode
 
-from django.http import Http404, HttpResponse
+from django.http import Http404
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 
 from hyperkitty.lib.compat import get_list_by_name, month_name_to_num
+from hyperkitty.lib.view_helpers import get_display_dates
 from hyperkitty.models import Email, MailingList
 
 
@@ -54,43 +50,23 @@ def arch_month(request, list_name, year, month_name, summary_type="thread"):
 
 def arch_month_mbox(request, list_name, year, month_name):
     """
-    The messages must be rebuilt before being added to the mbox file, including
-    headers and the textual content, making sure to escape email addresses.
+    Redirect to the mbox export of the month, which serves the precomputed
+    archive when it is available.
     """
-    return HttpResponse("Not implemented yet.",
-                        content_type="text/plain", status=500)
     mlist = get_list_by_name(list_name, request.get_host())
-    month = month_name_to_num(month_name)
-    year = int(year)
-    begin_date = datetime.datetime(year, month, 1)
-    if month != 12:
-        end_month = month + 1
-    else:
-        end_month = 1
-    end_date = datetime.datetime(year, end_month, 1)
-    messages = Email.objects.filter(
-        mailinglist=mlist, date__gte=begin_date, date__lte=end_date
-        ).order_by("date")
-    mboxfile, mboxfilepath = tempfile.mkstemp(
-        prefix="hyperkitty-", suffix=".mbox.gz")
-    os.close(mboxfile)
-    mbox = mailbox.mbox(mboxfilepath)
-    for msg in messages:
-        mbox.add(msg.full)
-    mbox.close()
-    content = StringIO()
-    zipped_content = gzip.GzipFile(fileobj=content)
-    with gzip.GzipFile(fileobj=content, mode="wb") as zipped_content:
-        with open(mboxfilepath, "rb") as mboxfile:
-            zipped_content.write(mboxfile.read())
-    response = HttpResponse(content.getvalue())
-    content.close()
-    response['Content-Type'] = "application/mbox+gz"
-    response['Content-Disposition'] = 'attachment; filename=%d-%s.txt.gz' \
-        % (year, month_name)
-    response['Content-Length'] = len(response.content)
-    os.remove(mboxfilepath)
-    return response
+    try:
+        month = month_name_to_num(month_name)
+    except KeyError:
+        raise Http404("No such month.")
+    begin_date, end_date = get_display_dates(year, month, None)
+    url = reverse('hk_list_export_mbox', kwargs={
+        'mlist_fqdn': mlist.name,
+        'filename': "%s-%s" % (year, month_name),
+        })
+    return redirect("%s?%s" % (url, urlencode({
+        "start": begin_date.strftime("%Y-%m-%d"),
+        "end": end_date.strftime("%Y-%m-%d"),
+        })))
 
 
 def message(request, list_name, year, month_name, msg_num):
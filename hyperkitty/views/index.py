@@ -21,18 +21,19 @@
 #
 
 import json
-import re
 
 from django.conf import settings
 from django.db.models import Q
+from django.db.models.functions import Coalesce
 from django.http import HttpResponse
 from django.shortcuts import redirect, render
 
 from django_mailman3.lib.mailman import get_subscriptions
 from django_mailman3.lib.paginator import paginate
-from django_mailman3.models import MailDomain
 
+from hyperkitty.lib.mailman import get_mail_domains
 from hyperkitty.models import ArchivePolicy, MailingList
+from hyperkitty.models.stats import update_activity
 
 
 def index(request):
@@ -41,24 +42,16 @@ def index(request):
 
     # Domain filtering
     if getattr(settings, 'FILTER_VHOST', False):
-        our_lists = MailingList.objects.none()
         domain = request.get_host().split(":")[0]
-        mail_hosts = []
-        for mlist in mlists:
-            mail_host = re.sub('^.*@', '', mlist.name)
-            try:
-                if (MailDomain.objects.get(
-                        mail_domain=mail_host).site.domain == domain):
-                    if mail_host not in mail_hosts:
-                        mail_hosts.append(mail_host)
-            except MailDomain.DoesNotExist:
-                pass
+        mail_hosts = sorted(
+            mail_host for mail_host, site_domain
+            in get_mail_domains().items() if site_domain == domain)
         if len(mail_hosts) == 0:
             mail_hosts = [domain]
-        for domain in mail_hosts:
-            domain = '@%s' % domain
-            our_lists = our_lists | mlists.filter(name__iendswith=domain)
-        mlists = our_lists
+        domain_filter = Q()
+        for mail_host in mail_hosts:
+            domain_filter |= Q(name__iendswith='@%s' % mail_host)
+        mlists = mlists.filter(domain_filter)
 
     # Name filtering
     name_filter = request.GET.get('name')
@@ -88,15 +81,25 @@ def index(request):
         mlists = mlists.filter(
             archive_policy=ArchivePolicy.public.value)
 
+    # The stored activity summary, to sort in the database. Lists that don't
+    # have one yet (created since the last refresh) get it computed now, they
+    # would otherwise be sorted and shown as inactive.
+    for mlist in mlists.filter(activity__isnull=True):
+        update_activity(mlist)
+    mlists = mlists.annotate(
+        activity_threads_count=Coalesce(
+            "activity__recent_threads_count", 0),
+        activity_participants_count=Coalesce(
+            "activity__recent_participants_count", 0),
+        )
+
     # Sorting
     if sort_mode == "name":
         mlists = mlists.order_by("name")
     elif sort_mode == "active":
-        mlists = list(mlists)
-        mlists.sort(key=lambda l: l.recent_threads_count, reverse=True)
+        mlists = mlists.order_by("-activity_threads_count", "name")
     elif sort_mode == "popular":
-        mlists = list(mlists)
-        mlists.sort(key=lambda l: l.recent_participants_count, reverse=True)
+        mlists = mlists.order_by("-activity_participants_count", "name")
     elif sort_mode == "creation":
         mlists = mlists.order_by("-created_at")
     else:
@@ -106,6 +109,11 @@ def index(request):
     # Inactive List Setting
     show_inactive = getattr(settings, 'SHOW_INACTIVE_LISTS_DEFAULT', False)
 
+    mlists = paginate(
+        mlists, request.GET.get('page'),
+        request.GET.get('count') or getattr(
+            settings, "HYPERKITTY_INDEX_LISTS_PER_PAGE", 1000))
+
     context = {
         'view_name': 'all_lists',
         'all_lists': mlists,
@@ -36,9 +36,8 @@ from django.utils.http import urlunquote
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
-from django_mailman3.models import MailDomain
-
 from hyperkitty.lib.incoming import DuplicateMessage, add_to_list
+from hyperkitty.lib.mailman import get_mail_domains
 from hyperkitty.lib.utils import get_message_id_hash
 
 
@@ -93,11 +92,7 @@ def _get_url(mlist_fqdn, msg_id=None):
             "mlist_fqdn": mlist_fqdn, "message_id_hash": msg_hash})
     relative_url = urlunquote(url)
     mail_domain = mlist_fqdn.split("@")[1]
-    try:
-        domain = MailDomain.objects.get(
-            mail_domain=mail_domain).site.domain
-    except MailDomain.DoesNotExist:
-        domain = mail_domain
+    domain = get_mail_domains().get(mail_domain, mail_domain)
     return urljoin("https://%s" % domain, relative_url)
 
 
@@ -23,6 +23,7 @@
 import datetime
 import json
 import logging
+import os
 import urllib
 
 from django.conf import settings
@@ -41,8 +42,9 @@ from hyperkitty.forms import MessageDeleteForm, PostForm, ReplyForm
 from hyperkitty.lib.mailman import ModeratedListException
 from hyperkitty.lib.posting import PostingFailed, post_to_list, reply_subject
 from hyperkitty.lib.view_helpers import (
-    check_mlist_private, get_months, get_posting_form)
-from hyperkitty.models.email import Attachment, Email
+    check_mlist_private, file_response, get_months,
+    get_posting_form, set_user_votes)
+from hyperkitty.models.email import Email
 from hyperkitty.models.mailinglist import MailingList
 from hyperkitty.models.thread import Thread
 
@@ -59,10 +61,7 @@ def index(request, mlist_fqdn, message_id_hash):
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
     message = get_object_or_404(
         Email, mailinglist=mlist, message_id_hash=message_id_hash)
-    if request.user.is_authenticated:
-        message.myvote = message.votes.filter(user=request.user).first()
-    else:
-        message.myvote = None
+    set_user_votes([message], request.user)
 
     # Export button
     export = {
@@ -99,14 +98,31 @@ def attachment(request, mlist_fqdn, message_id_hash, counter, filename):
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
     message = get_object_or_404(
         Email, mailinglist=mlist, message_id_hash=message_id_hash)
-    att = get_object_or_404(
-        Attachment, email=message, counter=int(counter))
+    att = get_object_or_404(message.attachments, counter=int(counter))
     if att.name != filename:
         raise Http404
-    # http://djangosnippets.org/snippets/1710/
-    response = HttpResponse(att.get_content())
-    response['Content-Type'] = att.content_type
-    response['Content-Length'] = att.size
+    filepath = att.get_path()
+    sendfile = getattr(settings, "HYPERKITTY_ATTACHMENT_SENDFILE", None)
+    if filepath is not None and sendfile:
+        # Let the web server send the file.
+        response = _sendfile_response(sendfile, filepath)
+        response['Content-Type'] = att.content_type
+    else:
+        try:
+            content = att.open_content()
+        except FileNotFoundError:
+            logger.error("Could not find local attachment %s for email %s",
+                         att.counter, message.id)
+            raise Http404
+        size = content.seek(0, os.SEEK_END)
+        content.seek(0)
+        # The content of an attachment never changes.
+        response = file_response(
+            request, content, size, att.content_type,
+            etag='"%s-%s-%x"' % (message.message_id_hash, att.counter, size),
+            last_modified=message.archived_date)
+    if response.status_code not in (200, 206):
+        return response
     if att.encoding is not None:
         response['Content-Encoding'] = att.encoding
     # Follow RFC2231, browser support is sufficient nowadays (2012-09)
@@ -115,6 +131,26 @@ def attachment(request, mlist_fqdn, message_id_hash, counter, filename):
     return response
 
 
+def _sendfile_response(header, filepath):
+    """
+    Return an empty response asking the web server to send the file, with the
+    ``X-Sendfile`` header (Apache's mod_xsendfile, Lighttpd) or the
+    ``X-Accel-Redirect`` header (Nginx).
+    """
+    response = HttpResponse()
+    if header.lower() == "x-accel-redirect":
+        # The internal location of the attachments folder in Nginx.
+        prefix = getattr(
+            settings, "HYPERKITTY_ATTACHMENT_SENDFILE_PREFIX", "/attachments/")
+        relpath = os.path.relpath(
+            filepath, settings.HYPERKITTY_ATTACHMENT_FOLDER)
+        response['X-Accel-Redirect'] = urllib.parse.quote(
+            "%s/%s" % (prefix.rstrip("/"), relpath.replace(os.sep, "/")))
+    else:
+        response['X-Sendfile'] = filepath
+    return response
+
+
 @require_POST
 @check_mlist_private
 def vote(request, mlist_fqdn, message_id_hash):
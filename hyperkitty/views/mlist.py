@@ -22,7 +22,6 @@
 
 import datetime
 import json
-import zlib
 
 from django.conf import settings
 from django.contrib import messages
@@ -41,10 +40,16 @@ from django.views.decorators.cache import cache_page
 from django_mailman3.lib.mailman import get_mailman_user_id
 from django_mailman3.lib.paginator import paginate
 
+from hyperkitty.lib.archives import serve_month_archive
+from hyperkitty.lib.mbox import gzip_stream, iter_mbox
+from hyperkitty.lib.paginator import (
+    InvalidCursor, cursor_paginate, use_cursor_pagination)
 from hyperkitty.lib.view_helpers import (
     check_mlist_private, daterange, get_category_widget,
     get_display_dates, get_months)
-from hyperkitty.models import Email, Favorite, MailingList
+from hyperkitty.models import (
+    Email, Favorite, LastView, MailingList, ThreadCategory)
+from hyperkitty.models.stats import get_day
 from hyperkitty.signals import silenced_email_pre_delete
 
 
@@ -64,7 +69,7 @@ def archives(request, mlist_fqdn, year=None, month=None, day=None):
         # Since we don't need any special filtering, just return *all* the
         # threads ordered by date_active.
         threads = mlist.threads.order_by("-date_active")
-        if threads:
+        if threads.exists():
             begin_date = Email.objects.order_by('date').first().date
         else:
             begin_date = end_date
@@ -118,21 +123,45 @@ def archives(request, mlist_fqdn, year=None, month=None, day=None):
 def _thread_list(request, mlist, threads,
                  template_name='hyperkitty/thread_list.html',
                  extra_context=None):
-    threads = paginate(threads, request.GET.get('page'),
-                       request.GET.get('count'))
+    threads = threads.select_related(
+        "starting_email", "starting_email__sender", "category")
+    if use_cursor_pagination(request):
+        try:
+            threads = cursor_paginate(
+                threads, request.GET.get('cursor'), request.GET.get('count'),
+                ordering=("-date_active", "-id"))
+        except InvalidCursor:
+            raise Http404("Invalid cursor")
+    else:
+        threads = paginate(threads, request.GET.get('page'),
+                           request.GET.get('count'))
+    # Load the favorites and the last views of the user for the whole page.
+    favorites = set()
+    last_views = {}
+    if request.user.is_authenticated:
+        thread_ids = [thread.id for thread in threads]
+        favorites = set(Favorite.objects.filter(
+            thread_id__in=thread_ids, user=request.user,
+            ).values_list("thread_id", flat=True))
+        for thread_id, view_date in LastView.objects.filter(
+                thread_id__in=thread_ids, user=request.user,
+                ).order_by("view_date").values_list("thread_id", "view_date"):
+            last_views[thread_id] = view_date
+    categories = list(ThreadCategory.objects.all())
     for thread in threads:
         # Favorites
-        thread.favorite = False
+        thread.favorite = thread.id in favorites
+        # Unread
         if request.user.is_authenticated:
-            try:
-                Favorite.objects.get(thread=thread, user=request.user)
-            except Favorite.DoesNotExist:
-                pass
-            else:
-                thread.favorite = True
+            view_date = last_views.get(thread.id)
+            thread.unread = (
+                view_date is None or
+                thread.date_active.replace(tzinfo=timezone.utc) > view_date)
+        else:
+            thread.unread = False
         # Category
-        thread.category_hk, thread.category_form = \
-            get_category_widget(request, thread.category)
+        thread.category_hk, thread.category_form = get_category_widget(
+            request, thread.category, categories=categories)
 
     context = {
         'mlist': mlist,
@@ -232,7 +261,9 @@ def overview_favorites(request, mlist_fqdn):
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
     if request.user.is_authenticated:
         favorites = [f.thread for f in Favorite.objects.filter(
-            thread__mailinglist=mlist, user=request.user)]
+            thread__mailinglist=mlist, user=request.user).select_related(
+            "thread__starting_email", "thread__starting_email__sender",
+            "thread__category")]
     else:
         favorites = []
     return render(request, "hyperkitty/fragments/overview_threads.html", {
@@ -251,11 +282,14 @@ def overview_posted_to(request, mlist_fqdn):
         mm_user_id = get_mailman_user_id(request.user)
         threads_posted_to = []
         if mm_user_id is not None:
-            for thread in mlist.recent_threads:
-                senders = set(
-                    [e.sender.mailman_id for e in thread.emails.all()])
-                if mm_user_id in senders:
-                    threads_posted_to.append(thread)
+            recent_threads = mlist.recent_threads
+            posted_to = set(Email.objects.filter(
+                thread_id__in=[thread.id for thread in recent_threads],
+                sender__mailman_id=mm_user_id,
+                ).values_list("thread_id", flat=True))
+            threads_posted_to = [
+                thread for thread in recent_threads
+                if thread.id in posted_to]
     else:
         threads_posted_to = []
     return render(request, "hyperkitty/fragments/overview_threads.html", {
@@ -281,27 +315,18 @@ def recent_activity(request, mlist_fqdn):
     """Return the number of emails posted in the last 30 days"""
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
     begin_date, end_date = mlist.get_recent_dates()
-    days = daterange(begin_date, end_date)
-
-    # Use get_messages and not get_threads to count the emails, because
-    # recently active threads include messages from before the start date
-    emails_in_month = mlist.emails.filter(
-        date__gte=begin_date,
-        date__lt=end_date)
-    # graph
-    emails_per_date = {}
-    # populate with all days before adding data.
-    for day in days:
-        emails_per_date[day.strftime("%Y-%m-%d")] = 0
-    # now count the emails
-    for email in emails_in_month:
-        date_str = email.date.strftime("%Y-%m-%d")
-        if date_str not in emails_per_date:
-            continue  # outside the range
-        emails_per_date[date_str] += 1
+    days = [get_day(d) for d in daterange(begin_date, end_date)]
+
+    # Use the daily statistics and not the threads to count the emails,
+    # because recently active threads include messages from before the start
+    # date
+    emails_per_date = dict(mlist.daily_stats.filter(
+        date__gte=days[0], date__lte=days[-1],
+        ).values_list("date", "emails_count"))
     # return the proper format for the javascript chart function
-    evolution = [{"date": d, "count": emails_per_date[d]}
-                 for d in sorted(emails_per_date)]
+    evolution = [{"date": d.strftime("%Y-%m-%d"),
+                  "count": emails_per_date.get(d, 0)}
+                 for d in days]
     return HttpResponse(json.dumps({"evolution": evolution}),
                         content_type='application/javascript')
 
@@ -310,6 +335,7 @@ def recent_activity(request, mlist_fqdn):
 def export_mbox(request, mlist_fqdn, filename):
     mlist = get_object_or_404(MailingList, name=mlist_fqdn)
     query = mlist.emails
+    start_date = end_date = None
     try:
         if "start" in request.GET:
             start_date = datetime.datetime.strptime(
@@ -327,17 +353,22 @@ def export_mbox(request, mlist_fqdn, filename):
         query = query.filter(thread__thread_id=request.GET["thread"])
     if "message" in request.GET:
         query = query.filter(message_id_hash=request.GET["message"])
-
-    def stream_mbox(query):
-        # Use the gzip format: http://www.zlib.net/manual.html#Advanced
-        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
-        for email in query.order_by("archived_date").all():
-            msg = email.as_message()
-            yield compressor.compress(msg.as_bytes(unixfrom=True))
-            yield compressor.compress(b"\n\n")
-        yield compressor.flush()
+    if ("thread" not in request.GET and "message" not in request.GET
+            and start_date is not None and get_display_dates(
+                start_date.year, start_date.month, None) == (
+                start_date, end_date)):
+        # A whole month: serve the precomputed archive if it is available.
+        response = serve_month_archive(
+            request, mlist, start_date.year, start_date.month,
+            "%s.mbox.gz" % filename)
+        if response is not None:
+            return response
+
+    threaded = getattr(
+        settings, "HYPERKITTY_MBOX_EXPORT_COMPRESSION_THREAD", False)
     response = StreamingHttpResponse(
-        stream_mbox(query), content_type="application/gzip")
+        gzip_stream(iter_mbox(query), threaded=threaded),
+        content_type="application/gzip")
     response['Content-Disposition'] = (
         'attachment; filename="%s.mbox.gz"' % filename)
     return response
@@ -21,11 +21,11 @@
 #
 
 from django.conf import settings
+from django.db.models import Q
 from django.forms import ValidationError
 from django.http import Http404
 from django.shortcuts import render
 from django.utils.translation import gettext as _
-from django.db.models import Q
 
 from django_mailman3.lib.mailman import get_subscriptions
 from django_mailman3.lib.paginator import paginate
@@ -33,8 +33,8 @@ from haystack import DEFAULT_ALIAS
 from haystack.forms import SearchForm
 from haystack.query import EmptySearchQuerySet, RelatedSearchQuerySet
 
-from hyperkitty.lib.view_helpers import is_mlist_authorized
-from hyperkitty.models import ArchivePolicy, MailingList, Email
+from hyperkitty.lib.view_helpers import is_mlist_authorized, set_user_votes
+from hyperkitty.models import ArchivePolicy, Email, MailingList
 
 
 class FullTextSearchForm(SearchForm):
@@ -135,12 +135,7 @@ def search(request):
             _('Parsing error: %(error)s'),
             params={"error": e}, code="parse",
             ))
-    for email in emails:
-        if request.user.is_authenticated:
-            email.myvote = email.votes.filter(
-                user=request.user).first()
-        else:
-            email.myvote = None
+    set_user_votes(emails, request.user)
 
     context = {
         'mlist': mlist,
@@ -42,9 +42,11 @@ from haystack.query import SearchQuerySet
 from hyperkitty.forms import AddTagForm, ReplyForm
 from hyperkitty.lib.utils import stripped_subject
 from hyperkitty.lib.view_helpers import (
-    check_mlist_private, get_category_widget, get_months, get_posting_form)
+    check_mlist_private, get_category_widget, get_months,
+    get_posting_form, set_user_votes)
 from hyperkitty.models import (
     Favorite, LastView, MailingList, Tag, Tagging, Thread)
+from hyperkitty.models.common import CachedValue
 
 
 REPLY_RE = re.compile(r'^(re:\s*)*', re.IGNORECASE)
@@ -68,12 +70,9 @@ def _get_thread_replies(request, thread, limit, offset=0):
     emails = list(thread.emails.exclude(
             pk=thread.starting_email.pk
         ).order_by(sort_mode)[offset:offset+limit])
+    CachedValue.get_many(emails, ["votes"])
+    set_user_votes(emails, request.user)
     for email in emails:
-        # Extract all the votes for this message
-        if request.user.is_authenticated:
-            email.myvote = email.votes.filter(user=request.user).first()
-        else:
-            email.myvote = None
         # Threading position
         if sort_mode == "thread_order":
             # If the email's thread_order is None, we set it to 1 by
@@ -107,11 +106,7 @@ def thread_index(request, mlist_fqdn, threadid, month=None, year=None):
     starting_email = thread.starting_email
 
     sort_mode = request.GET.get("sort", "thread")
-    if request.user.is_authenticated:
-        starting_email.myvote = starting_email.votes.filter(
-            user=request.user).first()
-    else:
-        starting_email.myvote = None
+    set_user_votes([starting_email], request.user)
 
     # Tags
     tag_form = AddTagForm()
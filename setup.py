@@ -37,7 +37,7 @@ with open('hyperkitty/__init__.py') as fp:
 
 # Requirements
 REQUIRES = [
-    "Django>=2.0,<3.1",
+    "Django>=2.2,<3.1",
     "django_mailman3>=1.3.3",
     "django-gravatar2>=1.0.6",
     "djangorestframework>=3.0.0",
@@ -46,7 +46,6 @@ REQUIRES = [
     "django-compressor>=1.3",
     "mailmanclient>=3.3.1",
     "python-dateutil >= 2.0",
-    "networkx>=2.0",
     "django-haystack>=2.8.0",
     "django-extensions>=1.3.7",
     "flufl.lock>=4.0",